@@ -0,0 +1,160 @@
+"""
+Engine opponents of the server. A fixed number of EngineWorker processes search for all games against the engine, so
+the CPU they use is bounded however many of these games are played at once - moves of the other games wait in a queue.
+
+The queue takes the games in turns (round robin): a game has at most one move waiting, and a game asking again goes
+behind every game which is already waiting, so no game can keep the workers to itself. Every search is limited by the
+budget of its game - time and nodes per move - and its move is passed to the on_move callback from the pool's thread.
+"""
+import threading
+from collections import deque
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
+from typing import Callable, Deque, Dict, Tuple, Union
+from engine import GameState
+from chess_ai import MAX_DEPTH
+from engine_worker import EngineWorker
+
+WORKERS = 2
+TT_SIZE = 200_000  # Positions in the transposition table of a worker - the workers are shared by many games
+
+
+class GameBudget:
+    __slots__ = ('move_time', 'nodes')
+
+    def __init__(self, move_time: Union[float, None] = None, nodes: Union[int, None] = None):
+        """
+        :param move_time: seconds of search per move
+        :param nodes: nodes searched per move - the search goes as deep as these limits allow, without both it stops at
+                      the default depth of the engine
+        """
+        self.move_time = move_time
+        self.nodes = nodes
+
+
+class AiPool:
+    def __init__(self, on_move: Callable[[int, int], None], workers: int = WORKERS, tt_size: int = TT_SIZE,
+                 book_path: Union[str, None] = None):
+        """
+        :param on_move: called with (game id, Move.move_id) when the engine has found its move - from the pool's thread
+        :param workers: number of engine processes
+        :param book_path: Polyglot opening book of the workers, used if the file exists
+        """
+        self.on_move = on_move
+        self.workers = [EngineWorker(tt_size=tt_size, book_path=book_path) for _ in range(workers)]
+        self.budgets: Dict[int, GameBudget] = dict()  # game id -> budget of the game
+        self.queue: Deque[int] = deque()  # Ids of the games waiting for a worker, in turn
+        self.positions: Dict[int, str] = dict()  # game id -> FEN to search, of the games in the queue
+        self.searches: Dict[EngineWorker, Tuple[int, str]] = dict()  # worker -> (game id, FEN) of its search
+        self.lock = threading.Lock()
+        self.closed = False
+        self.wake_reader, self.wake_writer = Pipe(duplex=False)  # Wakes the pool's thread when a request comes
+        self.wake_lock = threading.Lock()
+        self.wake_pending = False  # A wake-up is in the pipe - at most one is, so waking never blocks on a full pipe
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add_game(self, game_id: int, budget: GameBudget) -> None:
+        with self.lock:
+            self.budgets[game_id] = budget
+
+    def remove_game(self, game_id: int) -> None:
+        """
+        Forgets the game - its waiting move is dropped and its running search stopped.
+        """
+        with self.lock:
+            self.budgets.pop(game_id, None)
+            self.positions.pop(game_id, None)  # Left in the queue, skipped when its turn comes
+        self.wake()
+
+    def request(self, game_id: int, fen: str) -> None:
+        """
+        Queues the search of the engine's move in the position. Does not block.
+        """
+        with self.lock:
+            if game_id not in self.budgets:
+                return
+            if game_id not in self.positions:
+                self.queue.append(game_id)
+            self.positions[game_id] = fen
+        self.wake()
+
+    def waiting(self) -> int:
+        """
+        :return: number of games waiting for a worker
+        """
+        with self.lock:
+            return len(self.positions)
+
+    def wake(self) -> None:
+        """
+        Wakes the pool's thread without blocking - request() is called under the lock of the server's sessions, which
+        the pool's thread needs to deliver moves.
+        """
+        with self.wake_lock:
+            if self.wake_pending:
+                return
+            self.wake_pending = True
+        self.wake_writer.send(None)
+
+    def run(self) -> None:
+        """
+        Starts searches on free workers and delivers their moves. Sleeps until a worker replies or a request comes.
+        """
+        while True:
+            ready = wait([self.wake_reader] + [worker.connection for worker in self.workers])
+            if self.wake_reader in ready:
+                with self.wake_lock:  # Requests coming from now on send a new wake-up
+                    self.wake_pending = False
+                while self.wake_reader.poll():
+                    self.wake_reader.recv()
+            if self.closed:
+                return
+            try:
+                for worker in self.workers:
+                    for reply in worker.poll():
+                        if reply[0] == 'bestmove' and worker in self.searches:
+                            self.deliver(*self.searches.pop(worker), reply[2])
+            except (EOFError, OSError):  # A worker process has gone away - the server is shutting down
+                return
+            self.schedule()
+
+    def deliver(self, game_id: int, fen: str, notation: Union[str, None]) -> None:
+        with self.lock:
+            if game_id not in self.budgets:  # Removed while searching
+                return
+        move = GameState(fen).get_move_from_notation(notation) if notation is not None else None
+        if move is not None:
+            self.on_move(game_id, move.move_id)
+
+    def schedule(self) -> None:
+        """
+        Stops the searches of removed games and gives the free workers the next games in turn.
+        """
+        with self.lock:
+            for worker, (game_id, _) in list(self.searches.items()):
+                if game_id not in self.budgets:
+                    worker.stop()
+                    del self.searches[worker]
+            for worker in self.workers:
+                if worker in self.searches:
+                    continue
+                while self.queue and self.queue[0] not in self.positions:  # Removed games
+                    self.queue.popleft()
+                if not self.queue:
+                    break
+                game_id = self.queue.popleft()
+                fen = self.positions.pop(game_id)
+                budget = self.budgets[game_id]
+                worker.set_position(fen)
+                # The budget limits the search, not the default depth of the engine
+                depth = MAX_DEPTH if budget.nodes is not None or budget.move_time is not None else None
+                worker.go(depth=depth, nodes=budget.nodes, move_time=budget.move_time)
+                self.searches[worker] = (game_id, fen)
+
+    def close(self) -> None:
+        self.closed = True
+        self.wake()
+        self.thread.join()
+        for worker in self.workers:
+            worker.close()
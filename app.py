@@ -5,12 +5,11 @@ import threading
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
 import pygame as pg
 from collections.abc import Callable
-from typing import Tuple, Union, List, Iterable
+from typing import Tuple, Union, List
 from typing_extensions import Literal
 from widgets import MyButton, MyInputBox, MyChatBox, MyMessage, MyLobbyBox, MyPlayerWidget
 from player import Player
 from threading import Thread
-from collections import Counter
 
 """
 Main file containing entry point of the application. Responsible for GUI functionalities.
@@ -24,6 +23,7 @@ WINDOW_START_POS_Y: int = 40
 WINDOW_START_WIDTH: int = 800
 WINDOW_START_HEIGHT: int = 600
 FPS: int = 30
+SERVER_EVENT: int = pg.USEREVENT + 1  # Message from the server, posted by the receiving thread of the player
 STANDARD_FONT: str = 'Times New Roman'
 
 # END CONST SECTION ----------------------------------------------------------------------------------------------------
@@ -147,34 +147,37 @@ class App:
                         else:
                             widget.add_letter(event)
 
-        self.check_server_events()
+        if event.type == SERVER_EVENT and event.player is self.player:  # Not left over from an earlier connection
+            self.check_server_event(event.message)
 
-    def check_server_events(self):
-        if not self.player.received_message_queue.empty():
-            message = self.player.received_message_queue.get()
-            message_widget = MyMessage(message['text'], message['author'])
-            message_widget.prepare_message(350)
-            self.chat_box.add_message(message_widget)
-
-        # Lobby Players
-        if not App.compare_two_iterables(self.player.lobby_names, self.lobby_box.player_names):
-            if len(self.player.lobby_names) > len(self.lobby_box.player_names):  # Player has entered the lobby
-                for name in self.player.lobby_names:
-                    if name not in self.lobby_box.player_names:
-                        if name == self.player.name:
-                            self.lobby_box.add_player_widget(name, self.on_accept_button_clicked, self.on_invite_button_clicked, add_buttons=False, my_player=True)
-                        else:
-                            self.lobby_box.add_player_widget(name, self.on_accept_button_clicked, self.on_invite_button_clicked)
-            else:  # Player has quited
-                for name in self.lobby_box.player_names:
-                    if name not in self.player.lobby_names:
-                        self.lobby_box.remove_player_widget(name)
+    def check_server_event(self, message: Union[dict, None]) -> None:
+        """
+        Updates the lobby with a message from the server.
 
+        :param message: None if the connection was lost
+        """
         # Connection error in lobby
-        if not self.player.connected:
+        if message is None:
             # Close lobby
             self.display_error_info = True
             self.on_return_from_lobby_menu_clicked()
+            return
+
+        if 'MSG' in message:
+            message_widget = MyMessage(message['MSG']['text'], message['MSG']['author'])
+            message_widget.prepare_message(350)
+            self.chat_box.add_message(message_widget)
+
+        # Lobby Players - the player passes on only the changes which follow the lobby it has
+        if 'LOBBY' in message:  # The whole lobby, after joining it or missing a change
+            for name in list(self.lobby_box.player_names):
+                self.lobby_box.remove_player_widget(name)
+            for name in message['LOBBY']['players']:
+                self.add_player_widget(name)
+        elif 'JOINED' in message:
+            self.add_player_widget(message['JOINED']['player'])
+        elif 'LEFT' in message:
+            self.lobby_box.remove_player_widget(message['LEFT']['player'])
 
     # End of functions checking events ---------------------------------------------------------------------------------
 
@@ -325,7 +328,8 @@ class App:
         lobby_connection_thread.start()
 
     def connect_to_lobby(self, name: str):
-        self.player = Player(name)
+        player = Player(name, on_message=lambda message: App.post_server_event(player, message))
+        self.player = player
         self.scene_events[self.scene] = self.check_events_enter_name_menu
         self.do_render_banner = False
         if self.player.connected:
@@ -334,10 +338,7 @@ class App:
             self.scene_widgets[self.scene].clear()
             self.create_widgets_lobby_menu()
             self.scene = 'lobby_menu'
-            receive_thread = threading.Thread(target=self.player.receive)
-            send_thread = threading.Thread(target=self.player.send)
-            receive_thread.start()
-            send_thread.start()
+            self.player.start()
         else:
             if self.player.lobby_full:
                 self.lobby_full = True
@@ -372,7 +373,7 @@ class App:
             if isinstance(widget, MyInputBox):
                 message = widget.text
         if message != '':
-            self.player.message_to_send = message
+            self.player.send_chat_message(message)
 
     def on_return_from_lobby_menu_clicked(self) -> None:
         self.close_connections()
@@ -455,17 +456,26 @@ class App:
         self.screen.blit(self.banner, (0, 0), special_flags=pg.BLEND_MULT)
         self.draw_text(self.banner_text, STANDARD_FONT, 44, pg.Color('red'), 400, 300, align='center')
 
-    @staticmethod
-    def compare_two_iterables(one: Iterable, two: Iterable):
-        return Counter(one) == Counter(two)
+    def add_player_widget(self, name: str) -> None:
+        if name == self.player.name:
+            self.lobby_box.add_player_widget(name, self.on_accept_button_clicked, self.on_invite_button_clicked,
+                                             add_buttons=False, my_player=True)
+        else:
+            self.lobby_box.add_player_widget(name, self.on_accept_button_clicked, self.on_invite_button_clicked)
 
     def close_connections(self):
         if self.player is not None:
-            self.player.stop_thread = True
-            self.player.connected = False
-            self.player.client.close()
+            self.player.close()
             self.player = None
 
+    @staticmethod
+    def post_server_event(player: Player, message: Union[dict, None]) -> None:
+        """
+        Passes a message from the receiving thread of the player to the main loop, which is woken by the event instead
+        of polling the player.
+        """
+        pg.event.post(pg.event.Event(SERVER_EVENT, player=player, message=message))
+
     # End of helping functions -----------------------------------------------------------------------------------------
 
 
@@ -0,0 +1,284 @@
+"""
+Lobby server on asyncio streams. Every client is served by a task instead of an OS thread, so thousands of idle
+connections fit in one process and a client that is slow to send its nickname never holds up the accept loop. Speaks
+the same protocol as server.py:
+
+    python async_server.py
+"""
+import asyncio
+from typing import Dict, Iterable, Union
+import protocol
+from server import HOST, PORT, MAX_LOBBY_SIZE, MAX_LOBBIES, AI_NICKNAME, AI_WORKERS, AI_BUDGETS
+from ai_pool import AiPool
+from lobby import Lobby, LobbyManager
+from session import GameSession, SessionManager
+
+HANDSHAKE_TIMEOUT = 10  # Seconds a new client has to send its nickname
+BACKLOG = 1024  # Connections waiting to be accepted
+MAX_WRITE_BUFFER = 1 << 20  # Bytes waiting to be sent to a client - a client with more is not reading and is dropped
+
+
+class AsyncServer:
+    def __init__(self, host: str = HOST, port: int = PORT, max_lobby_size: int = MAX_LOBBY_SIZE,
+                 max_lobbies: int = MAX_LOBBIES):
+        self.host = host
+        self.port = port
+        self.clients: Dict[str, asyncio.StreamWriter] = dict()  # nickname -> stream of the client, in joining order
+        self.server: Union[asyncio.AbstractServer, None] = None
+        self.lobbies = LobbyManager(max_lobby_size, max_lobbies, on_change=self.on_lobby_change)
+        self.sessions = SessionManager(on_move=self.on_move)
+        self.ai_pool = AiPool(self.on_ai_move, AI_WORKERS)
+        self.loop: Union[asyncio.AbstractEventLoop, None] = None
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=BACKLOG)
+
+    async def serve_forever(self) -> None:
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def broadcast(self, lobby: Lobby, message: Dict) -> None:
+        """
+        Broadcasts message to the members of the lobby. The message is encoded once and queued on every stream without
+        waiting.
+
+        :param lobby:
+        :param message:
+        """
+        self.send_to(self.lobbies.members(lobby), message)
+
+    def on_lobby_change(self, lobby: Lobby, nickname: str, joined: bool) -> None:
+        """
+        Sends the change of the lobby to its players, and the whole lobby to the player who has joined it.
+        """
+        if joined:
+            self.send_lobby(lobby, nickname)
+            self.send_to([member for member in lobby.members if member != nickname],
+                         {'JOINED': {'version': lobby.version, 'player': nickname}})
+        else:
+            self.send_to(lobby.members, {'LEFT': {'version': lobby.version, 'player': nickname}})
+
+    def send_lobby(self, lobby: Lobby, nickname: str) -> None:
+        self.send_to([nickname], {'LOBBY': {'name': lobby.name, 'version': lobby.version,
+                                            'players': list(lobby.members)}})
+
+    def send_to(self, nicknames: Iterable[str], message: Dict) -> None:
+        """
+        Sends message to the given clients. The message is encoded once.
+        """
+        frame = protocol.encode(message)
+        for nickname in nicknames:
+            writer = self.clients.get(nickname)
+            if writer is not None:
+                AsyncServer.queue_frame(writer, frame)
+
+    def send_game_end(self, session: GameSession) -> None:
+        self.send_to(session.recipients(), {'END': {'game': session.game_id, 'result': session.result}})
+        if AI_NICKNAME in (session.white, session.black):
+            self.ai_pool.remove_game(session.game_id)
+
+    def make_move(self, nickname: str, game_id: int, move_id: int) -> bool:
+        """
+        Plays the move in the game. The move is sent by on_move.
+
+        :return: True if the move was applied
+        """
+        session, accepted = self.sessions.play(nickname, game_id, move_id)
+        if accepted and session.result is not None:
+            self.send_game_end(session)
+        return accepted
+
+    def start_ai_game(self, nickname: str, color: str, level: int) -> None:
+        """
+        Starts a game of the player against the engine.
+
+        :param color: 'w' or 'b' - color of the player
+        :param level: 1 to len(AI_BUDGETS) - search budget of the engine
+        """
+        white, black = (nickname, AI_NICKNAME) if color == 'w' else (AI_NICKNAME, nickname)
+        session = self.sessions.start(white, black)
+        self.ai_pool.add_game(session.game_id, AI_BUDGETS[min(max(level, 1), len(AI_BUDGETS)) - 1])
+        self.send_to([nickname], {'START': {'game': session.game_id, 'white': session.white, 'black': session.black,
+                                            'fen': session.fen}})
+        if white == AI_NICKNAME:
+            self.ai_pool.request(session.game_id, session.fen)
+
+    def on_move(self, session: GameSession, move_id: int) -> None:
+        """
+        Sends the move to the players and to the spectators - one frame shared by all spectators. Called by the session
+        manager in the order of the moves.
+        """
+        self.send_to((session.white, session.black), {'MOV': {'game': session.game_id, 'move': move_id}})
+        if session.spectators:
+            self.send_to(session.spectators, {'MOVED': {'game': session.game_id, 'ply': session.ply(),
+                                                         'move': move_id}})
+        if session.result is None and session.player_to_move() == AI_NICKNAME:
+            self.ai_pool.request(session.game_id, session.fen)
+
+    def on_ai_move(self, game_id: int, move_id: int) -> None:
+        """
+        Called from the thread of the engine pool - the move is played in the event loop.
+        """
+        self.loop.call_soon_threadsafe(self.make_move, AI_NICKNAME, game_id, move_id)
+
+    def send_game(self, session: GameSession, nickname: str) -> None:
+        """
+        Sends the game as it is now to a new spectator.
+        """
+        self.send_to([nickname], {'GAME': {'game': session.game_id, 'white': session.white, 'black': session.black,
+                                           'fen': session.fen, 'moves': session.ply()}})
+
+    def change_lobby(self, writer: asyncio.StreamWriter, nickname: str, name: str, create: bool = False) -> None:
+        """
+        Moves the client to another lobby. The players of both lobbies are updated by on_lobby_change.
+
+        :param name: name of the lobby, '' - any lobby with a free place, or a new lobby named by the server if create
+        :param create: if True, the lobby is opened first
+        """
+        previous = self.lobbies.lobby_of(nickname)
+        if create:
+            lobby = self.lobbies.create_and_join(nickname, name)
+        else:
+            lobby = self.lobbies.join(nickname, name)
+        if lobby is None:
+            AsyncServer.queue_frame(writer, protocol.encode({'NO_SPACE': ''}))
+        elif lobby is previous:  # Nothing has changed, the client gets its lobby anyway
+            self.send_lobby(lobby, nickname)
+
+    @staticmethod
+    def queue_frame(writer: asyncio.StreamWriter, frame: bytes) -> None:
+        """
+        Queues a frame on the stream without waiting. A client which lets too much pile up is disconnected - its
+        handler then ends on the closed stream.
+        """
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            writer.transport.abort()
+        else:
+            writer.write(frame)
+
+    @staticmethod
+    async def send_object_message(writer: asyncio.StreamWriter, message_object: Dict) -> None:
+        writer.write(protocol.encode(message_object))
+        await writer.drain()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serves a client from its first contact until it disconnects.
+        """
+        print(f'Connected with {writer.get_extra_info("peername")}')
+        nickname = None
+        try:
+            nickname = await asyncio.wait_for(self.join(reader, writer), HANDSHAKE_TIMEOUT)
+            if nickname is not None:
+                await self.handle(reader, writer, nickname)
+        except Exception as e:
+            print(e)
+        finally:
+            if nickname is not None and self.clients.get(nickname) is writer:
+                self.lobbies.leave(nickname)
+                del self.clients[nickname]
+                for session in self.sessions.leave(nickname):  # The opponents win
+                    self.send_game_end(session)
+            writer.close()
+
+    async def join(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Union[str, None]:
+        """
+        Asks the client for a nickname and adds it to the lobby.
+
+        :return: nickname or None if the client was not let in
+        """
+        if self.lobbies.is_full():
+            await AsyncServer.send_object_message(writer, {'NO_SPACE': ''})
+            return None
+        await AsyncServer.send_object_message(writer, {'NICK': ''})
+        message = await protocol.read_message(reader)
+        if message is None:
+            return None
+        message_header = list(message.keys())[0]
+        if message_header != 'NICK':
+            raise Exception('First message from client should have a nickname!')
+        nickname = message[message_header]
+        if nickname in self.clients or nickname == AI_NICKNAME:
+            await AsyncServer.send_object_message(writer, {'NICK_IN_USE': ''})
+            return None
+        if self.lobbies.is_full():  # Other clients filled up the lobbies while this one was choosing its nickname
+            await AsyncServer.send_object_message(writer, {'NO_SPACE': ''})
+            return None
+        self.clients[nickname] = writer
+        writer.write(protocol.encode({'OK': ''}))
+        lobby = self.lobbies.join(nickname)  # Sends the lobby to the client and the client to the lobby
+        print(f'{nickname} joined {lobby.name}')
+        return nickname
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, nickname: str) -> None:
+        """
+        Deals with communication with a client.
+
+        :param reader: stream of the client
+        :param writer: stream of the client
+        :param nickname:
+        """
+        while True:
+            message = await protocol.read_message(reader)
+            if message is None:
+                return
+            message_header = list(message.keys())[0]
+            if message_header == 'MSG':  # The author is the sender, whatever it claims
+                text = message[message_header]['text']
+                self.broadcast(self.lobbies.lobby_of(nickname), {'MSG': {'author': nickname, 'text': text}})
+                print(f'Received message from {nickname}:\n{text}')
+
+            elif message_header == 'MOV':
+                game_id, move_id = message[message_header]['game'], message[message_header]['move']
+                if not self.make_move(nickname, game_id, move_id):
+                    AsyncServer.queue_frame(writer, protocol.encode({'ILLEGAL': message[message_header]}))
+
+            elif message_header == 'INVITE':
+                invited = message[message_header]
+                if invited != nickname and invited in self.clients:
+                    self.sessions.invite(nickname, invited)
+                    self.send_to([invited], {'INVITE': nickname})
+
+            elif message_header == 'ACCEPT':
+                session = self.sessions.accept(nickname, message[message_header])
+                if session is not None:
+                    self.send_to(session.recipients(), {'START': {'game': session.game_id, 'white': session.white,
+                                                                  'black': session.black, 'fen': session.fen}})
+                    print(f'Game {session.game_id} started: {session.white} - {session.black}')
+
+            elif message_header == 'LIST':
+                names, sizes = self.lobbies.list()
+                AsyncServer.queue_frame(writer, protocol.encode({'LOBBIES': {'names': names, 'sizes': sizes}}))
+
+            elif message_header in ('JOIN', 'CREATE'):
+                self.change_lobby(writer, nickname, message[message_header], create=message_header == 'CREATE')
+
+            elif message_header == 'AI':
+                self.start_ai_game(nickname, message[message_header]['color'], message[message_header]['level'])
+
+            elif message_header == 'WATCH':
+                game_id = message[message_header]
+                if not self.sessions.watch(nickname, game_id, lambda session: self.send_game(session, nickname)):
+                    AsyncServer.queue_frame(writer, protocol.encode({'END': {'game': game_id, 'result': '*'}}))
+
+            elif message_header == 'UNWATCH':
+                self.sessions.unwatch(nickname, message[message_header])
+
+            elif message_header == 'SYNC':  # The client has missed a change of its lobby
+                self.lobbies.snapshot(nickname, lambda lobby: self.send_lobby(lobby, nickname))
+
+            else:
+                raise Exception('Undefined message header received!')
+
+
+def main() -> None:
+    asyncio.run(AsyncServer().serve_forever())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+"""
+Win/draw/loss bitbases of endgames with a lone king: KPK, KRK, KQK and KBNK. The tables are built by retrograde
+analysis over all placements of the pieces - starting from the checkmates, positions are marked as won or lost by
+walking the moves backwards until nothing changes. Everything else is a draw.
+
+The pieces of the stronger side are always stored as white. A position of the table is indexed by the squares
+(row * 8 + col) of the white king, the other white pieces and the black king:
+
+    index = ((white_king * 64 + piece_1) * 64 + ...) * 64 + black_king
+
+and every table keeps one bit per index for each side to move - white wins with white to move, black loses with black
+to move. All tables are written into one file, which is memory-mapped, so a probe reads a single byte.
+
+Building the tables (seconds for KPK, KRK and KQK, about two minutes for KBNK):
+
+    python bitbases.py resources/bitbases.bin
+"""
+import argparse
+import mmap
+import struct
+import time
+from typing import Dict, List, Tuple, Union
+import numpy as np
+from engine import GameState
+
+TABLES = ('KQK', 'KRK', 'KPK', 'KBNK')  # In the order of building - KPK needs KQK and KRK for promotions
+PROMOTIONS = ('Q', 'R')  # Promotions to a bishop or a knight never win more than a queen or a rook
+MAGIC = b'CGBB'
+_HEADER = struct.Struct('<4sI')
+_TABLE = struct.Struct('<8sQQ')  # Name, offset of the table in the file and number of positions
+CHUNK = 1 << 18  # Positions processed at once - bounds the memory used by temporary arrays
+
+_SQUARES = np.arange(64)
+_ROWS = _SQUARES >> 3
+_COLS = _SQUARES & 7
+_ROW_DISTANCE = np.abs(_ROWS[:, None] - _ROWS[None, :])
+_COL_DISTANCE = np.abs(_COLS[:, None] - _COLS[None, :])
+
+# [from_square, to_square] -> piece attacks the square on an empty board
+KING_ATTACKS = np.maximum(_ROW_DISTANCE, _COL_DISTANCE) == 1
+KNIGHT_ATTACKS = _ROW_DISTANCE * _COL_DISTANCE == 2
+ROOK_ATTACKS = ((_ROW_DISTANCE == 0) | (_COL_DISTANCE == 0)) & ~np.eye(64, dtype=bool)
+BISHOP_ATTACKS = (_ROW_DISTANCE == _COL_DISTANCE) & ~np.eye(64, dtype=bool)
+QUEEN_ATTACKS = ROOK_ATTACKS | BISHOP_ATTACKS
+PAWN_ATTACKS = (_ROWS[None, :] - _ROWS[:, None] == -1) & (_COL_DISTANCE == 1)  # White pawns move to lower rows
+ATTACKS = {'K': KING_ATTACKS, 'N': KNIGHT_ATTACKS, 'B': BISHOP_ATTACKS, 'R': ROOK_ATTACKS, 'Q': QUEEN_ATTACKS,
+           'P': PAWN_ATTACKS}
+SLIDERS = ('B', 'R', 'Q')
+
+
+def _build_between() -> np.ndarray:
+    """
+    [from_square * 4096 + to_square * 64 + square] -> square lies strictly between the two squares on a line
+    """
+    between = np.zeros((64, 64, 64), dtype=bool)
+    for start in range(64):
+        for end in np.flatnonzero(QUEEN_ATTACKS[start]):
+            row_step = np.sign(_ROWS[end] - _ROWS[start])
+            col_step = np.sign(_COLS[end] - _COLS[start])
+            row, col = _ROWS[start] + row_step, _COLS[start] + col_step
+            while row * 8 + col != end:
+                between[start, end, row * 8 + col] = True
+                row, col = row + row_step, col + col_step
+    return between.reshape(-1)
+
+
+BETWEEN = _build_between()
+
+
+def _targets(attacks: np.ndarray) -> np.ndarray:
+    """
+    [square, i] -> i-th square attacked from the square, -1 after the last one
+    """
+    counts = attacks.sum(axis=1)
+    targets = np.full((64, counts.max()), -1, dtype=np.int64)
+    for square in range(64):
+        squares = np.flatnonzero(attacks[square])
+        targets[square, :len(squares)] = squares
+    return targets
+
+
+TARGETS = {piece: _targets(attacks) for piece, attacks in ATTACKS.items() if piece != 'P'}
+
+
+def _decode(indices: np.ndarray, count: int) -> List[np.ndarray]:
+    squares = []
+    for _ in range(count):
+        squares.append(indices & 63)
+        indices = indices >> 6
+    return squares[::-1]
+
+
+def _encode(squares: List[np.ndarray]) -> np.ndarray:
+    indices = np.zeros_like(squares[0])
+    for square in squares:
+        indices = (indices << 6) | square
+    return indices
+
+
+def _blocked(start: np.ndarray, end: np.ndarray, blockers: List[np.ndarray]) -> np.ndarray:
+    line = start * 4096 + end * 64
+    blocked = np.zeros(len(start), dtype=bool)
+    for blocker in blockers:
+        blocked |= BETWEEN[line + blocker]
+    return blocked
+
+
+class _Builder:
+    """
+    Retrograde analysis of one table. White has the king and the pieces, black has only the king.
+    """
+    def __init__(self, name: str, tables: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        self.name = name
+        self.pieces = ['K'] + list(name[1:name.rindex('K')])  # White pieces, the black king follows them
+        self.count = len(self.pieces) + 1
+        self.size = 64 ** self.count
+        self.tables = tables  # Finished tables used for promotions
+        self.white_wins = np.zeros(self.size, dtype=bool)
+        self.black_loses = np.zeros(self.size, dtype=bool)
+        self.white_legal = np.zeros(self.size, dtype=bool)
+        self.black_legal = np.zeros(self.size, dtype=bool)
+
+    def attacked(self, squares: List[np.ndarray], target: np.ndarray, skip: int = -1) -> np.ndarray:
+        """
+        :param squares: squares of the white pieces
+        :param target: attacked squares - the black king is never a blocker, it is the one being attacked
+        :param skip: index of a white piece which has been captured
+        """
+        attacked = np.zeros(len(target), dtype=bool)
+        for i, (piece, square) in enumerate(zip(self.pieces, squares)):
+            if i == skip:
+                continue
+            attacks = ATTACKS[piece][square, target]
+            if piece in SLIDERS:
+                blockers = [other for j, other in enumerate(squares) if j != i and j != skip]
+                attacks &= ~_blocked(square, target, blockers)
+            attacked |= attacks
+        return attacked
+
+    def find_legal(self) -> None:
+        for start in range(0, self.size, CHUNK):
+            indices = np.arange(start, min(start + CHUNK, self.size), dtype=np.int64)
+            squares = _decode(indices, self.count)
+            legal = ~KING_ATTACKS[squares[0], squares[-1]]
+            for i in range(self.count):
+                for j in range(i + 1, self.count):
+                    legal &= squares[i] != squares[j]
+            for piece, square in zip(self.pieces, squares):
+                if piece == 'P':
+                    legal &= (_ROWS[square] != 0) & (_ROWS[square] != 7)
+            self.black_legal[indices] = legal
+            # With white to move the black king must not be in check
+            self.white_legal[indices] = legal & ~self.attacked(squares[:-1], squares[-1])
+
+    def black_lost(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Black to move loses if every move leads to a position won by white, or if it is checkmated. Capturing a piece
+        always draws - the remaining material cannot win.
+        """
+        squares = _decode(indices, self.count)
+        white, black_king = squares[:-1], squares[-1]
+        in_check = self.attacked(white, black_king)
+        has_move = np.zeros(len(indices), dtype=bool)
+        escapes = np.zeros(len(indices), dtype=bool)
+        all_won = np.ones(len(indices), dtype=bool)
+        for target in TARGETS['K'][black_king].T:
+            on_board = target >= 0
+            target = np.where(on_board, target, 0)
+            allowed = on_board & ~KING_ATTACKS[white[0], target] & (target != white[0])
+            captures = np.zeros(len(indices), dtype=bool)
+            for i in range(1, len(white)):
+                capture = allowed & (target == white[i])
+                captures |= capture
+                escapes |= capture & ~self.attacked(white, target, skip=i)
+            quiet = allowed & ~captures & ~self.attacked(white, target)
+            has_move |= quiet
+            successors = _encode(white + [target])
+            all_won &= ~quiet | self.white_wins[np.where(quiet, successors, 0)]
+        return np.where(has_move | escapes, ~escapes & all_won, in_check)
+
+    def white_predecessors(self, indices: np.ndarray, marks: np.ndarray) -> None:
+        """
+        Marks the positions with white to move from which a white move leads to the given positions.
+        """
+        squares = _decode(indices, self.count)
+        for i, piece in enumerate(self.pieces):
+            square = squares[i]
+            others = [other for j, other in enumerate(squares) if j != i]
+            if piece == 'P':
+                # A pawn move backwards - one square down, or two squares down to its starting row
+                origins = [(square + 8, (_ROWS[square] <= 5), [])]
+                origins.append((square + 16, _ROWS[square] == 4, [square + 8]))
+            else:
+                origins = [(origin, origin >= 0, []) for origin in TARGETS[piece][square].T]
+            for origin, allowed, path in origins:
+                origin = np.where(allowed, origin, 0)
+                for other in others:
+                    allowed = allowed & (origin != other)
+                    for path_square in path:
+                        allowed &= path_square != other
+                if piece in SLIDERS:
+                    allowed &= ~_blocked(origin, square, others)
+                if piece == 'K':
+                    allowed &= ~KING_ATTACKS[origin, squares[-1]]
+                predecessors = _encode(squares[:i] + [origin] + squares[i + 1:])[allowed]
+                marks[predecessors[self.white_legal[predecessors]]] = True
+
+    def black_predecessors(self, indices: np.ndarray, marks: np.ndarray) -> None:
+        """
+        Marks the positions with black to move from which a black king move leads to the given positions.
+        """
+        squares = _decode(indices, self.count)
+        for origin in TARGETS['K'][squares[-1]].T:
+            allowed = origin >= 0
+            predecessors = _encode(squares[:-1] + [np.where(allowed, origin, 0)])[allowed]
+            marks[predecessors[self.black_legal[predecessors]]] = True
+
+    def promotion_wins(self) -> np.ndarray:
+        """
+        Positions with white to move won by promoting the pawn.
+        """
+        pawn = self.pieces.index('P')
+        won = []
+        for start in range(0, self.size, CHUNK):
+            indices = np.arange(start, min(start + CHUNK, self.size), dtype=np.int64)
+            squares = _decode(indices, self.count)
+            candidates = self.white_legal[indices] & (_ROWS[squares[pawn]] == 1)
+            indices = indices[candidates]
+            squares = [square[candidates] for square in squares]
+            target = squares[pawn] - 8
+            allowed = np.ones(len(indices), dtype=bool)
+            for j, other in enumerate(squares):
+                if j != pawn:
+                    allowed &= target != other
+            for piece in PROMOTIONS:
+                pieces = self.pieces[:pawn] + [piece] + self.pieces[pawn + 1:]
+                name = 'K' + ''.join(pieces[1:]) + 'K'
+                if name not in self.tables:
+                    raise ValueError(f'Table {name} has to be built before {self.name}')
+                black_loses = self.tables[name][1]
+                successors = _encode(squares[:pawn] + [target] + squares[pawn + 1:])
+                won.append(indices[allowed & black_loses[np.where(allowed, successors, 0)]])
+        return np.unique(np.concatenate(won)) if won else np.zeros(0, dtype=np.int64)
+
+    def build(self) -> Tuple[np.ndarray, np.ndarray]:
+        self.find_legal()
+
+        # Checkmates - with no white wins known yet, only positions without moves can be lost
+        lost = []
+        for start in range(0, self.size, CHUNK):
+            indices = np.flatnonzero(self.black_legal[start:start + CHUNK]) + start
+            lost.append(indices[self.black_lost(indices)])
+        new_lost = np.concatenate(lost)
+        self.black_loses[new_lost] = True
+        new_won = self.promotion_wins() if 'P' in self.pieces else np.zeros(0, dtype=np.int64)
+        self.white_wins[new_won] = True
+
+        while len(new_lost) or len(new_won):
+            marks = np.zeros(self.size, dtype=bool)
+            for start in range(0, len(new_lost), CHUNK):
+                self.white_predecessors(new_lost[start:start + CHUNK], marks)
+            marks &= ~self.white_wins
+            won = np.flatnonzero(marks)
+            self.white_wins[won] = True
+            new_won = np.concatenate((new_won, won))
+
+            # Positions with black to move which can reach a new win are checked again
+            marks[:] = False
+            for start in range(0, len(new_won), CHUNK):
+                self.black_predecessors(new_won[start:start + CHUNK], marks)
+            marks &= ~self.black_loses
+            candidates = np.flatnonzero(marks)
+            lost = [candidates[start:start + CHUNK][self.black_lost(candidates[start:start + CHUNK])]
+                    for start in range(0, len(candidates), CHUNK)]
+            new_lost = np.concatenate(lost) if lost else np.zeros(0, dtype=np.int64)
+            self.black_loses[new_lost] = True
+            new_won = np.zeros(0, dtype=np.int64)
+        return self.white_wins, self.black_loses
+
+
+def build_bitbases(path: str, names: Tuple[str, ...] = TABLES, verbose: bool = False) -> None:
+    """
+    Builds the tables and writes them into one file.
+
+    :param path: output file
+    :param names: tables to build, a KPK table needs KQK and KRK
+    :param verbose: if True, statistics of every table are printed
+    """
+    tables: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+    for name in sorted(names, key=TABLES.index):
+        start = time.perf_counter()
+        builder = _Builder(name, tables)
+        tables[name] = builder.build()
+        if verbose:
+            print(f'{name}: {np.count_nonzero(builder.white_wins)} of {np.count_nonzero(builder.white_legal)} won with '
+                  f'white to move, {np.count_nonzero(builder.black_loses)} of {np.count_nonzero(builder.black_legal)} '
+                  f'lost with black to move ({time.perf_counter() - start:.1f} s)')
+
+    offset = _HEADER.size + _TABLE.size * len(tables)
+    with open(path, 'wb') as bitbase_file:
+        bitbase_file.write(_HEADER.pack(MAGIC, len(tables)))
+        for name, (white_wins, _) in tables.items():
+            bitbase_file.write(_TABLE.pack(name.encode(), offset, len(white_wins)))
+            offset += 2 * len(white_wins) // 8
+        for white_wins, black_loses in tables.values():
+            bitbase_file.write(np.packbits(white_wins).tobytes())
+            bitbase_file.write(np.packbits(black_loses).tobytes())
+
+
+class Bitbases:
+    """
+    Memory-mapped tables written by build_bitbases().
+    """
+    KNOWN_WIN = 1  # Results of probe() from the point of view of the side to move
+    DRAW = 0
+    KNOWN_LOSS = -1
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as bitbase_file:
+            self.data = mmap.mmap(bitbase_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a bitbase file')
+        self.tables: Dict[str, Tuple[int, int]] = {}  # Material, e.g. 'KBNK' -> (offset, number of positions)
+        for i in range(count):
+            name, offset, size = _TABLE.unpack_from(self.data, _HEADER.size + i * _TABLE.size)
+            self.tables[name.rstrip(b'\0').decode()] = (offset, size)
+
+    def close(self) -> None:
+        self.data.close()
+
+    def probe(self, game_state: GameState) -> Union[int, None]:
+        """
+        :return: KNOWN_WIN, DRAW or KNOWN_LOSS for the side to move, None if the material is not in the tables
+        """
+        if np.count_nonzero(game_state.board != '--') > 4:
+            return None
+        strong, weak = [], []
+        for row, pieces in enumerate(game_state.board.tolist()):
+            for col, piece in enumerate(pieces):
+                if piece != '--':
+                    (strong if piece[0] == 'w' else weak).append((piece, row, col))
+        if len(strong) > 1 and len(weak) > 1:  # Both sides have more than the king
+            return None
+        if len(weak) > 1:  # Black is the stronger side - mirror the board, so it becomes white
+            strong, weak = [('w' + piece[1], 7 - row, col) for piece, row, col in weak], \
+                [('b' + piece[1], 7 - row, col) for piece, row, col in strong]
+            strong_to_move = not game_state.white_to_move
+        else:
+            strong_to_move = game_state.white_to_move
+        if len(strong) == 1:  # Two kings
+            return Bitbases.DRAW
+
+        strong.sort(key=lambda piece: 'KQRBNP'.index(piece[0][1]))  # The order of the pieces in the table names
+        name = 'K' + ''.join(piece[0][1] for piece in strong[1:]) + 'K'
+        if name not in self.tables:
+            return None
+        offset, size = self.tables[name]
+        index = 0
+        for _, row, col in strong + weak:
+            index = index * 64 + row * 8 + col
+        if not strong_to_move:
+            offset += size // 8
+        bit = self.data[offset + (index >> 3)] >> (7 - (index & 7)) & 1
+        if strong_to_move:
+            return Bitbases.KNOWN_WIN if bit else Bitbases.DRAW
+        return Bitbases.KNOWN_LOSS if bit else Bitbases.DRAW
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Build endgame bitbases by retrograde analysis.')
+    parser.add_argument('path', help='output file')
+    parser.add_argument('--tables', nargs='+', choices=TABLES, default=list(TABLES))
+    args = parser.parse_args()
+    build_bitbases(args.path, tuple(args.tables), verbose=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,9 @@
+import asyncio
+import copy
+import json
 import random
+import threading
+import time
 import numpy as np
 
 
@@ -79,10 +84,26 @@ class ChessAi:
     )
     PIECE_POSITION_SCORES = {'N': KNIGHT_SCORES, 'B': BISHOP_SCORES, 'Q': QUEEN_SCORES, 'R': ROOK_SCORES,
                              'wP': WHITE_PAWN_SCORES, 'bP': BLACK_PAWN_SCORES}
+    POSITION_TABLE_NAMES = {'N': 'KNIGHT_SCORES', 'B': 'BISHOP_SCORES', 'Q': 'QUEEN_SCORES', 'R': 'ROOK_SCORES',
+                            'wP': 'WHITE_PAWN_SCORES', 'bP': 'BLACK_PAWN_SCORES'}  # Names used in weights files
+    POSITION_SCORE_WEIGHT = 0.1  # Position scores are added to the material in tenths of a pawn
+    # Pawn structure, in pawns per pawn
+    DOUBLED_PAWN_SCORE = -0.2  # Every pawn on a file beyond the first
+    ISOLATED_PAWN_SCORE = -0.15  # No pawn of the same color on the neighbouring files
+    # No enemy pawn in front, [rank of the pawn from its own side - 1]: 1 on the starting rank, 6 before promotion. No
+    # pawn stands on 0 or 7, they stay 0
+    PASSED_PAWN_SCORES = np.array([0, 0.05, 0.1, 0.2, 0.35, 0.6, 1.0, 0])
     CHECKMATE = 1000
     STALEMATE = 0
 
-    next_move = None
+    # Integer coding of squares used by the vectorized evaluator. Names are sorted, so np.searchsorted maps a board of
+    # piece strings straight onto these codes.
+    PIECE_NAMES = np.array(['--', 'bB', 'bK', 'bN', 'bP', 'bQ', 'bR', 'wB', 'wK', 'wN', 'wP', 'wQ', 'wR'])
+    PIECE_CODES = {name: code for code, name in enumerate(PIECE_NAMES.tolist())}
+    SQUARES = np.arange(64)
+    MATERIAL_TABLE = None  # (13,) signed material value of every piece code - built below the class
+    SCORE_TABLE = None  # (13 * 64,) signed material + positional value of every piece code on every square
+
     DEPTH = 3
 
     @staticmethod
@@ -131,11 +152,20 @@ class ChessAi:
     @staticmethod
     def find_best_move_minmax(game_state, valid_moves):
         """
-        Helper method to make first recursive call.
+        Helper method to make first recursive call. Root moves are scored here, so no state is kept between searches.
         """
         random.shuffle(valid_moves)
-        ChessAi.find_move_minmax(game_state, valid_moves, ChessAi.DEPTH, game_state.white_to_move)
-        return ChessAi.next_move
+        best_move = None
+        best_score = -ChessAi.CHECKMATE - 1 if game_state.white_to_move else ChessAi.CHECKMATE + 1
+        for move in valid_moves:
+            game_state.make_move(move)
+            next_moves = game_state.get_valid_moves()
+            score = ChessAi.find_move_minmax(game_state, next_moves, ChessAi.DEPTH - 1, game_state.white_to_move)
+            game_state.undo_move()
+            if (score > best_score) if game_state.white_to_move else (score < best_score):
+                best_score = score
+                best_move = move
+        return best_move
 
     @staticmethod
     def find_move_minmax(game_state, valid_moves, depth, white_to_move):
@@ -150,8 +180,6 @@ class ChessAi:
                 score = ChessAi.find_move_minmax(game_state, next_moves, depth-1, False)
                 if score > max_score:
                     max_score = score
-                    if depth == ChessAi.DEPTH:
-                        ChessAi.next_move = move
                 game_state.undo_move()
             return max_score
 
@@ -163,16 +191,24 @@ class ChessAi:
                 score = ChessAi.find_move_minmax(game_state, next_moves, depth-1, True)
                 if score < min_score:
                     min_score = score
-                    if depth == ChessAi.DEPTH:
-                        ChessAi.next_move = move
                 game_state.undo_move()
             return min_score
 
     @staticmethod
     def find_best_move_negamax(game_state, valid_moves):
         random.shuffle(valid_moves)
-        ChessAi.find_move_negamax(game_state, valid_moves, ChessAi.DEPTH, 1 if game_state.white_to_move else -1)
-        return ChessAi.next_move
+        turn_multiplier = 1 if game_state.white_to_move else -1
+        best_move = None
+        max_score = -ChessAi.CHECKMATE - 1
+        for move in valid_moves:
+            game_state.make_move(move)
+            next_moves = game_state.get_valid_moves()
+            score = -ChessAi.find_move_negamax(game_state, next_moves, ChessAi.DEPTH - 1, -turn_multiplier)
+            game_state.undo_move()
+            if score > max_score:
+                max_score = score
+                best_move = move
+        return best_move
 
     @staticmethod
     def find_move_negamax(game_state, valid_moves, depth, turn_multiplier):
@@ -186,87 +222,787 @@ class ChessAi:
             score = -ChessAi.find_move_negamax(game_state, next_moves, depth-1, -turn_multiplier)
             if score > max_score:
                 max_score = score
-                if depth == ChessAi.DEPTH:
-                    ChessAi.next_move = move
             game_state.undo_move()
 
         return max_score
 
     @staticmethod
     def find_best_move_negamax_alpha_beta(game_state, valid_moves, return_queue):
-        random.shuffle(valid_moves)
-        ChessAi.find_move_negamax_alpha_beta(game_state, valid_moves, ChessAi.DEPTH, -ChessAi.CHECKMATE, ChessAi.CHECKMATE, 1 if game_state.white_to_move else -1)
-        return_queue.put(ChessAi.next_move)
+        """
+        Searches with a fresh SearchEngine and puts the best move on the return queue.
+        """
+        return_queue.put(SearchEngine().search(game_state, valid_moves))
 
     @staticmethod
-    def find_move_negamax_alpha_beta(game_state, valid_moves, depth, alpha, beta, turn_multiplier):
-        if depth == 0:
-            return turn_multiplier * ChessAi.score_board(game_state)
+    def score_board(game_state, pawn_table=None):
+        """
+        A positive score is good for white, a negative score is good for black.
+
+        :param pawn_table: PawnTable caching the pawn structure scores, None - the pawn structure is scored every time
+        """
+        if game_state.check_mate:
+            if game_state.white_to_move:
+                return -ChessAi.CHECKMATE  # Black wins
+            else:
+                return ChessAi.CHECKMATE  # White wins
+        elif game_state.stale_mate:
+            return ChessAi.STALEMATE
+
+        codes = ChessAi.encode_board(game_state.board)
+        if pawn_table is None:
+            return ChessAi.score_codes(codes) + ChessAi.score_pawn_structure(codes)
+        return ChessAi.score_codes(codes) + pawn_table.score(game_state.pawn_key, codes)
+
+    @staticmethod
+    def score_material(board):
+        """
+        Score the board based on material.
+        """
+        return ChessAi.score_codes(ChessAi.encode_board(board), material_only=True)
+
+    @staticmethod
+    def build_score_tables():
+        """
+        Flattens PIECE_SCORES and PIECE_POSITION_SCORES into lookup tables indexed by piece code (and square), with
+        black pieces negated. Has to be called again whenever the scores are changed.
+        """
+        material_table = np.zeros(len(ChessAi.PIECE_NAMES))
+        score_table = np.zeros((len(ChessAi.PIECE_NAMES), 8, 8))
+        for code, name in enumerate(ChessAi.PIECE_NAMES.tolist()):
+            if name == '--':
+                continue
+            sign = 1 if name[0] == 'w' else -1
+            material_table[code] = sign * ChessAi.PIECE_SCORES[name[1]]
+            score_table[code] = material_table[code]
+            if name[1] != 'K':  # No position table for a king
+                position_scores = ChessAi.PIECE_POSITION_SCORES[name if name[1] == 'P' else name[1]]
+                score_table[code] += sign * position_scores * ChessAi.POSITION_SCORE_WEIGHT
+        ChessAi.MATERIAL_TABLE = material_table
+        ChessAi.SCORE_TABLE = score_table.ravel()
+
+    @staticmethod
+    def load_weights(path):
+        """
+        Replaces the scores with the ones from a weights file written by tuner.py - a JSON object with PIECE_SCORES,
+        the position tables and the pawn structure scores under their attribute names (KNIGHT_SCORES, ...,
+        DOUBLED_PAWN_SCORE, ...). Missing entries keep their values.
+        """
+        with open(path, encoding='utf-8') as weights_file:
+            weights = json.load(weights_file)
+        ChessAi.PIECE_SCORES = {**ChessAi.PIECE_SCORES, **weights.get('PIECE_SCORES', {})}
+        ChessAi.DOUBLED_PAWN_SCORE = weights.get('DOUBLED_PAWN_SCORE', ChessAi.DOUBLED_PAWN_SCORE)
+        ChessAi.ISOLATED_PAWN_SCORE = weights.get('ISOLATED_PAWN_SCORE', ChessAi.ISOLATED_PAWN_SCORE)
+        if 'PASSED_PAWN_SCORES' in weights:
+            ChessAi.PASSED_PAWN_SCORES = np.array(weights['PASSED_PAWN_SCORES'], dtype=float)
+        for key, name in ChessAi.POSITION_TABLE_NAMES.items():
+            if name in weights:
+                table = np.array(weights[name], dtype=float).reshape(8, 8)
+                setattr(ChessAi, name, table)
+                ChessAi.PIECE_POSITION_SCORES[key] = table
+        ChessAi.build_score_tables()
+
+    @staticmethod
+    def encode_board(board):
+        """
+        Converts a board (or a stack of boards) of piece strings into an array of the same shape holding piece codes.
+        """
+        return np.searchsorted(ChessAi.PIECE_NAMES, board).astype(np.int8)
+
+    @staticmethod
+    def score_codes(codes, material_only=False):
+        """
+        Scores integer coded boards. A single board of shape (8, 8) gives a float, a stack of shape (n, 8, 8) gives
+        an array of n scores. A positive score is good for white, a negative score is good for black.
+        """
+        codes = np.asarray(codes)
+        flat_codes = codes.reshape(-1, 64).astype(np.intp)
+        if material_only:
+            scores = np.take(ChessAi.MATERIAL_TABLE, flat_codes).sum(axis=1)
+        else:
+            scores = np.take(ChessAi.SCORE_TABLE, flat_codes * 64 + ChessAi.SQUARES).sum(axis=1)
+        return scores[0] if codes.ndim == 2 else scores
+
+    @staticmethod
+    def score_pawn_structure(codes):
+        """
+        Scores doubled, isolated and passed pawns of integer coded boards. Depends on the pawns only, so the search
+        caches it in a PawnTable. A single board gives a float, a stack of boards gives an array.
+        """
+        codes = np.asarray(codes)
+        doubled, isolated, passed = ChessAi.count_pawn_structure(codes)
+        scores = ChessAi.DOUBLED_PAWN_SCORE * doubled + ChessAi.ISOLATED_PAWN_SCORE * isolated + \
+            passed @ ChessAi.PASSED_PAWN_SCORES
+        return scores[0] if codes.ndim == 2 else scores
+
+    @staticmethod
+    def count_pawn_structure(codes):
+        """
+        Counts the pawn structure terms of integer coded boards, white pawns minus black pawns - the pawn structure
+        score is linear in them.
+
+        :return: (doubled pawns, isolated pawns, passed pawns indexed like PASSED_PAWN_SCORES) - arrays of shapes (n,),
+                 (n,), (n, 8)
+        """
+        boards = np.asarray(codes).reshape(-1, 8, 8)
+        white = boards == ChessAi.PIECE_CODES['wP']
+        black = boards == ChessAi.PIECE_CODES['bP']
+        rows = np.arange(8).reshape(1, 8, 1)
+        # Rearmost pawn of every file from the other side's point of view, 8 (-1) on files without pawns
+        black_rearmost = np.where(black, rows, 8).min(axis=1)
+        white_rearmost = np.where(white, rows, -1).max(axis=1)
+        black_front = black_rearmost.copy()  # Over the file and its neighbours - a pawn behind these rows is passed
+        black_front[:, 1:] = np.minimum(black_front[:, 1:], black_rearmost[:, :-1])
+        black_front[:, :-1] = np.minimum(black_front[:, :-1], black_rearmost[:, 1:])
+        white_front = white_rearmost.copy()
+        white_front[:, 1:] = np.maximum(white_front[:, 1:], white_rearmost[:, :-1])
+        white_front[:, :-1] = np.maximum(white_front[:, :-1], white_rearmost[:, 1:])
+
+        doubled = np.zeros(len(boards), dtype=int)
+        isolated = np.zeros(len(boards), dtype=int)
+        for pawns, sign in ((white, 1), (black, -1)):
+            files = pawns.sum(axis=1)
+            occupied = files > 0
+            neighbours = np.zeros_like(occupied)
+            neighbours[:, 1:] |= occupied[:, :-1]
+            neighbours[:, :-1] |= occupied[:, 1:]
+            doubled += sign * np.maximum(files - 1, 0).sum(axis=1)
+            isolated += sign * (files * ~neighbours).sum(axis=1)
+        white_passed = (white & (rows <= black_front[:, np.newaxis, :])).sum(axis=2)  # By row
+        black_passed = (black & (rows >= white_front[:, np.newaxis, :])).sum(axis=2)
+        return doubled, isolated, white_passed[:, ::-1] - black_passed  # White pawns advance towards row 0
+
+    @staticmethod
+    def encode_position(position):
+        """
+        Integer codes of a game state, a board of piece strings or an already integer coded board.
+        """
+        board = np.asarray(position.board if hasattr(position, 'board') else position)
+        return board if np.issubdtype(board.dtype, np.integer) else ChessAi.encode_board(board)
+
+    @staticmethod
+    def score_many(positions, material_only=False):
+        """
+        Scores many positions in one call. Positions may be game states, boards of piece strings or integer coded
+        boards (also given as one stacked array). Game states that are over are scored as checkmate or stalemate.
+
+        :return: array of scores, positive is good for white
+        """
+        if isinstance(positions, np.ndarray):
+            boards = positions
+            game_states = []
+        else:
+            positions = list(positions)
+            if len(positions) == 0:
+                return np.zeros(0)
+            game_states = [position for position in positions if hasattr(position, 'board')]
+            # Encoded one by one - stacking piece strings with integer codes would turn the codes into strings
+            boards = np.stack([ChessAi.encode_position(position) for position in positions])
+
+        codes = boards if np.issubdtype(boards.dtype, np.integer) else ChessAi.encode_board(boards)
+        scores = np.atleast_1d(ChessAi.score_codes(codes, material_only)).astype(float)
+        if not material_only:
+            scores += ChessAi.score_pawn_structure(codes)
+
+        if game_states:
+            for i, position in enumerate(positions):
+                if getattr(position, 'check_mate', False):
+                    scores[i] = -ChessAi.CHECKMATE if position.white_to_move else ChessAi.CHECKMATE
+                elif getattr(position, 'stale_mate', False):
+                    scores[i] = ChessAi.STALEMATE
+        return scores
+
+
+ChessAi.build_score_tables()
+
+
+class SearchAborted(Exception):
+    """
+    Raised inside of the search to unwind it when a limit is reached or a stop was requested.
+    """
+    pass
+
+
+MAX_DEPTH = 64  # Depth of searches limited only by time or nodes
+
+
+class SearchLimits:
+    def __init__(self, depth=ChessAi.DEPTH, nodes=None, move_time=None):
+        self.depth = depth  # Maximum depth of iterative deepening
+        self.nodes = nodes  # Maximum number of nodes, None - no limit
+        self.move_time = move_time  # Maximum search time in seconds, None - no limit
+
+
+class PawnTable:
+    """
+    Fixed size cache of pawn structure scores keyed by GameState.pawn_key. Every key has one slot (key modulo the
+    capacity) and a new entry replaces the old one. Pawns move rarely in the search, so most lookups hit.
+    """
+    def __init__(self, capacity=16384):
+        self.capacity = capacity
+        self.keys = [None] * capacity
+        self.scores = [0.0] * capacity
+        self.hits = 0  # Lookups since the table was created
+        self.misses = 0
 
-        # TODO: Move ordering - implement later
+    def clear(self):
+        self.keys = [None] * self.capacity
 
+    def score(self, pawn_key, codes):
+        """
+        :param pawn_key: pawn key of the position
+        :param codes: integer coded board of the position, scored on a miss
+        :return: ChessAi.score_pawn_structure of the position
+        """
+        index = pawn_key % self.capacity
+        if self.keys[index] == pawn_key:
+            self.hits += 1
+            return self.scores[index]
+        self.misses += 1
+        score = ChessAi.score_pawn_structure(codes)
+        self.keys[index] = pawn_key
+        self.scores[index] = score
+        return score
+
+
+class SearchStats:
+    """
+    Counters of the search, reported per iteration of iterative deepening as dictionaries (records), optionally written
+    to a stream as JSON lines. Counting costs a few attribute updates per node - an engine without stats skips them.
+    """
+    CUTOFF_SLOTS = 8  # Beta cutoffs are counted by the index of the move which caused them, the last slot counts the rest
+
+    def __init__(self, output=None):
+        self.output = output  # Text stream receiving every record as a JSON line, None - records are only kept
+        self.records = []  # Records of the iterations of the last search
+
+        # Counters of the running iteration
+        self.leaf_nodes = 0  # Nodes evaluated statically at the horizon
+        self.tt_probes = 0
+        self.tt_hits = 0
+        self.tt_cutoffs = 0  # Nodes answered by the transposition table without searching
+        self.beta_cutoffs = [0] * SearchStats.CUTOFF_SLOTS
+        self.iteration_start_nodes = 0
+        self.iteration_start_time = 0.0
+        self.search_start_time = 0.0
+        self.pawn_table = None  # PawnTable of the engine, its counters are reported per iteration
+        self.iteration_start_pawn_hits = 0
+        self.iteration_start_pawn_misses = 0
+
+    def start_search(self, pawn_table=None):
+        self.records = []
+        self.search_start_time = time.perf_counter()
+        self.pawn_table = pawn_table
+
+    def start_iteration(self, nodes):
+        """
+        :param nodes: node count of the engine when the iteration starts
+        """
+        self.leaf_nodes = 0
+        self.tt_probes = 0
+        self.tt_hits = 0
+        self.tt_cutoffs = 0
+        self.beta_cutoffs = [0] * SearchStats.CUTOFF_SLOTS
+        self.iteration_start_nodes = nodes
+        self.iteration_start_time = time.perf_counter()
+        if self.pawn_table is not None:
+            self.iteration_start_pawn_hits = self.pawn_table.hits
+            self.iteration_start_pawn_misses = self.pawn_table.misses
+
+    def end_iteration(self, depth, nodes, score, completed=True):
+        """
+        Creates the record of the iteration. The effective branching factor is the ratio of nodes searched by this and
+        by the previous iteration.
+
+        :param completed: False if the iteration was aborted by a limit or a stop request
+        :return: the record
+        """
+        now = time.perf_counter()
+        elapsed = now - self.iteration_start_time
+        iteration_nodes = nodes - self.iteration_start_nodes
+        cutoffs = sum(self.beta_cutoffs)
+        previous_nodes = self.records[-1]['nodes'] if self.records else 0
+        pawn_hits = self.pawn_table.hits - self.iteration_start_pawn_hits if self.pawn_table is not None else 0
+        pawn_misses = self.pawn_table.misses - self.iteration_start_pawn_misses if self.pawn_table is not None else 0
+        record = {
+            'depth': depth,
+            'completed': completed,
+            'score': score,
+            'nodes': iteration_nodes,
+            'leaf_nodes': self.leaf_nodes,
+            'tt_probes': self.tt_probes,
+            'tt_hits': self.tt_hits,
+            'tt_hit_rate': self.tt_hits / self.tt_probes if self.tt_probes else 0.0,
+            'tt_cutoffs': self.tt_cutoffs,
+            'pawn_hits': pawn_hits,
+            'pawn_misses': pawn_misses,
+            'pawn_hit_rate': pawn_hits / (pawn_hits + pawn_misses) if pawn_hits + pawn_misses else 0.0,
+            'beta_cutoffs': list(self.beta_cutoffs),
+            'first_move_cutoff_rate': self.beta_cutoffs[0] / cutoffs if cutoffs else 0.0,
+            'ebf': iteration_nodes / previous_nodes if previous_nodes and completed else None,
+            'time': elapsed,
+            'total_time': now - self.search_start_time,
+            'nps': int(iteration_nodes / elapsed) if elapsed > 0 else 0,
+        }
+        self.records.append(record)
+        if self.output is not None:
+            self.output.write(json.dumps(record) + '\n')
+            self.output.flush()
+        return record
+
+
+class SearchEngine:
+    """
+    Iterative deepening negamax with alpha-beta pruning, transposition table and history heuristic. All of the search
+    state lives on the instance, so every game can have its own engine and engines can search concurrently in threads
+    (or asyncio executors) of one process. One engine runs one search at a time.
+    """
+    EXACT = 0
+    LOWER_BOUND = 1
+    UPPER_BOUND = 2
+    CHECK_INTERVAL = 64  # Nodes between checks of limits and stop requests
+    MATE_THRESHOLD = ChessAi.CHECKMATE - 100  # Scores above are mates in a number of plies
+    KNOWN_WIN = ChessAi.CHECKMATE / 2  # Score of positions won according to the bitbases, below all mate scores
+
+    def __init__(self, limits=None, tt_size=1_000_000, seed=None, info_callback=None, stop_event=None, book=None,
+                 bitbases=None, stats=None, network=None, multi_pv=1, pawn_table_size=16384):
+        self.limits = limits if limits is not None else SearchLimits()
+        self.book = book  # Opening book (book.OpeningBook) - positions found in it are not searched
+        self.bitbases = bitbases  # Endgame tables (bitbases.Bitbases) probed at the leaves
+        self.stats = stats  # SearchStats collecting counters of every iteration, None - nothing is counted
+        self.network = network  # Neural evaluator (nnue.Network) used instead of score_board, if set
+        self.multi_pv = multi_pv  # Number of best root moves searched with exact scores
+        self.info_callback = info_callback  # Called with get_info() after every completed iteration
+        self.tt_size = tt_size  # Maximum number of positions kept in the transposition table
+        self.transposition_table = {}  # zobrist key -> (depth, score, flag, move)
+        self.pawn_table = PawnTable(pawn_table_size)  # Pawn structure scores of the evaluation
+        self.history = [0] * 64 * 64  # [from_square * 64 + to_square] -> bonus for quiet moves causing cutoffs
+        self.random = random.Random(seed)
+        # Stop flag polled every CHECK_INTERVAL nodes. May be shared with other processes (multiprocessing.Event) - then
+        # its owner is responsible for clearing it before a new search.
+        self.owns_stop_event = stop_event is None
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.search_lock = threading.Lock()
+
+        # Result of the last search
+        self.best_move = None
+        self.best_score = 0  # From the point of view of the side to move
+        self.principal_variation = []
+        self.lines = []  # (score, principal variation) of the best root moves, best first - multi_pv of them at most
+        self.completed_depth = 0
+        self.nodes = 0
+
+        self.start_time = 0.0
+        self.pv_table = []
+        self.iteration_result = None  # (score, principal variation) of the best root move of the running iteration
+        self.iteration_lines = []  # Lines of the running iteration
+
+        # Pondering - searching the expected reply on the opponent's time, limits apply only after ponderhit()
+        self.pondering = False
+        self.ponder_released = threading.Event()
+        self.ponder_lock = threading.Lock()
+        self.ponderhit_limits = None  # Limits given to ponderhit(), replacing the limits of the ponder search
+        self.search_limits = None  # Limits of the running search
+
+    def new_game(self):
+        """
+        Forgets everything learned in previous searches.
+        """
+        self.transposition_table.clear()
+        self.pawn_table.clear()
+        self.history = [0] * 64 * 64
+
+    def stop(self):
+        """
+        Requests the running search to finish. The search unwinds at its next check and returns the best move found so
+        far.
+        """
+        self.stop_event.set()
+        self.ponder_released.set()
+
+    def begin_ponder(self):
+        """
+        Makes the next search a ponder search. Has to be called before the search is started in a thread of its own,
+        so that a ponderhit() or stop() coming before the thread has started the search is not lost.
+        """
+        self.ponderhit_limits = None
+        self.ponder_released.clear()
+        self.pondering = True
+
+    def ponderhit(self, limits=None):
+        """
+        The opponent played the expected move - the ponder search becomes a normal search. Its limits count from now.
+
+        :param limits: SearchLimits replacing the limits the ponder search was started with, None - they are kept
+        """
+        with self.ponder_lock:
+            if limits is not None:
+                self.ponderhit_limits = limits
+                if self.search_limits is not None:
+                    self.search_limits.depth = limits.depth
+                    self.search_limits.nodes = limits.nodes
+                    self.search_limits.move_time = limits.move_time
+            self.start_time = time.perf_counter()
+            self.pondering = False
+        self.ponder_released.set()
+
+    def search(self, game_state, valid_moves=None, limits=None, ponder=False, multi_pv=None):
+        """
+        Finds the best move for the side to move. The given game state is not modified - search runs on a copy.
+        If the search is stopped or runs out of time or nodes, the best move found so far is returned. The best
+        multi_pv moves with their scores and principal variations are left in lines.
+
+        :param game_state: position to search
+        :param valid_moves: root moves to consider, all valid moves if None
+        :param limits: SearchLimits overriding the engine's limits for this search
+        :param ponder: if True, time and node limits are ignored and the result is not returned until ponderhit() or
+                       stop() is called. begin_ponder() has to be called first - if ponderhit() has been called since,
+                       the search is a normal one
+        :param multi_pv: number of best moves to find, overrides the engine's multi_pv for this search
+        :return: best move or None if there are no valid moves
+        """
+        with self.search_lock:
+            if not ponder:
+                self.pondering = False
+            try:
+                return self.iterative_deepening(game_state, valid_moves, limits,
+                                                multi_pv if multi_pv is not None else self.multi_pv)
+            finally:
+                if self.pondering:  # Finished before the opponent moved - wait for the hit or the stop
+                    self.ponder_released.wait()
+                    self.pondering = False
+                self.search_limits = self.ponderhit_limits = None
+
+    def analyse(self, game_state, count, limits=None):
+        """
+        Finds the best moves of the position in a single search. Root moves after the first count ones are searched
+        with the window of the count-th best score, so most of them are refuted as quickly as in a normal search.
+
+        :return: list of up to count (score, principal variation) pairs, best first
+        """
+        self.search(game_state, limits=limits, multi_pv=count)
+        return self.lines
+
+    def iterative_deepening(self, game_state, valid_moves, limits, multi_pv=1):
+        with self.ponder_lock:  # A copy - ponderhit() may change the limits of the running search
+            if self.ponderhit_limits is not None:
+                limits = self.ponderhit_limits
+            self.search_limits = limits = copy.copy(limits if limits is not None else self.limits)
+        game_state = copy.deepcopy(game_state)
+        if self.network is not None:
+            self.network.new_accumulator(game_state)
+        root_moves = game_state.get_valid_moves(expand_promotions=True)
+        if valid_moves is not None:  # Keep the promotion choices of the root moves
+            allowed = {move.move_id % 10000 for move in valid_moves}
+            root_moves = [move for move in root_moves if move.move_id % 10000 in allowed]
+        self.random.shuffle(root_moves)
+
+        self.best_move = root_moves[0] if root_moves else None
+        self.best_score = 0
+        self.principal_variation = [self.best_move] if root_moves else []
+        self.lines = [(0, [move]) for move in root_moves[:multi_pv]]
+        self.completed_depth = 0
+        self.nodes = 0
+        if self.owns_stop_event:
+            self.stop_event.clear()
+        self.start_time = time.perf_counter()
+        if len(root_moves) <= 1:
+            return self.best_move
+
+        if self.book is not None and multi_pv == 1:  # Book moves come without scores to rank them
+            book_move = self.book.choose_move(game_state, self.random)
+            if book_move is not None and any(move.move_id == book_move.move_id for move in root_moves):
+                self.best_move = book_move
+                self.principal_variation = [book_move]
+                return self.best_move
+
+        turn_multiplier = 1 if game_state.white_to_move else -1
+        stats = self.stats
+        if stats is not None:
+            stats.start_search(self.pawn_table)
+        depth = 0
+        while depth < limits.depth:  # The depth may be changed by ponderhit()
+            depth += 1
+            self.pv_table = [[] for _ in range(depth + 1)]
+            if stats is not None:
+                stats.start_iteration(self.nodes)
+            try:
+                score = self.search_root(game_state, root_moves, depth, turn_multiplier, limits, multi_pv)
+            except SearchAborted:
+                # The previous best move is searched first, so any root move which has already got a score in
+                # this iteration is at least as good as it - and searched deeper
+                if self.iteration_result is not None:
+                    self.best_score, self.principal_variation = self.iteration_result
+                    self.best_move = self.principal_variation[0]
+                    # Previous lines are searched first as well - those not reached yet keep their older results
+                    searched = {line[1][0].move_id for line in self.iteration_lines}
+                    self.lines = (self.iteration_lines + [line for line in self.lines
+                                                          if line[1][0].move_id not in searched])[:multi_pv]
+                if stats is not None:
+                    stats.end_iteration(depth, self.nodes, self.best_score, completed=False)
+                break
+            self.best_score = score
+            self.principal_variation = self.pv_table[0]
+            self.best_move = self.principal_variation[0]
+            self.lines = self.iteration_lines
+            self.completed_depth = depth
+            if stats is not None:
+                stats.end_iteration(depth, self.nodes, score)
+            if self.info_callback is not None:
+                self.info_callback(self.get_info())
+            if abs(score) > SearchEngine.MATE_THRESHOLD:  # Mate found - deeper search will not change it
+                break
+        return self.best_move
+
+    def get_info(self):
+        """
+        Progress of the current (or last) search as a dictionary.
+        """
+        elapsed = time.perf_counter() - self.start_time
+        info = {'depth': self.completed_depth, 'score': self.best_score, 'nodes': self.nodes, 'time': elapsed,
+                'nps': int(self.nodes / elapsed) if elapsed > 0 else 0,
+                'pv': [move.get_chess_notation() for move in self.principal_variation]}
+        if len(self.lines) > 1:
+            info['lines'] = [{'score': score, 'pv': [move.get_chess_notation() for move in principal_variation]}
+                             for score, principal_variation in self.lines]
+        if self.stats is not None and self.stats.records:
+            info['stats'] = self.stats.records[-1]
+        return info
+
+    async def search_async(self, game_state, valid_moves=None, limits=None, executor=None, ponder=False):
+        """
+        Runs the search in an executor, so the event loop is not blocked while the engine thinks.
+        """
+        loop = asyncio.get_running_loop()
+        if ponder:
+            self.begin_ponder()
+        return await loop.run_in_executor(executor, self.search, game_state, valid_moves, limits, ponder)
+
+    def search_move(self, game_state, move, depth, alpha, beta, limits=None):
+        """
+        Searches a single root move with the given window. Used to split the root moves between workers. The game state
+        is searched in place and restored before returning.
+
+        :return: score of the move from the point of view of the side to move at the root
+        """
+        limits = limits if limits is not None else self.limits
+        self.pv_table = [[] for _ in range(depth + 1)]
+        self.nodes = 0
+        if self.owns_stop_event:
+            self.stop_event.clear()
+        self.start_time = time.perf_counter()
+        turn_multiplier = 1 if game_state.white_to_move else -1
+        if self.network is not None and game_state.accumulator is None:
+            self.network.new_accumulator(game_state)
+        game_state.make_move(move)
+        try:
+            score = -self.negamax(game_state, depth - 1, -beta, -alpha, -turn_multiplier, 1, limits)
+        finally:
+            game_state.undo_move()
+        self.principal_variation = [move] + self.pv_table[1]
+        return score
+
+    def search_root(self, game_state, root_moves, depth, turn_multiplier, limits, multi_pv=1):
+        """
+        Searches the root moves, keeping the best multi_pv of them in iteration_lines. Until that many moves have a
+        score the window is open, then alpha is the worst kept score - moves which cannot get into the lines fail low.
+
+        :return: score of the best move
+        """
+        alpha = -ChessAi.CHECKMATE - 1
+        beta = ChessAi.CHECKMATE + 1
+        self.iteration_result = None
+        self.iteration_lines = lines = []
+        self.order_moves(root_moves, self.best_move)
+        if multi_pv > 1:  # Moves of the previous lines first, in their order - they set the window soonest
+            ranks = {line[1][0].move_id: rank for rank, line in enumerate(self.lines)}
+            root_moves.sort(key=lambda root_move: ranks.get(root_move.move_id, multi_pv))
+        for move in root_moves:
+            game_state.make_move(move)
+            try:
+                score = -self.negamax(game_state, depth - 1, -beta, -alpha, -turn_multiplier, 1, limits)
+            finally:
+                game_state.undo_move()
+            if score > alpha:
+                index = len(lines)
+                while index > 0 and lines[index - 1][0] < score:
+                    index -= 1
+                lines.insert(index, (score, [move] + self.pv_table[1]))
+                del lines[multi_pv:]
+                if len(lines) == multi_pv:
+                    alpha = lines[-1][0]
+                self.iteration_result = lines[0]
+                self.pv_table[0] = lines[0][1]
+        return lines[0][0]
+
+    def negamax(self, game_state, depth, alpha, beta, turn_multiplier, ply, limits):
+        self.nodes += 1
+        if self.nodes % SearchEngine.CHECK_INTERVAL == 0:
+            self.check_limits(limits)
+        self.pv_table[ply] = []
+        stats = self.stats
+
+        alpha_original = alpha
+        tt_move = None
+        entry = self.transposition_table.get(game_state.zobrist_key)
+        if stats is not None:
+            stats.tt_probes += 1
+        if entry is not None:
+            if stats is not None:
+                stats.tt_hits += 1
+            tt_depth, tt_score, tt_flag, tt_move = entry
+            if tt_depth >= depth:
+                tt_score = SearchEngine.score_from_tt(tt_score, ply)
+                if tt_flag == SearchEngine.EXACT:
+                    alpha = beta = tt_score
+                elif tt_flag == SearchEngine.LOWER_BOUND:
+                    alpha = max(alpha, tt_score)
+                else:
+                    beta = min(beta, tt_score)
+                if alpha >= beta:
+                    if stats is not None:
+                        stats.tt_cutoffs += 1
+                    if tt_flag == SearchEngine.EXACT:  # The score may get into the principal variation
+                        self.pv_table[ply] = self.tt_principal_variation(game_state, depth)
+                    return tt_score
+
+        valid_moves = game_state.get_valid_moves(expand_promotions=True)
+        if game_state.check_mate:
+            return -ChessAi.CHECKMATE + ply  # Prefer shorter mates
+        if game_state.stale_mate:
+            return ChessAi.STALEMATE
+        if depth == 0:
+            if stats is not None:
+                stats.leaf_nodes += 1
+            if self.bitbases is not None:
+                result = self.bitbases.probe(game_state)
+                if result is not None:
+                    return SearchEngine.score_bitbase_result(game_state, result)
+            if self.network is not None:
+                return self.network.evaluate(game_state.accumulator, game_state.white_to_move)
+            return turn_multiplier * ChessAi.score_board(game_state, self.pawn_table)
+
+        self.order_moves(valid_moves, tt_move)
         max_score = -ChessAi.CHECKMATE
-        for move in valid_moves:
+        best_move = None
+        for index, move in enumerate(valid_moves):
             game_state.make_move(move)
-            next_moves = game_state.get_valid_moves()
-            score = -ChessAi.find_move_negamax_alpha_beta(game_state, next_moves, depth-1, -beta, -alpha, -turn_multiplier)
+            try:
+                score = -self.negamax(game_state, depth - 1, -beta, -alpha, -turn_multiplier, ply + 1, limits)
+            finally:  # Unwinds cleanly when the search is aborted
+                game_state.undo_move()
             if score > max_score:
                 max_score = score
-                if depth == ChessAi.DEPTH:
-                    ChessAi.next_move = move
-            game_state.undo_move()
-
+                best_move = move
             if max_score > alpha:  # Pruning
                 alpha = max_score
+                self.pv_table[ply] = [move] + self.pv_table[ply + 1]
             if alpha >= beta:
+                if stats is not None:
+                    stats.beta_cutoffs[min(index, SearchStats.CUTOFF_SLOTS - 1)] += 1
+                if not move.is_capture_move:
+                    self.history[(move.start_row * 8 + move.start_col) * 64 + move.end_row * 8 + move.end_col] += \
+                        depth * depth
                 break
 
+        if max_score <= alpha_original:
+            flag = SearchEngine.UPPER_BOUND
+        elif max_score >= beta:
+            flag = SearchEngine.LOWER_BOUND
+        else:
+            flag = SearchEngine.EXACT
+        if len(self.transposition_table) >= self.tt_size:
+            self.transposition_table.clear()
+        self.transposition_table[game_state.zobrist_key] = (depth, SearchEngine.score_to_tt(max_score, ply), flag,
+                                                            best_move)
         return max_score
 
-    @staticmethod
-    def score_board(game_state):
+    def tt_principal_variation(self, game_state, length):
         """
-        A positive score is good for white, a negative score is good for black.
+        Principal variation of a position cut off by its transposition table score - the best moves stored along the
+        line, up to length of them. The game state is restored before returning.
         """
-        if game_state.check_mate:
-            if game_state.white_to_move:
-                return -ChessAi.CHECKMATE  # Black wins
-            else:
-                return ChessAi.CHECKMATE  # White wins
-        elif game_state.stale_mate:
-            return ChessAi.STALEMATE
+        principal_variation = []
+        try:
+            while len(principal_variation) < length:
+                entry = self.transposition_table.get(game_state.zobrist_key)
+                if entry is None or entry[3] is None:
+                    break
+                move_id = entry[3].move_id
+                move = next((move for move in game_state.get_valid_moves(expand_promotions=True)
+                             if move.move_id == move_id), None)
+                if move is None:  # Key collision
+                    break
+                principal_variation.append(move)
+                game_state.make_move(move)
+        finally:
+            for _ in principal_variation:
+                game_state.undo_move()
+        return principal_variation
 
-        score = 0
-        for row in range(len(game_state.board)):
-            for col in range(len(game_state.board[row])):
-                square = game_state.board[row][col]
-                if square != '--':
-                    # Score it positionally
-                    piece_position_score = 0
-                    if square[1] != 'K':  # No position table for a king
-                        if square[1] == 'P':  # For pawns
-                            piece_position_score = ChessAi.PIECE_POSITION_SCORES[square][row][col]
-                        else:  # For other pieces
-                            piece_position_score = ChessAi.PIECE_POSITION_SCORES[square[1]][row][col]
-
-                    if square[0] == 'w':
-                        score += ChessAi.PIECE_SCORES[square[1]] + piece_position_score * 0.1
-                    elif square[0] == 'b':
-                        score -= ChessAi.PIECE_SCORES[square[1]] + piece_position_score * 0.1
+    def order_moves(self, moves, best_move):
+        """
+        Sorts moves in place: best move of a previous search first, then captures (most valuable victim, least valuable
+        attacker), then quiet moves by their history score.
+        """
+        best_move_id = best_move.move_id if best_move is not None else None
+        history = self.history
 
-        return score
+        def move_order(move):
+            if move.move_id == best_move_id:
+                return 1_000_000_000
+            if move.is_capture_move:
+                return 100_000_000 + 10 * ChessAi.PIECE_SCORES[move.piece_captured[1]] - \
+                    ChessAi.PIECE_SCORES[move.piece_moved[1]]
+            return history[(move.start_row * 8 + move.start_col) * 64 + move.end_row * 8 + move.end_col]
+
+        moves.sort(key=move_order, reverse=True)
 
     @staticmethod
-    def score_material(board):
+    def score_bitbase_result(game_state, result):
         """
-        Score the board based on material.
+        Score of a position from the bitbases for the side to move. The tables tell only who wins, so won positions are
+        scored higher the closer they are to the end - with the pawn further advanced, or with the losing king closer
+        to the edge and the kings closer to each other. The search then makes progress instead of shuffling.
+        """
+        if result == 0:
+            return ChessAi.STALEMATE
+        pawns = np.argwhere((game_state.board == 'wP') | (game_state.board == 'bP'))
+        if len(pawns):  # Scored below all of the positions after the promotion
+            row, col = pawns[0]
+            return result * (SearchEngine.KNOWN_WIN - 10 + (6 - row if game_state.board[row][col] == 'wP' else row - 1))
+        if (result > 0) == game_state.white_to_move:
+            winning_king, losing_king = game_state.white_king_location, game_state.black_king_location
+        else:
+            winning_king, losing_king = game_state.black_king_location, game_state.white_king_location
+        center_distance = max(3 - losing_king[0], losing_king[0] - 4) + max(3 - losing_king[1], losing_king[1] - 4)
+        kings_distance = abs(winning_king[0] - losing_king[0]) + abs(winning_king[1] - losing_king[1])
+        return result * (SearchEngine.KNOWN_WIN + 0.5 * center_distance - 0.2 * kings_distance)
+
+    def check_limits(self, limits):
+        if self.stop_event.is_set():
+            raise SearchAborted()
+        if self.pondering:
+            return
+        if limits.nodes is not None and self.nodes >= limits.nodes:
+            raise SearchAborted()
+        if limits.move_time is not None and time.perf_counter() - self.start_time >= limits.move_time:
+            raise SearchAborted()
+
+    @staticmethod
+    def score_to_tt(score, ply):
+        """
+        Mate scores are stored relative to the node, not to the root.
         """
-        score = 0
-        for row in board:
-            for square in row:
-                if square[0] == 'w':
-                    score += ChessAi.PIECE_SCORES[square[1]]
-                elif square[0] == 'b':
-                    score -= ChessAi.PIECE_SCORES[square[1]]
+        if score > SearchEngine.MATE_THRESHOLD:
+            return score + ply
+        if score < -SearchEngine.MATE_THRESHOLD:
+            return score - ply
+        return score
 
+    @staticmethod
+    def score_from_tt(score, ply):
+        if score > SearchEngine.MATE_THRESHOLD:
+            return score - ply
+        if score < -SearchEngine.MATE_THRESHOLD:
+            return score + ply
         return score
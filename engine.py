@@ -3,10 +3,22 @@ Stores information about the current state of a chess game. Responsible for dete
 """
 import numpy as np
 import copy
+import random
+
+# Zobrist keys - random 64 bit numbers xor-ed together to get a (almost) unique key of a position. Fixed seed, so keys
+# are the same in every process.
+_zobrist_random = random.Random(2021)
+ZOBRIST_PIECES = {piece: [[_zobrist_random.getrandbits(64) for _ in range(8)] for _ in range(8)]
+                  for piece in ('wP', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bP', 'bN', 'bB', 'bR', 'bQ', 'bK')}
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(4)]  # wks, bks, wqs, bqs
+ZOBRIST_ENPASSANT = [_zobrist_random.getrandbits(64) for _ in range(8)]  # Per file of en passant square
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
 
 
 class GameState:
-    def __init__(self):
+    def __init__(self, fen=None):
         self.board = np.array(  # 2D array [y, x]
             [
                 ['bR', 'bN', 'bB', 'bQ', 'bK', 'bB', 'bN', 'bR'],
@@ -44,6 +56,172 @@ class GameState:
         self.castle_rights_log = [CastleRights(self.current_castle_rights.wks, self.current_castle_rights.bks,
                                                self.current_castle_rights.wqs, self.current_castle_rights.bqs)]
 
+        # Position key - updated incrementally on every move
+        self.zobrist_key = self.compute_zobrist_key()
+        self.zobrist_key_log = []
+        # Key of the pawns only - keys the pawn structure cache of the evaluation
+        self.pawn_key = self.compute_pawn_key()
+        self.pawn_key_log = []
+
+        # First layer of the neural evaluator (nnue.Accumulator) - updated on every move once attached
+        self.accumulator = None
+
+        self.start_fen = START_FEN
+        self.start_fullmove_number = 1
+        if fen is not None:
+            self.load_fen(fen)
+
+    def load_fen(self, fen):
+        """
+        Sets up the position described by a FEN string. The move log is cleared.
+        """
+        fields = fen.split()
+        placement, side = fields[0], fields[1]
+        castling = fields[2] if len(fields) > 2 else '-'
+        enpassant = fields[3] if len(fields) > 3 else '-'
+
+        board = []
+        for rank in placement.split('/'):
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row += ['--'] * int(char)
+                else:
+                    row.append(('w' if char.isupper() else 'b') + char.upper())
+            board.append(row)
+        if len(board) != 8 or any(len(row) != 8 for row in board):
+            raise ValueError(f'Invalid FEN board: {placement}')
+        if sum(row.count('wK') for row in board) != 1 or sum(row.count('bK') for row in board) != 1:
+            raise ValueError(f'Invalid FEN board, every side needs one king: {placement}')
+        self.board = np.array(board)
+
+        self.white_to_move = side == 'w'
+        self.move_log = []
+        self.white_king_location = self.get_king_location('w')
+        self.black_king_location = self.get_king_location('b')
+        self.in_check = False
+        self.pins = []
+        self.checks = []
+        self.check_mate = False
+        self.stale_mate = False
+
+        self.enpassant_possible = () if enpassant == '-' else (Move.ranks_to_rows[enpassant[1]],
+                                                               Move.files_to_cols[enpassant[0]])
+        self.enpassant_possible_log = [self.enpassant_possible]
+        self.current_castle_rights = CastleRights('K' in castling, 'k' in castling, 'Q' in castling, 'q' in castling)
+        self.castle_rights_log = [CastleRights(self.current_castle_rights.wks, self.current_castle_rights.bks,
+                                               self.current_castle_rights.wqs, self.current_castle_rights.bqs)]
+
+        self.zobrist_key = self.compute_zobrist_key()
+        self.zobrist_key_log = []
+        self.pawn_key = self.compute_pawn_key()
+        self.pawn_key_log = []
+        self.start_fen = fen
+        self.start_fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+
+    def get_fen(self):
+        """
+        FEN string of the current position. The halfmove clock is not tracked and always written as 0.
+        """
+        ranks = []
+        for row in self.board:
+            rank = ''
+            empty = 0
+            for square in row:
+                if square == '--':
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += square[1] if square[0] == 'w' else square[1].lower()
+            ranks.append(rank + (str(empty) if empty else ''))
+
+        rights = self.current_castle_rights
+        castling = ('K' if rights.wks else '') + ('Q' if rights.wqs else '') + ('k' if rights.bks else '') + \
+                   ('q' if rights.bqs else '')
+        enpassant = '-' if self.enpassant_possible == () else \
+            Move.cols_to_files[self.enpassant_possible[1]] + Move.rows_to_ranks[self.enpassant_possible[0]]
+        black_started = self.start_fen.split()[1] == 'b'
+        fullmove_number = self.start_fullmove_number + (len(self.move_log) + black_started) // 2
+        return f'{"/".join(ranks)} {"w" if self.white_to_move else "b"} {castling or "-"} {enpassant} 0 ' \
+               f'{fullmove_number}'
+
+    def get_move_from_notation(self, notation):
+        """
+        Finds the valid move written in long algebraic notation (e.g. 'e2e4', 'e7e8q').
+
+        :return: move or None if there is no such valid move
+        """
+        for move in self.get_valid_moves(expand_promotions=True):
+            if move.get_chess_notation() == notation:
+                return move
+        return None
+
+    def compute_zobrist_key(self):
+        """
+        Computes the zobrist key of the current position from scratch.
+        """
+        key = 0
+        for row in range(len(self.board)):
+            for col in range(len(self.board[row])):
+                piece = self.board[row][col]
+                if piece != '--':
+                    key ^= ZOBRIST_PIECES[piece][row][col]
+        if not self.white_to_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        key ^= self.current_castle_rights.zobrist_key()
+        if self.enpassant_possible != ():
+            key ^= ZOBRIST_ENPASSANT[self.enpassant_possible[1]]
+        return key
+
+    def compute_pawn_key(self):
+        """
+        Computes the pawn key of the current position from scratch - zobrist keys of the pawns xor-ed together.
+        """
+        key = 0
+        for row in range(len(self.board)):
+            for col in range(len(self.board[row])):
+                piece = self.board[row][col]
+                if piece[1] == 'P':
+                    key ^= ZOBRIST_PIECES[piece][row][col]
+        return key
+
+    def update_zobrist_key(self, move, previous_enpassant, previous_castle_rights):
+        """
+        Updates the zobrist key and the pawn key after the move has been made on the board.
+        """
+        key = self.zobrist_key ^ ZOBRIST_BLACK_TO_MOVE
+        key ^= ZOBRIST_PIECES[move.piece_moved][move.start_row][move.start_col]
+        key ^= ZOBRIST_PIECES[self.board[move.end_row][move.end_col]][move.end_row][move.end_col]  # Promoted piece
+        if move.enpassant:
+            key ^= ZOBRIST_PIECES[move.piece_captured][move.start_row][move.end_col]
+        elif move.piece_captured != '--':
+            key ^= ZOBRIST_PIECES[move.piece_captured][move.end_row][move.end_col]
+        if move.is_castle_move:
+            rook = move.piece_moved[0] + 'R'
+            if move.end_col - move.start_col == 2:  # King side castle
+                key ^= ZOBRIST_PIECES[rook][move.end_row][move.end_col+1] ^ ZOBRIST_PIECES[rook][move.end_row][move.end_col-1]
+            else:  # Queen side castle
+                key ^= ZOBRIST_PIECES[rook][move.end_row][move.end_col-2] ^ ZOBRIST_PIECES[rook][move.end_row][move.end_col+1]
+        if previous_enpassant != ():
+            key ^= ZOBRIST_ENPASSANT[previous_enpassant[1]]
+        if self.enpassant_possible != ():
+            key ^= ZOBRIST_ENPASSANT[self.enpassant_possible[1]]
+        key ^= previous_castle_rights.zobrist_key() ^ self.current_castle_rights.zobrist_key()
+        self.zobrist_key = key
+
+        if move.piece_moved[1] == 'P' or move.piece_captured[1] == 'P':  # Most moves leave the pawns alone
+            pawn_key = self.pawn_key
+            if move.piece_moved[1] == 'P':
+                pawn_key ^= ZOBRIST_PIECES[move.piece_moved][move.start_row][move.start_col]
+                if not move.pawn_promotion:
+                    pawn_key ^= ZOBRIST_PIECES[move.piece_moved][move.end_row][move.end_col]
+            if move.piece_captured[1] == 'P':
+                captured_row = move.start_row if move.enpassant else move.end_row
+                pawn_key ^= ZOBRIST_PIECES[move.piece_captured][captured_row][move.end_col]
+            self.pawn_key = pawn_key
+
     def get_king_location(self, color):
         if color == 'b' or color == 'w':
             for i, row in enumerate(self.board):
@@ -53,6 +231,10 @@ class GameState:
 
     def make_move(self, move):
         if self.board[move.start_row][move.start_col] != '--':
+            previous_enpassant = self.enpassant_possible
+            previous_castle_rights = self.castle_rights_log[-1]
+            self.zobrist_key_log.append(self.zobrist_key)
+            self.pawn_key_log.append(self.pawn_key)
             self.board[move.start_row][move.start_col] = '--'
             self.board[move.end_row][move.end_col] = move.piece_moved
             self.move_log.append(move)
@@ -76,9 +258,10 @@ class GameState:
 
             # Pawn promotion
             if move.pawn_promotion:
-                promoted_piece = None
+                promoted_piece = move.promotion_choice
                 while promoted_piece not in ['Q', 'R', 'B', 'N']:
                     promoted_piece = input('Promote to Q, R, B or N: ')  # TODO: make promotion choice a part of an UI
+                move.promotion_choice = promoted_piece  # Remembered, so the move log has full notation
                 self.board[move.end_row][move.end_col] = move.piece_moved[0] + promoted_piece
 
             # Castle move
@@ -98,6 +281,10 @@ class GameState:
             self.castle_rights_log.append(CastleRights(self.current_castle_rights.wks, self.current_castle_rights.bks,
                                                        self.current_castle_rights.wqs, self.current_castle_rights.bqs))
 
+            self.update_zobrist_key(move, previous_enpassant, previous_castle_rights)
+            if self.accumulator is not None:
+                self.accumulator.push(move)
+
     def update_castle_rights(self, move):
         if move.piece_moved == 'wK':
             self.current_castle_rights.wks = False
@@ -112,7 +299,7 @@ class GameState:
                 elif move.start_col == len(self.board)-1:  # Right rook
                     self.current_castle_rights.wks = False
         elif move.piece_moved == 'bR':
-            if move.start_row == len(self.board)-1:
+            if move.start_row == 0:
                 if move.start_col == 0:  # Left rook
                     self.current_castle_rights.bqs = False
                 elif move.start_col == len(self.board)-1:  # Right rook
@@ -166,13 +353,21 @@ class GameState:
                     self.board[move.end_row][move.end_col-2] = self.board[move.end_row][move.end_col+1]  # Move rook
                     self.board[move.end_row][move.end_col+1] = '--'  # Erase old rook
 
+            self.zobrist_key = self.zobrist_key_log.pop()
+            self.pawn_key = self.pawn_key_log.pop()
+            if self.accumulator is not None:
+                self.accumulator.pop()
+
             # Reset flags
             self.check_mate = False
             self.stale_mate = False
 
-    def get_valid_moves(self):
+    def get_valid_moves(self, expand_promotions=False):
         """
         All moves with considering checks.
+
+        :param expand_promotions: if True, every promotion is returned once per piece it can promote to (with its
+                                  promotion choice set), so the move can be made without asking the user
         """
         moves = []
         self.in_check, self.pins, self.checks = self.check_for_pins_and_checks()
@@ -220,6 +415,10 @@ class GameState:
             else:
                 self.stale_mate = True
 
+        if expand_promotions:
+            moves = [promotion for move in moves
+                     for promotion in (move.get_promotions() if move.pawn_promotion else (move,))]
+
         return moves
 
     def check_for_pins_and_checks(self):
@@ -432,10 +631,11 @@ class GameState:
     def get_queen_moves(self, row, column, moves):
         """
          Gets all the queen moves for the queen at given location and adds these moves to the list.
-         Queen's moves are combination of moves of rook and bishop.
+         Queen's moves are combination of moves of rook and bishop - generated in one pass, because the pin of the
+        queen is consumed by the first pass.
         """
-        self.get_rook_moves(row, column, moves)
-        self.get_bishop_moves(row, column, moves)
+        directions = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (1, 1), (1, -1), (-1, 1))
+        self.get_long_distance_move(row, column, directions, moves, len(self.board) - 1)
 
     def get_long_distance_move(self, row, column, directions, moves, longest_move):
         """
@@ -548,6 +748,13 @@ class CastleRights:
         self.wqs = wqs
         self.bqs = bqs
 
+    def zobrist_key(self):
+        key = 0
+        for i, right in enumerate((self.wks, self.bks, self.wqs, self.bqs)):
+            if right:
+                key ^= ZOBRIST_CASTLING[i]
+        return key
+
 
 class Move:
     ranks_to_rows = {'1': 7, '2': 6, '3': 5, '4': 4, '5': 3, '6': 2, '7': 1, '8': 0}
@@ -555,7 +762,10 @@ class Move:
     files_to_cols = {'a': 0, 'b': 1, 'c': 2, 'd': 3, 'e': 4, 'f': 5, 'g': 6, 'h': 7}
     cols_to_files = {v: k for k, v in files_to_cols.items()}
 
-    def __init__(self, start_sq, end_sq, board, enpassant=False, pawn_promotion=False, is_castle_move=False):
+    promotion_pieces = ('Q', 'R', 'B', 'N')
+
+    def __init__(self, start_sq, end_sq, board, enpassant=False, pawn_promotion=False, is_castle_move=False,
+                 promotion_choice=None):
         self.start_row = start_sq[0]
         self.start_col = start_sq[1]
         self.end_row = end_sq[0]
@@ -570,6 +780,7 @@ class Move:
 
         # Pawn promotion
         self.pawn_promotion = pawn_promotion
+        self.promotion_choice = promotion_choice  # 'Q', 'R', 'B' or 'N'; if None the user is asked while moving
 
         # Castle move
         self.is_castle_move = is_castle_move
@@ -578,6 +789,20 @@ class Move:
         self.is_capture_move = self.piece_captured != '--'
 
         self.move_id = self.start_row * 1000 + self.start_col * 100 + self.end_row * 10 + self.end_col
+        if promotion_choice is not None:
+            self.move_id += (self.promotion_pieces.index(promotion_choice) + 1) * 10000
+
+    def get_promotions(self):
+        """
+        Copies of this promotion move - one for every piece the pawn can be promoted to.
+        """
+        promotions = []
+        for piece in self.promotion_pieces:
+            promotion = copy.copy(self)
+            promotion.promotion_choice = piece
+            promotion.move_id = self.move_id % 10000 + (self.promotion_pieces.index(piece) + 1) * 10000
+            promotions.append(promotion)
+        return promotions
 
     def __eq__(self, other):
         if isinstance(other, Move):
@@ -592,10 +817,11 @@ class Move:
 
         # Pawn moves
         if self.piece_moved[1] == 'P':
+            promotion = f'={self.promotion_choice}' if self.promotion_choice is not None else ''
             if self.is_capture_move:
-                return f'{self.cols_to_files[self.start_col]}x{end_square}'
+                return f'{self.cols_to_files[self.start_col]}x{end_square}{promotion}'
             else:
-                return end_square
+                return end_square + promotion
 
         # Piece moves
         move_string = self.piece_moved[1]
@@ -605,7 +831,10 @@ class Move:
         return move_string
 
     def get_chess_notation(self):
-        return self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        notation = self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        if self.promotion_choice is not None:
+            notation += self.promotion_choice.lower()
+        return notation
 
     def get_rank_file(self, r, c):
         return self.cols_to_files[c] + self.rows_to_ranks[r]
@@ -0,0 +1,254 @@
+"""
+Long-lived engine process. Keeps one SearchEngine (and its transposition and history tables) warm between moves and is
+driven by commands sent over a pipe:
+
+    ('position', fen, moves)                    - set up the position, moves in long algebraic notation
+    ('go', search_id, depth, nodes, move_time, ponder)
+                                                - start searching, limits may be None. A ponder search ignores limits
+                                                  and holds its bestmove until 'ponderhit' or 'stop'
+    ('ponderhit', depth, nodes, move_time)      - the expected move was played, the ponder search becomes a normal one
+                                                  with these limits - if all are None it keeps the limits of its 'go'
+    ('stop',)                                   - finish the running search early (it still sends its bestmove)
+    ('newgame',)                                - forget tables of previous games
+    ('isready',)                                - answered with ('readyok',) when all previous commands are done
+    ('quit',)
+
+Replies are ('info', search_id, info_dictionary) after every completed iteration - with the SearchStats record of the
+iteration under 'stats', ('bestmove', search_id, move, ponder_move) - ponder_move is the expected reply or None - and
+('error', description) for commands that could not be executed.
+
+Besides the 'stop' command the parent can set the shared stop event directly - the search polls it every few nodes,
+unwinds and reports the best move found so far, so stopping never waits for the command loop.
+"""
+import os
+import threading
+from multiprocessing import Process, Pipe, Event
+from typing import List, Tuple, Union
+from engine import GameState, START_FEN
+from chess_ai import SearchEngine, SearchLimits, SearchStats, ChessAi
+from book import OpeningBook
+from bitbases import Bitbases
+from nnue import Network
+
+
+def worker_main(connection, stop_event, tt_size: int, book_path: Union[str, None] = None,
+                bitbases_path: Union[str, None] = None, weights_path: Union[str, None] = None,
+                network_path: Union[str, None] = None) -> None:
+    """
+    Command loop of the worker process. Searches run in a separate thread, so 'stop' can be received while searching.
+    """
+    if weights_path is not None and os.path.exists(weights_path):
+        ChessAi.load_weights(weights_path)
+    book = OpeningBook(book_path) if book_path is not None and os.path.exists(book_path) else None
+    bitbases = Bitbases(bitbases_path) if bitbases_path is not None and os.path.exists(bitbases_path) else None
+    network = Network.load(network_path) if network_path is not None and os.path.exists(network_path) else None
+    engine = SearchEngine(tt_size=tt_size, stop_event=stop_event, book=book, bitbases=bitbases, stats=SearchStats(),
+                          network=network)
+    game_state = GameState()
+    send_lock = threading.Lock()
+    search_thread: Union[threading.Thread, None] = None
+
+    def send(message: Tuple) -> None:
+        with send_lock:
+            connection.send(message)
+
+    def run_search(search_id: int, limits: SearchLimits, searched_state: GameState, ponder: bool) -> None:
+        engine.info_callback = lambda info: send(('info', search_id, info))
+        move = engine.search(searched_state, limits=limits, ponder=ponder)
+        principal_variation = engine.principal_variation
+        ponder_move = principal_variation[1].get_chess_notation() if len(principal_variation) > 1 else None
+        send(('bestmove', search_id, move.get_chess_notation() if move is not None else None, ponder_move))
+
+    def finish_search() -> None:
+        if search_thread is not None and search_thread.is_alive():
+            engine.stop()
+            search_thread.join()
+
+    while True:
+        try:
+            command, *args = connection.recv()
+        except EOFError:  # Parent has gone away
+            command, args = 'quit', []
+
+        if command == 'position':
+            finish_search()
+            fen, moves = args
+            try:
+                new_game_state = GameState(fen)
+                for notation in moves:
+                    move = new_game_state.get_move_from_notation(notation)
+                    if move is None:
+                        raise ValueError(f'Illegal move in position command: {notation}')
+                    new_game_state.make_move(move)
+            except (ValueError, IndexError, KeyError) as e:
+                send(('error', str(e)))
+            else:
+                game_state = new_game_state
+
+        elif command == 'go':
+            finish_search()
+            search_id, depth, nodes, move_time, ponder = args
+            stop_event.clear()
+            limits = SearchLimits(depth if depth is not None else ChessAi.DEPTH, nodes, move_time)
+            if ponder:  # Before the thread starts, so that a following 'ponderhit' is not lost
+                engine.begin_ponder()
+            search_thread = threading.Thread(target=run_search, args=(search_id, limits, game_state, ponder))
+            search_thread.start()
+
+        elif command == 'ponderhit':
+            depth, nodes, move_time = args
+            if depth is None and nodes is None and move_time is None:
+                engine.ponderhit()
+            else:
+                engine.ponderhit(SearchLimits(depth if depth is not None else ChessAi.DEPTH, nodes, move_time))
+
+        elif command == 'stop':
+            finish_search()
+
+        elif command == 'newgame':
+            finish_search()
+            engine.new_game()
+
+        elif command == 'isready':
+            send(('readyok',))
+
+        elif command == 'quit':
+            finish_search()
+            break
+
+
+class EngineWorker:
+    """
+    Parent side of the engine process. All methods return immediately - results are collected with poll().
+    """
+    def __init__(self, tt_size: int = 1_000_000, book_path: Union[str, None] = None,
+                 bitbases_path: Union[str, None] = None, weights_path: Union[str, None] = None,
+                 network_path: Union[str, None] = None):
+        """
+        :param tt_size: maximum number of positions in the transposition table
+        :param book_path: Polyglot opening book, used if the file exists
+        :param bitbases_path: endgame bitbases, used if the file exists
+        :param weights_path: evaluation weights written by tuner.py, used if the file exists
+        :param network_path: weights of the neural evaluator (see nnue.py), used instead of the handcrafted evaluation
+                             if the file exists
+        """
+        self.connection, child_connection = Pipe()
+        self.stop_event = Event()
+        self.process = Process(target=worker_main, daemon=True,
+                               args=(child_connection, self.stop_event, tt_size, book_path, bitbases_path, weights_path,
+                                     network_path))
+        self.process.start()
+        self.search_id = 0
+        self.searching = False
+        self.best_move: Union[str, None] = None  # Result of the last finished search
+        self.ponder_move: Union[str, None] = None  # Expected reply to the best move
+        self.last_info: Union[dict, None] = None
+        self.pondering = False
+        self.pondered_move: Union[str, None] = None  # Move the running ponder search assumes the opponent plays
+
+    def set_position(self, fen: str = START_FEN, moves: Tuple[str, ...] = ()) -> None:
+        self.connection.send(('position', fen, list(moves)))
+
+    def set_game_state(self, game_state: GameState) -> None:
+        """
+        Sends the starting position of the game and all moves made since.
+        """
+        self.set_position(game_state.start_fen, tuple(move.get_chess_notation() for move in game_state.move_log))
+
+    def go(self, depth: Union[int, None] = None, nodes: Union[int, None] = None,
+           move_time: Union[float, None] = None, ponder: bool = False) -> int:
+        """
+        Starts a search of the current position.
+
+        :return: id of the search, echoed in its info and bestmove replies
+        """
+        self.search_id += 1
+        self.searching = True
+        self.pondering = ponder
+        self.best_move = None
+        self.ponder_move = None
+        self.connection.send(('go', self.search_id, depth, nodes, move_time, ponder))
+        return self.search_id
+
+    def start_pondering(self, game_state: GameState) -> bool:
+        """
+        Call after the engine's move has been made. Searches the position after the expected reply on the opponent's
+        time.
+
+        :return: True if pondering has started (there is an expected reply)
+        """
+        if self.ponder_move is None or self.searching:
+            return False
+        self.pondered_move = self.ponder_move
+        self.set_position(game_state.start_fen, tuple(move.get_chess_notation() for move in game_state.move_log) +
+                          (self.pondered_move,))
+        self.go(ponder=True)
+        return True
+
+    def start_thinking(self, game_state: GameState, depth: Union[int, None] = None, nodes: Union[int, None] = None,
+                       move_time: Union[float, None] = None) -> bool:
+        """
+        Starts the search for the engine's move. If the opponent played the move the engine was pondering on, the ponder
+        search continues with the given limits (ponder hit) - otherwise it is discarded (ponder miss) and a new search
+        is started. The transposition table stays warm either way.
+
+        :return: True on a ponder hit
+        """
+        if self.pondering and self.searching:
+            last_move = game_state.move_log[-1].get_chess_notation() if game_state.move_log else None
+            if last_move == self.pondered_move:
+                self.pondering = False
+                self.connection.send(('ponderhit', depth, nodes, move_time))
+                return True
+            self.stop()
+        self.set_game_state(game_state)
+        self.go(depth, nodes, move_time)
+        return False
+
+    def stop(self, keep_result: bool = False) -> None:
+        """
+        Stops the running search. The worker is not killed - its tables stay warm for the next search.
+
+        :param keep_result: if True, the best move found so far is still delivered by poll(), otherwise it is ignored
+        """
+        if self.searching:
+            self.stop_event.set()
+            if not keep_result or self.pondering:
+                self.search_id += 1  # Replies of the stopped search become stale
+                self.searching = False
+            self.pondering = False
+            self.connection.send(('stop',))
+
+    def new_game(self) -> None:
+        self.stop()
+        self.connection.send(('newgame',))
+
+    def poll(self) -> List[Tuple]:
+        """
+        Reads all replies that have arrived, without blocking. Replies of stopped searches are dropped.
+
+        :return: list of replies of the current search
+        """
+        replies = []
+        while self.connection.poll():
+            reply = self.connection.recv()
+            if reply[0] in ('info', 'bestmove') and reply[1] != self.search_id:
+                continue
+            if reply[0] == 'info':
+                self.last_info = reply[2]
+            elif reply[0] == 'bestmove':
+                self.best_move = reply[2]
+                self.ponder_move = reply[3]
+                self.searching = False
+            replies.append(reply)
+        return replies
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            try:
+                self.connection.send(('quit',))
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.terminate()
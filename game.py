@@ -4,9 +4,9 @@ Main file. Handles user input and displays the current game state.
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
 import pygame as pg
-from multiprocessing import Process, Queue
 from engine import GameState, Move
 from chess_ai import ChessAi
+from engine_worker import EngineWorker
 
 
 BOARD_WIDTH = BOARD_HEIGHT = 512
@@ -18,6 +18,10 @@ MAX_FPS = 60
 HOOVERED_SQ_COLOR = (100, 100, 100)
 POSSIBLE_MOVE_SQ_COLOR = (120, 255, 50)
 SELECTED_SQ_COLOR = (255, 255, 0)
+OPENING_BOOK_PATH = 'resources/book.bin'  # Polyglot book used by the AI if present - see book.py to build one
+BITBASES_PATH = 'resources/bitbases.bin'  # Endgame bitbases used by the AI if present - see bitbases.py to build them
+WEIGHTS_PATH = 'resources/weights.json'  # Tuned evaluation used by the AI if present - see tuner.py to create it
+NETWORK_PATH = 'resources/nnue.npz'  # Neural evaluation used by the AI if present - see nnue.py
 
 
 class Game:
@@ -191,7 +195,9 @@ class Game:
         player_one = True  # If human is playing white - True, if ai is playing - False
         player_two = False  # Same as above but for black
         ai_thinking = False
-        move_finder_process = None
+        # Lives for the whole game, so its tables stay warm between moves
+        engine_worker = EngineWorker(book_path=OPENING_BOOK_PATH, bitbases_path=BITBASES_PATH,
+                                     weights_path=WEIGHTS_PATH, network_path=NETWORK_PATH)
 
         move_undone = False
 
@@ -257,11 +263,15 @@ class Game:
                         move_made = True
                         animate = False
                         game_over = False
-                        if ai_thinking:
-                            move_finder_process.terminate()
-                            ai_thinking = False
+                        engine_worker.stop()  # Stops thinking as well as pondering
+                        ai_thinking = False
                         move_undone = True
 
+                    # Make the AI move now - with the best move it has found so far
+                    if e.key == pg.K_m:
+                        if ai_thinking:
+                            engine_worker.stop(keep_result=True)
+
                     # Reset the board
                     if e.key == pg.K_r:
                         self.game_state = GameState()
@@ -271,28 +281,33 @@ class Game:
                         game_over = False
                         move_made = False
                         animate = False
-                        if ai_thinking:
-                            move_finder_process.terminate()
-                            ai_thinking = False
+                        engine_worker.new_game()
+                        ai_thinking = False
                         move_undone = True
 
             # Ai move finder logic
+            engine_replies = engine_worker.poll()  # Polled every frame - also drains progress of pondering
             if not game_over and not is_human_turn and not move_undone:
                 if not ai_thinking:
                     ai_thinking = True
-                    return_queue = Queue()  # Used to pass data between threads
-                    move_finder_process = Process(target=ChessAi.find_best_move_negamax_alpha_beta,
-                                                  args=(self.game_state, valid_moves, return_queue))
-                    move_finder_process.start()
-
-                if not move_finder_process.is_alive():
-                    ai_move = return_queue.get()
-                    if ai_move is None:
-                        ai_move = ChessAi.find_random_move(valid_moves)
-                    self.game_state.make_move(ai_move)
-                    move_made = True
-                    animate = True
-                    ai_thinking = False
+                    engine_worker.start_thinking(self.game_state)  # Continues the ponder search on a ponder hit
+
+                for reply in engine_replies:
+                    if reply[0] == 'bestmove':
+                        ai_move = self.game_state.get_move_from_notation(reply[2]) if reply[2] is not None else None
+                        found_by_engine = ai_move is not None
+                        if ai_move is None:
+                            ai_move = ChessAi.find_random_move(valid_moves)
+                        self.game_state.make_move(ai_move)
+                        move_made = True
+                        animate = True
+                        ai_thinking = False
+
+                        # Think about the expected reply while the human is thinking
+                        human_moves_next = (self.game_state.white_to_move and player_one) or (
+                                not self.game_state.white_to_move and player_two)
+                        if found_by_engine and human_moves_next:
+                            engine_worker.start_pondering(self.game_state)
 
             if move_made:
                 if animate:
@@ -316,6 +331,8 @@ class Game:
             clock.tick(MAX_FPS)
             pg.display.flip()
 
+        engine_worker.close()
+
     def draw_end_game_text(self, text):
         font = pg.font.SysFont('Helvitca', 32, True, False)
         text_object = font.render(text, False, pg.Color('Dark Red'))
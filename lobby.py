@@ -0,0 +1,180 @@
+"""
+Lobbies of the server. Every client is in exactly one lobby - chat and the lobby state are sent only to its members.
+A client joining without naming a lobby is put into the oldest lobby with a free place, and a new lobby is opened when
+all of them are full, so the number of clients is limited by the number of lobbies, not by the size of one.
+
+Lobbies and their members are found through dictionaries, so joining, leaving and routing a message take the same
+time with one lobby as with hundreds.
+
+Every join and leave gives the lobby its next version and is reported to the on_change callback, so that the server
+sends its players only the change.
+"""
+import itertools
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+
+
+class Lobby:
+    __slots__ = ('name', 'capacity', 'members', 'version')
+
+    def __init__(self, name: str, capacity: int):
+        self.name = name
+        self.capacity = capacity
+        self.members: Dict[str, None] = dict()  # Nicknames in joining order
+        self.version = 0  # Number of changes of the members
+
+    def is_full(self) -> bool:
+        return len(self.members) >= self.capacity
+
+
+class LobbyManager:
+    """
+    Lobbies and the lobby of every player. Thread safe - the threaded server calls it from every client's thread.
+    """
+    def __init__(self, capacity: int, max_lobbies: int,
+                 on_change: Union[Callable[[Lobby, str, bool], None], None] = None):
+        """
+        :param capacity: players in one lobby
+        :param max_lobbies: lobbies open at once
+        :param on_change: called with (lobby, nickname, True if joined else left) after every change, under the lock
+                          of the manager - so changes are reported in the order of their versions. Must not block.
+        """
+        self.capacity = capacity
+        self.max_lobbies = max_lobbies
+        self.on_change = on_change
+        self.lobbies: Dict[str, Lobby] = dict()  # name -> lobby
+        self.player_lobbies: Dict[str, Lobby] = dict()  # nickname -> lobby of the player
+        self.open_lobbies: Dict[str, None] = dict()  # Names of the lobbies with free places, oldest first
+        self.lobby_numbers = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def is_full(self) -> bool:
+        """
+        :return: True if a player joining without naming a lobby would not find a place
+        """
+        return not self.open_lobbies and len(self.lobbies) >= self.max_lobbies
+
+    def create(self, name: str = '') -> Union[Lobby, None]:
+        """
+        Opens an empty lobby. It is closed again when its last player leaves, so a player should join it right away.
+
+        :param name: '' - the lobby is named by the manager
+        :return: the new lobby, None if the name is taken or there are too many lobbies
+        """
+        with self.lock:
+            return self._create(name)
+
+    def _create(self, name: str) -> Union[Lobby, None]:
+        if len(self.lobbies) >= self.max_lobbies:
+            return None
+        if name == '':
+            name = f'Lobby {next(self.lobby_numbers)}'
+            while name in self.lobbies:
+                name = f'Lobby {next(self.lobby_numbers)}'
+        elif name in self.lobbies:
+            return None
+        lobby = Lobby(name, self.capacity)
+        self.lobbies[name] = lobby
+        self.open_lobbies[name] = None
+        return lobby
+
+    def join(self, nickname: str, name: str = '') -> Union[Lobby, None]:
+        """
+        Moves the player to the lobby, out of its current one.
+
+        :param name: name of the lobby, '' - the oldest lobby with a free place or a new one if all are full
+        :return: lobby of the player, None if the lobby does not exist or is full - the player stays where it was
+        """
+        with self.lock:
+            if name == '' and not self.open_lobbies:
+                return self._create_and_join(nickname, '')
+            lobby = self.lobbies[next(iter(self.open_lobbies))] if name == '' else self.lobbies.get(name)
+            if lobby is None:
+                return None
+            return self._join(nickname, lobby)
+
+    def create_and_join(self, nickname: str, name: str = '') -> Union[Lobby, None]:
+        """
+        Opens an empty lobby and moves the player to it in one step, so no other player can take its place first.
+
+        :param name: '' - the lobby is named by the manager
+        :return: the new lobby, None if it could not be opened or joined - then it is closed again
+        """
+        with self.lock:
+            return self._create_and_join(nickname, name)
+
+    def _create_and_join(self, nickname: str, name: str) -> Union[Lobby, None]:
+        lobby = self._create(name)
+        if lobby is None:
+            return None
+        if self._join(nickname, lobby) is None:
+            self._close(lobby)
+            return None
+        return lobby
+
+    def _join(self, nickname: str, lobby: Lobby) -> Union[Lobby, None]:
+        if nickname in lobby.members:
+            return lobby
+        if lobby.is_full():
+            return None
+        self._leave(nickname)
+        lobby.members[nickname] = None
+        lobby.version += 1
+        self.player_lobbies[nickname] = lobby
+        if lobby.is_full():
+            self.open_lobbies.pop(lobby.name, None)
+        if self.on_change is not None:
+            self.on_change(lobby, nickname, True)
+        return lobby
+
+    def leave(self, nickname: str) -> Union[Lobby, None]:
+        """
+        :return: lobby the player has left, None if it was in none
+        """
+        with self.lock:
+            return self._leave(nickname)
+
+    def _leave(self, nickname: str) -> Union[Lobby, None]:
+        lobby = self.player_lobbies.pop(nickname, None)
+        if lobby is None:
+            return None
+        del lobby.members[nickname]
+        lobby.version += 1
+        if lobby.members:
+            self.open_lobbies[lobby.name] = None
+        else:  # Closed, so that lobbies spawned for a crowd do not outlive it
+            self._close(lobby)
+        if self.on_change is not None:
+            self.on_change(lobby, nickname, False)
+        return lobby
+
+    def _close(self, lobby: Lobby) -> None:
+        del self.lobbies[lobby.name]
+        self.open_lobbies.pop(lobby.name, None)
+
+    def lobby_of(self, nickname: str) -> Union[Lobby, None]:
+        return self.player_lobbies.get(nickname)
+
+    def members(self, lobby: Lobby) -> List[str]:
+        """
+        :return: nicknames of the players in the lobby, in joining order
+        """
+        with self.lock:
+            return list(lobby.members)
+
+    def snapshot(self, nickname: str, send: Callable[[Lobby], None]) -> None:
+        """
+        Calls send with the lobby of the player under the lock, so that no change is reported while the whole lobby is
+        being sent.
+        """
+        with self.lock:
+            lobby = self.player_lobbies.get(nickname)
+            if lobby is not None:
+                send(lobby)
+
+    def list(self) -> Tuple[List[str], List[int]]:
+        """
+        :return: (names of the lobbies, their numbers of players)
+        """
+        with self.lock:
+            return list(self.lobbies), [len(lobby.members) for lobby in self.lobbies.values()]
@@ -0,0 +1,164 @@
+"""
+Small NNUE-style evaluator. The network sees the board from both sides - a piece-square feature is active for every
+piece, indexed by whether the piece is own or enemy, its kind and its square (mirrored for black):
+
+    feature = (kind + 6 * enemy) * 64 + square     kind: P, N, B, R, Q, K
+
+The first layer (768 -> hidden) is an int16 accumulator kept up to date by GameState: every make_move adds and
+subtracts the weight rows of the few features the move changes (two to four), every undo_move drops the last
+accumulator. Only the small layers on top - clipped ReLU of both perspectives (side to move first) -> 32 -> 1 - are
+computed per evaluation, in float32.
+
+Weights are loaded from an .npz file with the arrays:
+
+    feature_weights   int16 (768, hidden)     feature_bias   int16 (hidden,)
+    hidden_weights    float32 (2 * hidden, 32) hidden_bias    float32 (32,)
+    output_weights    float32 (32,)           output_bias    float32 ()
+    activation_scale  int16 ()                 - accumulator value that stands for an activation of 1
+"""
+import numpy as np
+
+PIECE_KINDS = ('P', 'N', 'B', 'R', 'Q', 'K')
+FEATURES = 2 * len(PIECE_KINDS) * 64
+HIDDEN_LAYER = 32
+MAX_SCORE = 100  # Scores of the network are clipped below the mate scores of the search
+
+
+def feature_indices(piece, row, col):
+    """
+    :return: (index from white's view, index from black's view) of the piece on the square
+    """
+    kind = PIECE_KINDS.index(piece[1])
+    white_index = (kind + 6 * (piece[0] == 'b')) * 64 + row * 8 + col
+    black_index = (kind + 6 * (piece[0] == 'w')) * 64 + (7 - row) * 8 + col
+    return white_index, black_index
+
+
+# [piece][row][col] -> (white index, black index), looked up on every move
+FEATURE_INDICES = {color + kind: [[feature_indices(color + kind, row, col) for col in range(8)] for row in range(8)]
+                   for color in 'wb' for kind in PIECE_KINDS}
+
+
+class Network:
+    def __init__(self, feature_weights, feature_bias, hidden_weights, hidden_bias, output_weights, output_bias,
+                 activation_scale=127):
+        self.feature_weights = np.asarray(feature_weights, dtype=np.int16)
+        self.feature_bias = np.asarray(feature_bias, dtype=np.int16)
+        self.hidden_weights = np.asarray(hidden_weights, dtype=np.float32)
+        self.hidden_bias = np.asarray(hidden_bias, dtype=np.float32)
+        self.output_weights = np.asarray(output_weights, dtype=np.float32)
+        self.output_bias = float(output_bias)
+        self.activation_scale = int(activation_scale)
+        # Hidden weights for accumulator values - the division by the activation scale is done once here
+        self.scaled_hidden_weights = self.hidden_weights * np.float32(1 / self.activation_scale)
+        if self.feature_weights.shape[0] != FEATURES or \
+                self.hidden_weights.shape != (2 * self.feature_weights.shape[1], len(self.hidden_bias)):
+            raise ValueError('Network layers do not fit together')
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as weights:
+            return Network(weights['feature_weights'], weights['feature_bias'], weights['hidden_weights'],
+                           weights['hidden_bias'], weights['output_weights'], weights['output_bias'],
+                           weights['activation_scale'])
+
+    def save(self, path):
+        np.savez(path, feature_weights=self.feature_weights, feature_bias=self.feature_bias,
+                 hidden_weights=self.hidden_weights, hidden_bias=self.hidden_bias, output_weights=self.output_weights,
+                 output_bias=self.output_bias, activation_scale=np.int16(self.activation_scale))
+
+    @staticmethod
+    def random(hidden=128, seed=None):
+        """
+        Network with small random weights - a starting point for training, and for testing.
+        """
+        random_generator = np.random.default_rng(seed)
+        return Network(random_generator.integers(-16, 17, (FEATURES, hidden)), random_generator.integers(0, 64, hidden),
+                       random_generator.normal(0, 0.1, (2 * hidden, HIDDEN_LAYER)), np.zeros(HIDDEN_LAYER),
+                       random_generator.normal(0, 0.1, HIDDEN_LAYER), 0.0)
+
+    def new_accumulator(self, game_state):
+        """
+        Accumulator of the position, attached to the game state so that its moves update it.
+        """
+        accumulator = Accumulator(self)
+        accumulator.refresh(game_state.board)
+        game_state.accumulator = accumulator
+        return accumulator
+
+    def evaluate(self, accumulator, white_to_move):
+        """
+        :return: score in pawns from the point of view of the side to move
+        """
+        accumulator = accumulator.stack[-1]
+        if not white_to_move:
+            accumulator = accumulator[::-1]
+        hidden = accumulator.clip(0, self.activation_scale).astype(np.float32).reshape(-1)
+        hidden = (hidden @ self.scaled_hidden_weights + self.hidden_bias).clip(0, 1)
+        score = float(hidden.dot(self.output_weights)) + self.output_bias
+        return min(max(score, -MAX_SCORE), MAX_SCORE)
+
+
+class Accumulator:
+    """
+    First layer outputs of both perspectives, one (2, hidden) array per move made - undoing a move only pops.
+    """
+    def __init__(self, network):
+        self.network = network
+        self.stack = []
+
+    def __deepcopy__(self, memo):
+        copy = Accumulator(self.network)  # The weights are shared
+        copy.stack = list(self.stack)  # Arrays are never changed in place
+        return copy
+
+    def refresh(self, board):
+        """
+        Computes the accumulator from scratch.
+        """
+        white_indices, black_indices = [], []
+        for row, pieces in enumerate(board.tolist()):
+            for col, piece in enumerate(pieces):
+                if piece != '--':
+                    white_index, black_index = FEATURE_INDICES[piece][row][col]
+                    white_indices.append(white_index)
+                    black_indices.append(black_index)
+        weights = self.network.feature_weights
+        accumulator = np.empty((2, weights.shape[1]), dtype=np.int16)
+        accumulator[0] = self.network.feature_bias + weights[white_indices].sum(axis=0, dtype=np.int16)
+        accumulator[1] = self.network.feature_bias + weights[black_indices].sum(axis=0, dtype=np.int16)
+        self.stack = [accumulator]
+
+    def push(self, move):
+        """
+        Adds the accumulator of the position after the move.
+        """
+        weights = self.network.feature_weights
+        accumulator = self.stack[-1].copy()
+        white, black = accumulator
+        moved = move.piece_moved
+        white_index, black_index = FEATURE_INDICES[moved][move.start_row][move.start_col]
+        white -= weights[white_index]
+        black -= weights[black_index]
+        if move.pawn_promotion:
+            moved = moved[0] + move.promotion_choice
+        white_index, black_index = FEATURE_INDICES[moved][move.end_row][move.end_col]
+        white += weights[white_index]
+        black += weights[black_index]
+        if move.is_capture_move:
+            captured_row = move.start_row if move.enpassant else move.end_row
+            white_index, black_index = FEATURE_INDICES[move.piece_captured][captured_row][move.end_col]
+            white -= weights[white_index]
+            black -= weights[black_index]
+        if move.is_castle_move:
+            rook = FEATURE_INDICES[moved[0] + 'R'][move.end_row]
+            if move.end_col - move.start_col == 2:  # King side castle
+                (white_from, black_from), (white_to, black_to) = rook[move.end_col + 1], rook[move.end_col - 1]
+            else:  # Queen side castle
+                (white_from, black_from), (white_to, black_to) = rook[move.end_col - 2], rook[move.end_col + 1]
+            white += weights[white_to] - weights[white_from]
+            black += weights[black_to] - weights[black_from]
+        self.stack.append(accumulator)
+
+    def pop(self):
+        self.stack.pop()
@@ -0,0 +1,197 @@
+"""
+Parallel root search. Root moves are split across a pool of worker processes which share the best score found so far,
+so later moves are searched with a narrower alpha-beta window.
+"""
+import argparse
+import copy
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from engine import GameState
+from chess_ai import ChessAi, SearchEngine, SearchLimits, SearchAborted
+
+# Worker process globals - set by the pool initializer
+_shared_alpha = None
+_engine = None
+
+
+def _init_worker(shared_alpha, stop_event, tt_size):
+    global _shared_alpha, _engine
+    _shared_alpha = shared_alpha
+    # Kept for the whole life of the worker, so its tables stay warm
+    _engine = SearchEngine(tt_size=tt_size, stop_event=stop_event)
+
+
+def _search_root_move(game_state, move, depth, limits):
+    """
+    Searches one root move in a worker process with alpha taken from (and improved in) the shared value.
+
+    :return: (move id, score, principal variation, nodes, exact) - score is None if the search was aborted, exact is
+             False if the move failed low - its score is only an upper bound, not above the alpha it was searched with
+    """
+    if _engine.stop_event.is_set():  # Stopped while waiting for a worker
+        return move.move_id, None, [], 0, False
+    alpha = _shared_alpha.value
+    try:
+        score = _engine.search_move(game_state, move, depth, alpha, ChessAi.CHECKMATE + 1, limits)
+    except SearchAborted:
+        return move.move_id, None, [], _engine.nodes, False
+    if score > alpha:
+        with _shared_alpha.get_lock():
+            if score > _shared_alpha.value:
+                _shared_alpha.value = score
+    return move.move_id, score, _engine.principal_variation, _engine.nodes, score > alpha
+
+
+class ParallelSearch:
+    """
+    Iterative deepening where every iteration searches the best move of the previous one first (to get a good alpha)
+    and then all remaining root moves in parallel.
+    """
+    def __init__(self, workers=None, limits=None, tt_size=1_000_000):
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.limits = limits if limits is not None else SearchLimits()
+        self.shared_alpha = multiprocessing.Value('d', 0.0)
+        self.stop_event = multiprocessing.Event()  # Polled by the searches of all workers
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                            initargs=(self.shared_alpha, self.stop_event, tt_size))
+
+        # Result of the last search
+        self.best_move = None
+        self.best_score = 0
+        self.principal_variation = []
+        self.completed_depth = 0
+        self.nodes = 0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.stop_event.set()
+        self.executor.shutdown(cancel_futures=True)
+
+    def stop(self):
+        """
+        Makes all workers finish their searches. The running search() returns the best move found so far.
+        """
+        self.stop_event.set()
+
+    def search(self, game_state, valid_moves=None, limits=None):
+        """
+        Finds the best move for the side to move. The given game state is not modified. If the search is stopped or
+        runs out of time or nodes, the best move found so far is returned.
+
+        :return: best move or None if there are no valid moves
+        """
+        limits = limits if limits is not None else self.limits
+        game_state = copy.deepcopy(game_state)
+        root_moves = game_state.get_valid_moves(expand_promotions=True)
+        if valid_moves is not None:
+            allowed = {move.move_id % 10000 for move in valid_moves}
+            root_moves = [move for move in root_moves if move.move_id % 10000 in allowed]
+        moves_by_id = {move.move_id: move for move in root_moves}
+
+        start_time = time.perf_counter()
+        self.best_move = root_moves[0] if root_moves else None
+        self.best_score = 0
+        self.principal_variation = [self.best_move] if root_moves else []
+        self.completed_depth = 0
+        self.nodes = 0
+        self.stop_event.clear()
+        if len(root_moves) <= 1:
+            self.elapsed = time.perf_counter() - start_time
+            return self.best_move
+
+        # The workers count the time of every root move on their own, so the whole search is stopped at the deadline
+        deadline = start_time + limits.move_time if limits.move_time is not None else None
+        for depth in range(1, limits.depth + 1):
+            iteration_limits = SearchLimits(limits.depth, limits.nodes, limits.move_time)
+            if limits.nodes is not None:  # Every search counts its own nodes - the rest is split between the moves
+                iteration_limits.nodes = (limits.nodes - self.nodes) // len(root_moves)
+                if iteration_limits.nodes <= 0:
+                    break
+            if limits.move_time is not None:
+                iteration_limits.move_time = limits.move_time - (time.perf_counter() - start_time)
+                if iteration_limits.move_time <= 0:
+                    break
+
+            # Best move of the previous iteration alone, then the rest in parallel
+            ordered = [self.best_move] + [move for move in root_moves if move.move_id != self.best_move.move_id]
+            self.shared_alpha.value = -ChessAi.CHECKMATE - 1
+            results = self.wait_results([self.executor.submit(_search_root_move, game_state, ordered[0], depth,
+                                                              iteration_limits)], deadline)
+            futures = [self.executor.submit(_search_root_move, game_state, move, depth, iteration_limits)
+                       for move in ordered[1:]]
+            results += self.wait_results(futures, deadline)
+
+            self.nodes += sum(result[3] for result in results)
+            # Moves which failed low may only tie the best score, so the best move is taken from the exact scores
+            exact = [result for result in results if result[4]]
+            if any(result[1] is None for result in results):
+                # Iteration aborted. If the previous best move got its score, every finished move that beats it is
+                # better - otherwise the scores are not comparable and the previous result is kept.
+                if results[0][1] is not None:
+                    move_id, self.best_score, self.principal_variation, _, _ = max(exact, key=lambda result: result[1])
+                    self.best_move = moves_by_id[move_id]
+                break
+            move_id, score, principal_variation, _, _ = max(exact, key=lambda result: result[1])
+            self.best_move = moves_by_id[move_id]
+            self.best_score = score
+            self.principal_variation = principal_variation
+            self.completed_depth = depth
+            if abs(score) > SearchEngine.MATE_THRESHOLD:
+                break
+
+        self.elapsed = time.perf_counter() - start_time
+        return self.best_move
+
+    def wait_results(self, futures, deadline):
+        """
+        Waits for the root move searches, stopping all of them at the deadline. Searches stopped before they started
+        return at their first check of the limits.
+
+        :return: results of the futures, in their order
+        """
+        if deadline is not None:
+            _, not_done = wait(futures, timeout=max(0.0, deadline - time.perf_counter()))
+            if not_done:
+                self.stop_event.set()
+        return [future.result() for future in futures]
+
+
+def benchmark(game_state, depth, worker_counts):
+    """
+    Searches the position sequentially and with every given number of workers and prints time, nodes per second and
+    speedup per core.
+    """
+    engine = SearchEngine(SearchLimits(depth=depth), seed=0)
+    start_time = time.perf_counter()
+    engine.search(game_state)
+    sequential_time = time.perf_counter() - start_time
+    print(f'sequential: move {engine.best_move}, {engine.nodes} nodes, {sequential_time:.2f} s, '
+          f'{engine.nodes / sequential_time:.0f} nps')
+
+    for workers in worker_counts:
+        with ParallelSearch(workers, SearchLimits(depth=depth)) as parallel_search:
+            parallel_search.search(game_state)
+            speedup = sequential_time / parallel_search.elapsed
+            print(f'{workers} workers: move {parallel_search.best_move}, {parallel_search.nodes} nodes, '
+                  f'{parallel_search.elapsed:.2f} s, {parallel_search.nodes / parallel_search.elapsed:.0f} nps, '
+                  f'speedup {speedup:.2f}, speedup per core {speedup / workers:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parallel root search against sequential search.')
+    parser.add_argument('--depth', type=int, default=ChessAi.DEPTH)
+    parser.add_argument('--workers', type=int, nargs='+', default=[os.cpu_count()])
+    args = parser.parse_args()
+    benchmark(GameState(), args.depth, args.workers)
+
+
+if __name__ == '__main__':
+    main()
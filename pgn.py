@@ -0,0 +1,186 @@
+"""
+Reading and writing of PGN (Portable Game Notation) files and conversion of SAN (standard algebraic notation) moves.
+"""
+import re
+from typing import Dict, Iterator, List, TextIO, Tuple, Union
+from engine import GameState, Move, START_FEN
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+SEVEN_TAG_ROSTER = ('Event', 'Site', 'Date', 'Round', 'White', 'Black', 'Result')  # Written first, in this order
+LINE_LENGTH = 80
+_HEADER = re.compile(r'\[(\w+)\s+"(.*)"\]')
+_COMMENT = re.compile(r'\{[^}]*\}|;[^\n]*')
+_MOVE_NUMBER = re.compile(r'^\d+\.+')
+
+
+def read_games(pgn_file: TextIO) -> Iterator[Tuple[Dict[str, str], List[str]]]:
+    """
+    Reads games one by one, so large collections never have to fit in memory.
+
+    :param pgn_file: opened text file
+    :return: iterator of (headers, list of SAN moves) - comments, variations and annotations are skipped
+    """
+    headers: Dict[str, str] = {}
+    movetext: List[str] = []
+    for line in pgn_file:
+        line = line.strip()
+        if line.startswith('%'):  # Escaped line
+            continue
+        header = _HEADER.match(line)
+        if header is not None:
+            if movetext:  # Game without an empty line before the next headers
+                yield headers, _parse_movetext(' '.join(movetext))
+                headers, movetext = {}, []
+            headers[header.group(1)] = header.group(2)
+        elif line:
+            movetext.append(line)
+            if line.split()[-1] in RESULTS:  # End of the game
+                yield headers, _parse_movetext(' '.join(movetext))
+                headers, movetext = {}, []
+    if movetext:
+        yield headers, _parse_movetext(' '.join(movetext))
+
+
+def _parse_movetext(movetext: str) -> List[str]:
+    movetext = _COMMENT.sub(' ', movetext)
+
+    # Remove (possibly nested) variations
+    depth = 0
+    main_line = []
+    for char in movetext:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth = max(0, depth - 1)
+        elif depth == 0:
+            main_line.append(char)
+
+    moves = []
+    for token in ''.join(main_line).split():
+        token = _MOVE_NUMBER.sub('', token)
+        if not token or token in RESULTS or token.startswith('$'):
+            continue
+        moves.append(token)
+    return moves
+
+
+def san_to_move(game_state: GameState, san: str) -> Union[Move, None]:
+    """
+    Finds the valid move written in SAN, e.g. 'e4', 'Nbd7', 'exd5', 'e8=Q+', 'O-O-O'.
+
+    :return: move or None if the notation does not describe exactly one valid move
+    """
+    san = san.rstrip('+#!?')
+    valid_moves = game_state.get_valid_moves(expand_promotions=True)
+
+    if san in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        king_side = san in ('O-O', '0-0')
+        for move in valid_moves:
+            if move.is_castle_move and (move.end_col == 6) == king_side:
+                return move
+        return None
+
+    promotion = None
+    if '=' in san:
+        san, promotion = san.split('=')
+        promotion = promotion[:1].upper()
+    elif len(san) > 2 and san[-1] in 'QRBN' and san[0].islower():  # Promotion written without '='
+        san, promotion = san[:-1], san[-1]
+
+    piece = san[0] if san[0] in 'KQRBN' else 'P'
+    body = san[1:] if piece != 'P' else san
+    body = body.replace('x', '').replace('-', '')
+    if len(body) < 2 or body[-2] not in Move.files_to_cols or body[-1] not in Move.ranks_to_rows:
+        return None
+    end_row, end_col = Move.ranks_to_rows[body[-1]], Move.files_to_cols[body[-2]]
+    disambiguation = body[:-2]
+
+    candidates = []
+    for move in valid_moves:
+        if move.piece_moved[1] != piece or move.end_row != end_row or move.end_col != end_col:
+            continue
+        if move.promotion_choice != promotion:
+            continue
+        if any((char in Move.files_to_cols and Move.files_to_cols[char] != move.start_col) or
+               (char in Move.ranks_to_rows and Move.ranks_to_rows[char] != move.start_row) for char in disambiguation):
+            continue
+        candidates.append(move)
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def move_to_san(game_state: GameState, move: Move) -> str:
+    """
+    SAN of a valid move, with '+' or '#' when it gives check or mate. A promotion needs its promotion choice set.
+    """
+    if move.is_castle_move:
+        san = 'O-O' if move.end_col == 6 else 'O-O-O'
+    elif move.piece_moved[1] == 'P':
+        san = (Move.cols_to_files[move.start_col] + 'x' if move.is_capture_move else '') + \
+            move.get_rank_file(move.end_row, move.end_col)
+        if move.promotion_choice is not None:
+            san += '=' + move.promotion_choice
+    else:
+        # Other pieces of the same kind which can move to the same square
+        rivals = [other for other in game_state.get_valid_moves() if other.piece_moved == move.piece_moved and
+                  (other.end_row, other.end_col) == (move.end_row, move.end_col) and
+                  (other.start_row, other.start_col) != (move.start_row, move.start_col)]
+        disambiguation = ''
+        if rivals:
+            if all(other.start_col != move.start_col for other in rivals):
+                disambiguation = Move.cols_to_files[move.start_col]
+            elif all(other.start_row != move.start_row for other in rivals):
+                disambiguation = Move.rows_to_ranks[move.start_row]
+            else:
+                disambiguation = move.get_rank_file(move.start_row, move.start_col)
+        san = move.piece_moved[1] + disambiguation + ('x' if move.is_capture_move else '') + \
+            move.get_rank_file(move.end_row, move.end_col)
+
+    game_state.make_move(move)
+    game_state.get_valid_moves()
+    if game_state.check_mate:
+        san += '#'
+    elif game_state.in_check:
+        san += '+'
+    game_state.undo_move()
+    return san
+
+
+def write_game(pgn_file: TextIO, headers: Dict[str, str], sans: List[str]) -> None:
+    """
+    Writes one game. Games starting from another position than the standard one need the 'FEN' header.
+
+    :param pgn_file: opened text file
+    :param headers: tag pairs - the seven tag roster is written first, missing tags as '?'
+    :param sans: moves in SAN
+    """
+    result = headers.get('Result', '*')
+    for tag in SEVEN_TAG_ROSTER:
+        pgn_file.write(f'[{tag} "{headers.get(tag, "?") if tag != "Result" else result}"]\n')
+    for tag, value in headers.items():
+        if tag not in SEVEN_TAG_ROSTER:
+            pgn_file.write(f'[{tag} "{value}"]\n')
+    pgn_file.write('\n')
+
+    fen_fields = headers.get('FEN', START_FEN).split()
+    white_to_move = fen_fields[1] == 'w'
+    move_number = int(fen_fields[5]) if len(fen_fields) > 5 else 1
+    tokens = []
+    for i, san in enumerate(sans):
+        if white_to_move:
+            tokens.append(f'{move_number}.')
+        elif i == 0:
+            tokens.append(f'{move_number}...')
+        tokens.append(san)
+        if not white_to_move:
+            move_number += 1
+        white_to_move = not white_to_move
+    tokens.append(result)
+
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > LINE_LENGTH:
+            pgn_file.write(line + '\n')
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    pgn_file.write(line + '\n\n')
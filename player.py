@@ -1,19 +1,36 @@
 import socket
-import pickle
 import threading
 import time
 from queue import Queue
-from typing import Dict, Union, List
-from server import HOST, PORT, HEADER_LENGTH
+from typing import Callable, Dict, Union, List, Set
+import protocol
+from protocol import FrameReader
+from server import HOST, PORT
 
 
 class Player:
-    def __init__(self, name: str):
+    """
+    Client side of the connection to the server. Two threads block on it instead of polling: the writer waits for
+    frames queued by send() and the receiver waits for messages from the server, which it passes on to on_message.
+    """
+    def __init__(self, name: str, on_message: Union[Callable[[Union[Dict, None]], None], None] = None):
+        """
+        :param name: nickname
+        :param on_message: called from the receiving thread with every message from the server (after the player's
+                           state is updated) and with None when the connection is lost. By default messages are put on
+                           received_message_queue.
+        """
         self.name = name
         self.client: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.received_message_queue: Queue[Dict] = Queue()
-        self.message_to_send: str = ''
-        self.move_queue: Queue = Queue()
+        self.reader = FrameReader(self.client)
+        self.received_message_queue: Queue[Union[Dict, None]] = Queue()
+        self.on_message = on_message if on_message is not None else self.received_message_queue.put
+        self.outgoing_queue: Queue[Union[bytes, None]] = Queue()  # Encoded frames, None stops the writer
+        self.invitations: List[str] = list()  # Nicknames of players who invited this one
+        self.game: Union[Dict, None] = None  # START message of the current game: game, white, black, fen
+        self.game_result: Union[str, None] = None
+        self.watched_games: Dict[int, Dict] = dict()  # game id -> GAME message with the moves played since counted
+        self.watch_requests: Set[int] = set()  # Ids of the games asked for and not received yet
         self.connected: bool = False
         self.lobby_full: bool = False
         self.name_in_use: bool = False
@@ -21,12 +38,12 @@ class Player:
             self.client.connect((HOST, PORT))
             message = self.receive_object_message()
             if message is not None:
-                message_header = list(message['data'].keys())[0]
+                message_header = list(message.keys())[0]
                 if message_header == 'NICK':
                     self.send_object_message({'NICK': self.name})
                     message = self.receive_object_message()
                     if message is not None:
-                        message_header = list(message['data'].keys())[0]
+                        message_header = list(message.keys())[0]
                         if message_header != 'OK':
                             self.name_in_use = True
                             raise Exception('Name already in use in a lobby!')
@@ -44,51 +61,173 @@ class Player:
             self.connected = True
 
         self.stop_thread: bool = False
-        self.lobby_names: List[str] = list()
+        self.lobby: str = ''  # Name of the lobby the player is in
+        self.lobby_names: Dict[str, None] = dict()  # Players of the lobby in joining order
+        self.lobby_version: int = 0  # Version of the lobby the lobby names are up to date with
+        self.lobby_sync_requested: bool = False  # A change was missed and the whole lobby was asked for
+        self.lobbies: Dict[str, int] = dict()  # Lobbies of the server (name -> number of players) as last listed
 
     def send_object_message(self, message_object: Dict) -> None:
         """
-        Sends message object (dictionary) preceded with header which has const length and info about the length of
-        a message.
+        Sends message object (dictionary) as a frame of the protocol right away. Used during the handshake, before the
+        writer runs.
 
-        :param message_object: for example: {'MSG': 'Hello World'}
+        :param message_object: for example: {'NICK': 'Patryk'}
         """
-        pickled_message_object = pickle.dumps(message_object)
-        message_header = bytes(f'{len(pickled_message_object):<{HEADER_LENGTH}}', 'utf-8')
-        self.client.send(message_header + pickled_message_object)
+        self.client.sendall(protocol.encode(message_object))
 
-    def send(self) -> None:
+    def start(self) -> None:
         """
-        Sends messages if any present in message queue.
+        Starts the threads receiving and sending messages.
         """
-        while not self.stop_thread:
+        threading.Thread(target=self.receive, daemon=True).start()
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def send(self, message_object: Dict) -> None:
+        """
+        Queues message object for the writer. Does not block.
+        """
+        self.outgoing_queue.put(protocol.encode(message_object))
+
+    def send_chat_message(self, text: str) -> None:
+        self.send({'MSG': {'author': self.name, 'text': text}})
+
+    def send_move(self, move) -> None:
+        """
+        Sends the move (engine.Move) of the player in the current game.
+        """
+        if self.game is not None:
+            self.send({'MOV': {'game': self.game['game'], 'move': move.move_id}})
+
+    def invite(self, nickname: str) -> None:
+        self.send({'INVITE': nickname})
+
+    def accept(self, nickname: str) -> None:
+        """
+        Accepts the invitation of the player - the server starts the game, the inviting player plays white.
+        """
+        self.send({'ACCEPT': nickname})
+
+    def list_lobbies(self) -> None:
+        """
+        Asks the server for its lobbies, which are put in self.lobbies.
+        """
+        self.send({'LIST': ''})
+
+    def join_lobby(self, name: str = '') -> None:
+        """
+        Moves the player to another lobby.
+
+        :param name: '' - any lobby with a free place
+        """
+        self.send({'JOIN': name})
+
+    def create_lobby(self, name: str = '') -> None:
+        """
+        Opens a new lobby and moves the player there.
+
+        :param name: '' - the lobby is named by the server
+        """
+        self.send({'CREATE': name})
+
+    def apply_lobby_change(self, message_header: str, change: Dict) -> bool:
+        """
+        Applies JOINED or LEFT if it is the next change of the lobby. Asks the server for the whole lobby if a change
+        was missed.
+
+        :return: True if the change was applied
+        """
+        if change['version'] <= self.lobby_version:  # Already in the lobby sent as a whole
+            return False
+        if change['version'] > self.lobby_version + 1:
+            if not self.lobby_sync_requested:
+                self.lobby_sync_requested = True
+                self.send({'SYNC': ''})
+            return False
+        self.lobby_version = change['version']
+        if message_header == 'JOINED':
+            self.lobby_names[change['player']] = None
+        else:
+            self.lobby_names.pop(change['player'], None)
+        return True
+
+    def play_ai(self, color: str = 'w', level: int = 1) -> None:
+        """
+        Starts a game against the server's engine.
+
+        :param color: 'w' or 'b' - color of the player
+        :param level: strength of the engine, from 1
+        """
+        self.send({'AI': {'color': color, 'level': level}})
+
+    def watch(self, game_id: int) -> None:
+        """
+        Starts watching the game. The server sends it as it is now and then its moves.
+        """
+        self.watch_requests.add(game_id)
+        self.send({'WATCH': game_id})
+
+    def unwatch(self, game_id: int) -> None:
+        self.watch_requests.discard(game_id)
+        self.watched_games.pop(game_id, None)
+        self.send({'UNWATCH': game_id})
+
+    def apply_watched_move(self, moved: Dict) -> bool:
+        """
+        Counts MOVED if it is the next move of a watched game. Asks the server for the whole game if a move was missed.
+
+        :return: True if the move was counted
+        """
+        game = self.watched_games.get(moved['game'])
+        if game is None or moved['game'] in self.watch_requests or moved['ply'] <= game['moves']:
+            return False
+        if moved['ply'] > game['moves'] + 1:
+            self.watch(moved['game'])
+            return False
+        game['moves'] = moved['ply']
+        return True
+
+    def write(self) -> None:
+        """
+        Sends queued frames, sleeping until there are any.
+        """
+        while True:
+            frame = self.outgoing_queue.get()
+            if frame is None or self.stop_thread:
+                return
             try:
-                if self.message_to_send != '':
-                    self.send_object_message({'MSG': self.message_to_send})
-                    self.message_to_send = ''
-                if not self.move_queue.empty():
-                    # self.send_object_message({'MOV': self.move_queue.get()})
-                    pass
-            except Exception as e:
-                self.client.close()
-                self.stop_thread = True
-                self.connected = False
+                self.client.sendall(frame)
+            except OSError as e:
                 print(e)
+                self.shutdown()  # The receiving thread reports the lost connection
+                return
+
+    def close(self) -> None:
+        """
+        Stops both threads and closes the connection.
+        """
+        self.stop_thread = True
+        self.connected = False
+        self.shutdown()
+        self.client.close()
+        self.outgoing_queue.put(None)
+
+    def shutdown(self) -> None:
+        """
+        Shuts the socket down, which wakes the receiving thread.
+        """
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def receive_object_message(self) -> Union[Dict, None]:
         """
         Receives an object message from a server.
 
-        :return: dictionary with encoded package header and decoded message
+        :return: message dictionary, None if the server closed the connection
         """
-        message_header = self.client.recv(HEADER_LENGTH)
-        if not message_header:
-            return None
-        message_length = int(message_header.decode('utf-8').strip())
-        data = pickle.loads(self.client.recv(message_length))
-        if not data:
-            return None
-        return {'header': message_header, 'data': data}
+        return self.reader.read_message()
 
     def receive(self) -> None:
         """
@@ -97,43 +236,66 @@ class Player:
         while not self.stop_thread:
             try:
                 message = self.receive_object_message()
-                if message is not None:
-                    # Message logic based on package headers
-                    message_header = list(message['data'].keys())[0]
-                    if message_header == 'MSG':
-                        self.received_message_queue.put(message['data'][message_header])
-                        # print(f'{message["data"][message_header]["author"]}: {message["data"][message_header]["text"]}')
-
-                    elif message_header == 'MOV':
-                        pass
-                    elif message_header == 'LOBBY':
-                        self.lobby_names = message['data'][message_header]
-                        print(self.lobby_names)
+                if message is None:
+                    raise Exception('Server closed the connection!')
+                # Message logic based on package headers
+                message_header = list(message.keys())[0]
+                if message_header in ('MSG', 'MOV'):  # Moves are sent back to the player who made them, too
+                    pass
+                elif message_header == 'ILLEGAL':
+                    print(f'Move rejected by the server: {message[message_header]}')
+                elif message_header == 'INVITE':
+                    self.invitations.append(message[message_header])
+                elif message_header == 'START':
+                    self.game = message[message_header]
+                    self.game_result = None
+                    if self.game['white'] in self.invitations:
+                        self.invitations.remove(self.game['white'])
+                elif message_header == 'END':
+                    game_id = message[message_header]['game']
+                    if game_id in self.watched_games or game_id in self.watch_requests:
+                        self.watched_games.pop(game_id, None)
+                        self.watch_requests.discard(game_id)
                     else:
-                        raise Exception('Received package with wrong message header!')
+                        self.game_result = message[message_header]['result']
+                elif message_header == 'GAME':
+                    self.watched_games[message[message_header]['game']] = message[message_header]
+                    self.watch_requests.discard(message[message_header]['game'])
+                elif message_header == 'MOVED':
+                    if not self.apply_watched_move(message[message_header]):
+                        continue  # Not passed on - a move already in the game or after a missed one
+                elif message_header == 'LOBBY':
+                    self.lobby = message[message_header]['name']
+                    self.lobby_version = message[message_header]['version']
+                    self.lobby_names = dict.fromkeys(message[message_header]['players'])
+                    self.lobby_sync_requested = False
+                elif message_header in ('JOINED', 'LEFT'):
+                    if not self.apply_lobby_change(message_header, message[message_header]):
+                        continue  # Not passed on - the lobby names have not changed
+                elif message_header == 'LOBBIES':
+                    self.lobbies = dict(zip(message[message_header]['names'], message[message_header]['sizes']))
+                elif message_header == 'NO_SPACE':
+                    print('Could not move to the lobby!')
+                else:
+                    raise Exception('Received package with wrong message header!')
+                self.on_message(message)
             except Exception as e:
-                self.client.close()
-                self.stop_thread = True
-                self.connected = False
-                print(e)
+                if not self.stop_thread:  # Not closed by the user
+                    print(e)
+                    self.close()
+                    self.on_message(None)
 
 
 if __name__ == '__main__':
-    player = Player('Patryk')
-    player.message_to_send = 'Hello'
-    thread = threading.Thread(target=player.send)
-    thread2 = threading.Thread(target=player.receive)
-    thread2.start()
-    thread.start()
+    player = Player('Patryk', on_message=print)
+    player.start()
+    player.send_chat_message('Hello')
     time.sleep(2)
-    player.message_to_send = 'jolo'
+    player.send_chat_message('jolo')
     time.sleep(2)
     p2 = Player('John')
-    p2.message_to_send = 'Siema'
-    t = threading.Thread(target=p2.send)
-    t2 = threading.Thread(target=p2.receive)
-    t2.start()
-    t.start()
+    p2.start()
+    p2.send_chat_message('Siema')
     time.sleep(2)
-    p2.message_to_send = 'allah'
+    p2.send_chat_message('allah')
 
@@ -0,0 +1,217 @@
+"""
+Wire protocol of the lobby. Every message is a frame - a binary length prefix followed by a one byte opcode and the
+fields of the message type, each encoded by a fixed schema:
+
+    frame   = length (uint32, big endian, of the rest) + opcode (uint8) + fields
+    u16     = uint16, big endian
+    u32     = uint32, big endian
+    str     = length (uint16) + utf-8 bytes
+    strs    = count (uint16) + str * count
+    u16s    = count (uint16) + u16 * count
+
+Messages are dictionaries with a single header key, for example {'MSG': {'author': 'Patryk', 'text': 'Hello'}}. A
+message type with one unnamed field carries the value itself ({'NICK': 'Patryk'}), one without fields carries ''.
+Unlike pickle, decoding never runs code of the peer.
+"""
+import socket
+import struct
+from typing import Dict, List, Tuple, Union
+
+LENGTH = struct.Struct('!I')
+OPCODE = struct.Struct('!B')
+STRING_LENGTH = struct.Struct('!H')
+INTEGERS = {'u16': struct.Struct('!H'), 'u32': struct.Struct('!I')}
+MAX_FRAME_SIZE = 1 << 20  # Longer frames are rejected before anything is allocated for them
+INITIAL_BUFFER_SIZE = 4096
+
+# header -> (opcode, fields); a field is (name, type), a name of None means the message carries the value itself
+MESSAGE_TYPES: Dict[str, Tuple[int, Tuple[Tuple[Union[str, None], str], ...]]] = {
+    'NICK': (1, ((None, 'str'),)),
+    'OK': (2, ()),
+    'NICK_IN_USE': (3, ()),
+    'NO_SPACE': (4, ()),
+    'LOBBY': (5, (('name', 'str'), ('version', 'u32'), ('players', 'strs'))),  # Lobby of the client as a whole
+    'MSG': (6, (('author', 'str'), ('text', 'str'))),
+    'MOV': (7, (('game', 'u32'), ('move', 'u16'))),  # Move.move_id
+    'INVITE': (8, ((None, 'str'),)),  # To the server: nickname of the invited player, from it: of the inviting one
+    'ACCEPT': (9, ((None, 'str'),)),  # Nickname of the inviting player
+    'START': (10, (('game', 'u32'), ('white', 'str'), ('black', 'str'), ('fen', 'str'))),
+    'ILLEGAL': (11, (('game', 'u32'), ('move', 'u16'))),  # Rejected move, sent only to the player who made it
+    'END': (12, (('game', 'u32'), ('result', 'str'))),  # '1-0', '0-1', '1/2-1/2' or '*' - no such game to watch
+    'LIST': (13, ()),  # Asks for LOBBIES
+    'LOBBIES': (14, (('names', 'strs'), ('sizes', 'u16s'))),  # Lobbies of the server and their numbers of players
+    'JOIN': (15, ((None, 'str'),)),  # Name of the lobby to move to, '' - any lobby with a free place
+    'CREATE': (16, ((None, 'str'),)),  # Name of a new lobby to move to, '' - named by the server
+    # Answered with LOBBY of the new lobby, NO_SPACE if the client could not move. Later changes of the lobby come as
+    # JOINED and LEFT, each with the next version of the lobby - a client which misses one asks for LOBBY with SYNC
+    'JOINED': (17, (('version', 'u32'), ('player', 'str'))),
+    'LEFT': (18, (('version', 'u32'), ('player', 'str'))),
+    'SYNC': (19, ()),
+    # Spectators: WATCH is answered with GAME - the players, the current position and the number of moves played - and
+    # then every move comes as MOVED with its ply, so a spectator which misses one sends WATCH again
+    'WATCH': (20, ((None, 'u32'),)),  # Game id
+    'UNWATCH': (21, ((None, 'u32'),)),
+    'GAME': (22, (('game', 'u32'), ('white', 'str'), ('black', 'str'), ('fen', 'str'), ('moves', 'u16'))),
+    'MOVED': (23, (('game', 'u32'), ('ply', 'u16'), ('move', 'u16'))),  # Ply - number of moves with this one
+    'AI': (24, (('color', 'str'), ('level', 'u16'))),  # Game against the server's engine, answered with START
+}
+HEADERS = {opcode: header for header, (opcode, _) in MESSAGE_TYPES.items()}
+
+
+class ProtocolError(Exception):
+    """
+    Raised for frames which do not follow the protocol.
+    """
+    pass
+
+
+def _encode_string(text: str, parts: List[bytes]) -> None:
+    data = text.encode('utf-8')
+    if len(data) > 0xFFFF:
+        raise ProtocolError('String too long')
+    parts.append(STRING_LENGTH.pack(len(data)))
+    parts.append(data)
+
+
+def encode(message: Dict) -> bytes:
+    """
+    Encodes a message into a frame ready to be sent - encode once, send to many clients.
+
+    :param message: for example: {'MSG': {'author': 'Patryk', 'text': 'Hello World'}}
+    """
+    (header, payload), = message.items()
+    opcode, fields = MESSAGE_TYPES[header]
+    parts = [b'', OPCODE.pack(opcode)]  # The first part is replaced by the length
+    for name, field_type in fields:
+        value = payload if name is None else payload[name]
+        if field_type == 'str':
+            _encode_string(value, parts)
+        elif field_type in INTEGERS:
+            parts.append(INTEGERS[field_type].pack(value))
+        elif field_type == 'u16s':
+            parts.append(STRING_LENGTH.pack(len(value)))
+            parts.append(struct.pack(f'!{len(value)}H', *value))
+        else:  # strs
+            parts.append(STRING_LENGTH.pack(len(value)))
+            for text in value:
+                _encode_string(text, parts)
+    length = sum(len(part) for part in parts)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError('Message too long')
+    parts[0] = LENGTH.pack(length)
+    return b''.join(parts)
+
+
+def _decode_string(frame: memoryview, offset: int) -> Tuple[str, int]:
+    length, = STRING_LENGTH.unpack_from(frame, offset)
+    offset += STRING_LENGTH.size
+    if offset + length > len(frame):
+        raise ProtocolError('Truncated string')
+    return str(frame[offset:offset + length], 'utf-8'), offset + length
+
+
+def decode(frame: Union[bytes, memoryview]) -> Dict:
+    """
+    Decodes a frame without its length prefix.
+
+    :return: message dictionary
+    """
+    try:
+        opcode, = OPCODE.unpack_from(frame, 0)
+        header = HEADERS[opcode]
+        fields = MESSAGE_TYPES[header][1]
+        offset = OPCODE.size
+        values = {}
+        for name, field_type in fields:
+            if field_type == 'str':
+                values[name], offset = _decode_string(frame, offset)
+            elif field_type in INTEGERS:
+                values[name], = INTEGERS[field_type].unpack_from(frame, offset)
+                offset += INTEGERS[field_type].size
+            elif field_type == 'u16s':
+                count, = STRING_LENGTH.unpack_from(frame, offset)
+                offset += STRING_LENGTH.size
+                values[name] = list(struct.unpack_from(f'!{count}H', frame, offset))
+                offset += 2 * count
+            else:  # strs
+                count, = STRING_LENGTH.unpack_from(frame, offset)
+                offset += STRING_LENGTH.size
+                texts = []
+                for _ in range(count):
+                    text, offset = _decode_string(frame, offset)
+                    texts.append(text)
+                values[name] = texts
+    except (struct.error, KeyError, UnicodeDecodeError) as e:
+        raise ProtocolError(f'Malformed frame: {e!r}')
+    if offset != len(frame):
+        raise ProtocolError('Unexpected bytes at the end of a frame')
+    if not fields:
+        return {header: ''}
+    return {header: values[None] if None in values else values}
+
+
+class FrameReader:
+    """
+    Reads frames from a blocking socket. Frames are assembled in one buffer reused for every frame, grown only for
+    a frame longer than any before, so a frame is valid until the next read.
+    """
+    def __init__(self, client: socket.socket):
+        self.client = client
+        self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+
+    def read_exactly(self, size: int) -> Union[memoryview, None]:
+        """
+        :return: view of the next size bytes, None if the connection was closed before the first of them
+        """
+        if size > len(self.buffer):
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        received = 0
+        while received < size:
+            count = self.client.recv_into(self.view[received:size])
+            if count == 0:
+                if received == 0:
+                    return None
+                raise ProtocolError('Connection closed in the middle of a frame')
+            received += count
+        return self.view[:size]
+
+    def read_frame(self) -> Union[memoryview, None]:
+        """
+        :return: next frame without its length prefix, None if the connection was closed
+        """
+        prefix = self.read_exactly(LENGTH.size)
+        if prefix is None:
+            return None
+        length, = LENGTH.unpack(prefix)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f'Frame of {length} bytes is too long')
+        frame = self.read_exactly(length)
+        if frame is None:
+            raise ProtocolError('Connection closed in the middle of a frame')
+        return frame
+
+    def read_message(self) -> Union[Dict, None]:
+        """
+        :return: next message, None if the connection was closed
+        """
+        frame = self.read_frame()
+        return decode(frame) if frame is not None else None
+
+
+async def read_message(reader) -> Union[Dict, None]:
+    """
+    Reads the next message from an asyncio stream.
+
+    :param reader: asyncio.StreamReader
+    :return: message, None if the connection was closed
+    """
+    try:
+        prefix = await reader.readexactly(LENGTH.size)
+    except EOFError:  # asyncio.IncompleteReadError
+        return None
+    length, = LENGTH.unpack(prefix)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f'Frame of {length} bytes is too long')
+    return decode(await reader.readexactly(length))
@@ -1,12 +1,111 @@
 import socket
 import threading
-from typing import List, Union, Dict, Tuple
-import pickle
+from collections import deque
+from typing import Deque, Iterable, Dict, Tuple, Union
+import protocol
+from protocol import FrameReader
+from ai_pool import AiPool, GameBudget
+from lobby import Lobby, LobbyManager
+from session import GameSession, SessionManager
 
 HOST = '192.168.0.241'
 PORT = 1234
-HEADER_LENGTH = 10
 MAX_LOBBY_SIZE = 6
+MAX_LOBBIES = 500  # Lobbies open at once - a new one is opened whenever all are full
+OUTBOUND_QUEUE_SIZE = 256  # Frames waiting to be written to a client
+
+# What happens to a frame for a client whose outbound queue is full
+DROP = 'drop'  # The frame is dropped - the client misses the message
+COALESCE = 'coalesce'  # The frame replaces a queued one with the same key (e.g. an older lobby state), else DISCONNECT
+DISCONNECT = 'disconnect'  # The client is disconnected
+SLOW_CONSUMER_POLICY = COALESCE
+
+AI_NICKNAME = 'Engine'  # Opponent in the games against the engine, not available to clients
+AI_WORKERS = 2  # Engine processes shared by all games against the engine
+# Search budgets of the engine's moves by level
+AI_BUDGETS = [GameBudget(move_time=0.2, nodes=1000), GameBudget(move_time=0.5, nodes=5000),
+              GameBudget(move_time=1.0, nodes=20000), GameBudget(move_time=2.0, nodes=60000)]
+
+
+class ClientConnection:
+    """
+    Socket of a client with a bounded queue of outgoing frames, written by a thread of its own. Sending to a client
+    only queues the frame, so a client that does not read never blocks the thread which sends to it.
+    """
+    def __init__(self, client: socket.socket, nickname: str, capacity: int = OUTBOUND_QUEUE_SIZE,
+                 policy: str = SLOW_CONSUMER_POLICY):
+        self.client = client
+        self.nickname = nickname
+        self.capacity = capacity
+        self.policy = policy
+        self.queue: Deque[Tuple[Union[str, None], bytes]] = deque()  # (key, frame)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0  # Frames lost to the slow consumer policy
+        self.writer_thread = threading.Thread(target=self.write, daemon=True)
+
+    def start(self) -> None:
+        self.writer_thread.start()
+
+    def send(self, frame: bytes, key: Union[str, None] = None) -> bool:
+        """
+        Queues an encoded frame. The same frame object may be queued to many clients.
+
+        :param key: frames with the same key replace each other when the queue is full, None - the frame is unique
+        :return: False if the frame was dropped or the client was disconnected
+        """
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.queue) >= self.capacity:
+                if self.policy == DROP:
+                    self.dropped += 1
+                    return False
+                if self.policy == COALESCE and key is not None:
+                    for index, (queued_key, _) in enumerate(self.queue):
+                        if queued_key == key:
+                            del self.queue[index]
+                            self.queue.append((key, frame))
+                            self.dropped += 1
+                            return True
+                print(f'{self.nickname} does not read its messages')
+                self.close()
+                return False
+            self.queue.append((key, frame))
+            self.condition.notify()
+            return True
+
+    def write(self) -> None:
+        """
+        Writes queued frames until the connection is closed.
+        """
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                _, frame = self.queue.popleft()
+            try:
+                self.client.sendall(frame)
+            except OSError:
+                self.close()
+                return
+
+    def close(self) -> None:
+        """
+        Stops the writer and shuts the socket down, which ends the client's handler too.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify()
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 
 class Server:
@@ -15,46 +114,137 @@ class Server:
         self.server.bind((HOST, PORT))
         self.server.listen()
 
-        self.clients: List[Tuple[socket.socket, str]] = list()
+        self.clients: Dict[str, ClientConnection] = dict()  # nickname -> connection, in joining order
+        self.clients_lock = threading.Lock()
+        self.lobbies = LobbyManager(MAX_LOBBY_SIZE, MAX_LOBBIES, on_change=self.on_lobby_change)
+        self.sessions = SessionManager(on_move=self.on_move)
+        self.ai_pool = AiPool(self.on_ai_move, AI_WORKERS)
 
-    def broadcast(self, message: Dict) -> None:
+    def broadcast(self, lobby: Lobby, message: Dict, key: Union[str, None] = None) -> None:
         """
-        Broadcasts message to all clients.
+        Broadcasts message to the members of the lobby. The message is encoded once and the same frame is queued to
+        every member.
 
+        :param lobby:
         :param message:
+        :param key: coalescing key of the message, see ClientConnection.send
         """
-        for client in self.clients:
-            Server.send_object_message(client[0], message)
+        self.send_to(self.lobbies.members(lobby), message, key)
 
-    @staticmethod
-    def receive_object_message(client: socket.socket) -> Union[Dict, None]:
+    def on_lobby_change(self, lobby: Lobby, nickname: str, joined: bool) -> None:
         """
-        Receives an object message from a client.
+        Sends the change of the lobby to its players, and the whole lobby to the player who has joined it. Called by the
+        lobby manager in the order of the changes, so the versions of the changes reach a client in order.
+        """
+        if joined:
+            self.send_lobby(lobby, nickname)
+            self.send_to([member for member in lobby.members if member != nickname],
+                         {'JOINED': {'version': lobby.version, 'player': nickname}})
+        else:
+            self.send_to(lobby.members, {'LEFT': {'version': lobby.version, 'player': nickname}})
 
-        :param client: socket
-        :return: dictionary with encoded package header and decoded message
+    def send_lobby(self, lobby: Lobby, nickname: str) -> None:
+        """
+        Sends the whole lobby to the player. Only the newest state matters, so a slow client gets it instead of older
+        ones. Must be called under the lock of the lobby manager.
+        """
+        self.send_to([nickname], {'LOBBY': {'name': lobby.name, 'version': lobby.version,
+                                            'players': list(lobby.members)}}, key='LOBBY')
+
+    def send_to(self, nicknames: Iterable[str], message: Dict, key: Union[str, None] = None) -> bool:
+        """
+        Sends message to the given clients. The message is encoded once.
+
+        :param key: coalescing key of the message, see ClientConnection.send
+        :return: True if any of the clients is connected
+        """
+        frame = protocol.encode(message)
+        with self.clients_lock:
+            connections = [self.clients[nickname] for nickname in nicknames if nickname in self.clients]
+        for connection in connections:
+            connection.send(frame, key)
+        return len(connections) > 0
+
+    def change_lobby(self, connection: ClientConnection, name: str, create: bool = False) -> None:
+        """
+        Moves the client to another lobby. The players of both lobbies are updated by on_lobby_change.
+
+        :param name: name of the lobby, '' - any lobby with a free place, or a new lobby named by the server if create
+        :param create: if True, the lobby is opened first
+        """
+        nickname = connection.nickname
+        previous = self.lobbies.lobby_of(nickname)
+        if create:
+            lobby = self.lobbies.create_and_join(nickname, name)
+        else:
+            lobby = self.lobbies.join(nickname, name)
+        if lobby is None:
+            connection.send(protocol.encode({'NO_SPACE': ''}))
+        elif lobby is previous:  # Nothing has changed, the client gets its lobby anyway
+            self.lobbies.snapshot(nickname, lambda lobby: self.send_lobby(lobby, nickname))
+
+    def send_game_end(self, session: GameSession) -> None:
+        self.send_to(session.recipients(), {'END': {'game': session.game_id, 'result': session.result}})
+        if AI_NICKNAME in (session.white, session.black):
+            self.ai_pool.remove_game(session.game_id)
+
+    def make_move(self, nickname: str, game_id: int, move_id: int) -> bool:
+        """
+        Plays the move in the game. The move is sent by on_move.
+
+        :return: True if the move was applied
+        """
+        session, accepted = self.sessions.play(nickname, game_id, move_id)
+        if accepted and session.result is not None:
+            self.send_game_end(session)
+        return accepted
+
+    def start_ai_game(self, nickname: str, color: str, level: int) -> None:
+        """
+        Starts a game of the player against the engine.
+
+        :param color: 'w' or 'b' - color of the player
+        :param level: 1 to len(AI_BUDGETS) - search budget of the engine
+        """
+        white, black = (nickname, AI_NICKNAME) if color == 'w' else (AI_NICKNAME, nickname)
+        session = self.sessions.start(white, black)
+        self.ai_pool.add_game(session.game_id, AI_BUDGETS[min(max(level, 1), len(AI_BUDGETS)) - 1])
+        self.send_to([nickname], {'START': {'game': session.game_id, 'white': session.white, 'black': session.black,
+                                            'fen': session.fen}})
+        if white == AI_NICKNAME:
+            self.ai_pool.request(session.game_id, session.fen)
+
+    def on_move(self, session: GameSession, move_id: int) -> None:
+        """
+        Sends the move to the players and to the spectators - one frame shared by all spectators. Called by the session
+        manager in the order of the moves.
+        """
+        self.send_to((session.white, session.black), {'MOV': {'game': session.game_id, 'move': move_id}})
+        if session.spectators:
+            self.send_to(session.spectators, {'MOVED': {'game': session.game_id, 'ply': session.ply(),
+                                                         'move': move_id}})
+        if session.result is None and session.player_to_move() == AI_NICKNAME:
+            self.ai_pool.request(session.game_id, session.fen)
+
+    def on_ai_move(self, game_id: int, move_id: int) -> None:
+        self.make_move(AI_NICKNAME, game_id, move_id)
+
+    def send_game(self, session: GameSession, nickname: str) -> None:
         """
-        message_header = client.recv(HEADER_LENGTH)
-        if not message_header:
-            return None
-        message_length = int(message_header.decode('utf-8').strip())
-        data = pickle.loads(client.recv(message_length))
-        if not data:
-            return None
-        return {'header': message_header, 'data': data}
+        Sends the game as it is now to a new spectator.
+        """
+        self.send_to([nickname], {'GAME': {'game': session.game_id, 'white': session.white, 'black': session.black,
+                                           'fen': session.fen, 'moves': session.ply()}})
 
     @staticmethod
     def send_object_message(client: socket.socket, message_object: Dict) -> None:
         """
-        Sends message object (dictionary) preceded with header which has const length and info about the length of
-        a message.
+        Sends message object (dictionary) as a frame of the protocol.
 
         :param client: socket
-        :param message_object: for example: {'MSG': 'Hello World'}
+        :param message_object: for example: {'NICK': 'Patryk'}
         """
-        pickled_message_object = pickle.dumps(message_object)
-        message_header = bytes(f'{len(pickled_message_object):<{HEADER_LENGTH}}', 'utf-8')
-        client.send(message_header + pickled_message_object)
+        client.sendall(protocol.encode(message_object))
 
     def receive(self) -> None:
         """
@@ -65,65 +255,110 @@ class Server:
             print(f'Connected with {address}')
             nickname = None
             try:
-                if len(self.clients) >= MAX_LOBBY_SIZE:
+                if self.lobbies.is_full():
                     Server.send_object_message(client_socket, {'NO_SPACE': ''})
                 else:
                     Server.send_object_message(client_socket, {'NICK': ''})
-                    message = Server.receive_object_message(client_socket)
+                    reader = FrameReader(client_socket)
+                    message = reader.read_message()
                     if message is not None:
-                        message_header = list(message['data'].keys())[0]
+                        message_header = list(message.keys())[0]
                         if message_header == 'NICK':
-                            nickname = message['data'][message_header]
-                            if nickname in [client[1] for client in self.clients]:
+                            nickname = message[message_header]
+                            if nickname in self.clients or nickname == AI_NICKNAME:
                                 self.send_object_message(client_socket, {'NICK_IN_USE': ''})
                             else:
-                                self.send_object_message(client_socket, {'OK': ''})
-                                self.clients.append((client_socket, nickname))
-                                print(f'{nickname} joined')
-
-                                # Broadcast lobby players state
-                                self.broadcast({'LOBBY': [client[1] for client in self.clients]})
+                                # Connected before joining, so that its lobby is queued to it - but written after OK
+                                connection = ClientConnection(client_socket, nickname)
+                                with self.clients_lock:
+                                    self.clients[nickname] = connection
+                                lobby = self.lobbies.join(nickname)
+                                if lobby is None:  # All lobbies filled up meanwhile
+                                    with self.clients_lock:
+                                        del self.clients[nickname]
+                                    self.send_object_message(client_socket, {'NO_SPACE': ''})
+                                else:
+                                    self.send_object_message(client_socket, {'OK': ''})
+                                    connection.start()
+                                    print(f'{nickname} joined {lobby.name}')
 
-                                thread = threading.Thread(target=self.handle, args=[client_socket, nickname])
-                                thread.start()
+                                    thread = threading.Thread(target=self.handle, args=[connection, reader])
+                                    thread.start()
                         else:
                             raise Exception('First message from client should have a nickname!')
             except Exception as e:
-                if nickname is not None:  # Exception occurred after appending socket and nickname to self.clients
-                    self.clients.remove((client_socket, nickname))
-                    # Broadcast lobby players state
-                    self.broadcast({'LOBBY': [client[1] for client in self.clients]})
                 client_socket.close()
                 print(e)
 
-    def handle(self, client: socket.socket, nickname: str) -> None:
+    def handle(self, connection: ClientConnection, reader: FrameReader) -> None:
         """
         Deals with communication with a client.
 
-        :param client: socket
-        :param nickname:
+        :param connection: connection of the client
+        :param reader: frame reader of the socket
         """
-        first_iter = True
+        nickname = connection.nickname
         while True:
             try:
-                message = Server.receive_object_message(client)
-                if message is not None:
-                    message_header = list(message['data'].keys())[0]
-                    if message_header == 'MSG':
-                        self.broadcast({'MSG': {'author': nickname, 'text': message['data'][message_header]}})
-                        print(f'Received message from {nickname}:\n{message["data"][message_header]}')
+                message = reader.read_message()
+                if message is None:
+                    raise Exception(f'{nickname} disconnected')
+                message_header = list(message.keys())[0]
+                if message_header == 'MSG':  # The author is the sender, whatever it claims
+                    text = message[message_header]['text']
+                    self.broadcast(self.lobbies.lobby_of(nickname), {'MSG': {'author': nickname, 'text': text}})
+                    print(f'Received message from {nickname}:\n{text}')
+
+                elif message_header == 'MOV':
+                    game_id, move_id = message[message_header]['game'], message[message_header]['move']
+                    if not self.make_move(nickname, game_id, move_id):
+                        connection.send(protocol.encode({'ILLEGAL': message[message_header]}))
+
+                elif message_header == 'INVITE':
+                    invited = message[message_header]
+                    if invited != nickname and invited in self.clients:
+                        self.sessions.invite(nickname, invited)  # Before the invited player can accept
+                        self.send_to([invited], {'INVITE': nickname})
 
-                    elif message_header == 'MOV':
-                        pass
+                elif message_header == 'ACCEPT':
+                    session = self.sessions.accept(nickname, message[message_header])
+                    if session is not None:
+                        self.send_to(session.recipients(), {'START': {'game': session.game_id, 'white': session.white,
+                                                                      'black': session.black, 'fen': session.fen}})
+                        print(f'Game {session.game_id} started: {session.white} - {session.black}')
 
-                    else:
-                        raise Exception('Undefined message header received!')
+                elif message_header == 'LIST':
+                    names, sizes = self.lobbies.list()
+                    connection.send(protocol.encode({'LOBBIES': {'names': names, 'sizes': sizes}}))
+
+                elif message_header in ('JOIN', 'CREATE'):
+                    self.change_lobby(connection, message[message_header], create=message_header == 'CREATE')
+
+                elif message_header == 'AI':
+                    self.start_ai_game(nickname, message[message_header]['color'], message[message_header]['level'])
+
+                elif message_header == 'WATCH':
+                    game_id = message[message_header]
+                    if not self.sessions.watch(nickname, game_id, lambda session: self.send_game(session, nickname)):
+                        connection.send(protocol.encode({'END': {'game': game_id, 'result': '*'}}))
+
+                elif message_header == 'UNWATCH':
+                    self.sessions.unwatch(nickname, message[message_header])
+
+                elif message_header == 'SYNC':  # The client has missed a change of its lobby
+                    self.lobbies.snapshot(nickname, lambda lobby: self.send_lobby(lobby, nickname))
+
+                else:
+                    raise Exception('Undefined message header received!')
 
             except Exception as e:
-                self.clients.remove((client, nickname))
-                client.close()
-                # Broadcast lobby players state
-                self.broadcast({'LOBBY': [client[1] for client in self.clients]})
+                self.lobbies.leave(nickname)  # Before the nickname is free to be taken again
+                with self.clients_lock:
+                    del self.clients[nickname]
+                connection.close()
+                connection.client.close()
+                for session in self.sessions.leave(nickname):  # The opponents win
+                    self.send_game_end(session)
                 print(e)
                 break
 
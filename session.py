@@ -0,0 +1,212 @@
+"""
+Online games hosted by the server. The server is the authority - a move is applied only if it is legal in the
+session's position and made by the player to move, and then sent to both players and the spectators.
+
+A session keeps only the current position as FEN and its moves as two bytes each (Move.move_id), so tens of thousands
+of games fit in one process. GameStates are kept only for the most recently active games, so a move of a game in
+progress is checked without setting up its position and generating its moves again.
+
+Spectators get the current position when they start watching and then only the moves. Both are passed to the server
+under the lock of the manager, so a spectator never gets a move before the position or one already in it.
+"""
+import itertools
+import struct
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Set, Tuple, Union
+from engine import GameState, START_FEN
+
+MOVE = struct.Struct('!H')  # Move.move_id of a move in GameSession.moves
+LIVE_POSITIONS = 1024  # Positions of the most recently active sessions kept by SessionManager
+
+
+class Position:
+    """
+    GameState of a session together with its valid moves.
+    """
+    __slots__ = ('game_state', 'valid_moves')
+
+    def __init__(self, fen: str):
+        self.game_state = GameState(fen)
+        self.valid_moves = self.game_state.get_valid_moves(expand_promotions=True)
+
+
+class GameSession:
+    __slots__ = ('game_id', 'white', 'black', 'spectators', 'fen', 'moves', 'result')
+
+    def __init__(self, game_id: int, white: str, black: str, fen: str = START_FEN):
+        self.game_id = game_id
+        self.white = white
+        self.black = black
+        self.spectators: Dict[str, None] = dict()  # Nicknames in the order they started watching
+        self.fen = fen  # Current position
+        self.moves = bytearray()  # Moves played so far
+        self.result: Union[str, None] = None  # '1-0', '0-1' or '1/2-1/2' when the game is over
+
+    def player_to_move(self) -> str:
+        return self.white if self.fen.split()[1] == 'w' else self.black
+
+    def recipients(self) -> List[str]:
+        """
+        Nicknames of everyone following the game.
+        """
+        return [self.white, self.black] + list(self.spectators)
+
+    def ply(self) -> int:
+        """
+        :return: number of moves played
+        """
+        return len(self.moves) // MOVE.size
+
+    def play(self, nickname: str, move_id: int, position: Union[Position, None] = None) -> bool:
+        """
+        Applies the move if the player may make it. Sets the result if the move ends the game.
+
+        :param position: position of the session, updated by the move - set up from the FEN if None
+        :return: True if the move was applied
+        """
+        if self.result is not None or nickname != self.player_to_move():
+            return False
+        position = position if position is not None else Position(self.fen)
+        move = next((move for move in position.valid_moves if move.move_id == move_id), None)
+        if move is None:
+            return False
+        game_state = position.game_state
+        game_state.make_move(move)
+        self.moves += MOVE.pack(move_id)
+        self.fen = game_state.get_fen()
+        position.valid_moves = game_state.get_valid_moves(expand_promotions=True)  # Detects the end of the game too
+        if game_state.check_mate:
+            self.result = '0-1' if game_state.white_to_move else '1-0'
+        elif game_state.stale_mate:
+            self.result = '1/2-1/2'
+        return True
+
+    def resign(self, nickname: str) -> None:
+        self.result = '0-1' if nickname == self.white else '1-0'
+
+
+class SessionManager:
+    """
+    Invitations and sessions of the server. Thread safe - the threaded server calls it from every client's thread.
+    """
+    def __init__(self, on_move: Union[Callable[[GameSession, int], None], None] = None):
+        """
+        :param on_move: called with (session, move id) after every move applied, under the lock of the manager - so
+                        moves are passed on in the order they were played. Must not block.
+        """
+        self.on_move = on_move
+        self.sessions: Dict[int, GameSession] = dict()
+        self.player_games: Dict[str, Set[int]] = dict()  # nickname -> ids of the sessions the player plays in
+        self.watched_games: Dict[str, Set[int]] = dict()  # nickname -> ids of the sessions the player watches
+        self.invitations: Set[Tuple[str, str]] = set()  # (inviting, invited)
+        self.positions: OrderedDict[int, Position] = OrderedDict()  # game id -> position, least recently used first
+        self.game_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def invite(self, inviting: str, invited: str) -> None:
+        with self.lock:
+            self.invitations.add((inviting, invited))
+
+    def accept(self, invited: str, inviting: str) -> Union[GameSession, None]:
+        """
+        Starts the game of an invitation. The inviting player plays white.
+
+        :return: the new session, None if there was no such invitation
+        """
+        with self.lock:
+            if (inviting, invited) not in self.invitations:
+                return None
+            self.invitations.discard((inviting, invited))
+            return self._start(inviting, invited)
+
+    def start(self, white: str, black: str) -> GameSession:
+        """
+        Starts a game without an invitation.
+        """
+        with self.lock:
+            return self._start(white, black)
+
+    def _start(self, white: str, black: str) -> GameSession:
+        session = GameSession(next(self.game_ids), white, black)
+        self.sessions[session.game_id] = session
+        for nickname in (white, black):
+            self.player_games.setdefault(nickname, set()).add(session.game_id)
+        return session
+
+    def play(self, nickname: str, game_id: int, move_id: int) -> Tuple[Union[GameSession, None], bool]:
+        """
+        :return: (session or None if there is no such game, True if the move was applied)
+        """
+        with self.lock:
+            session = self.sessions.get(game_id)
+            if session is None:
+                return None, False
+            position = self.positions.pop(game_id, None)
+            if position is None:
+                position = Position(session.fen)
+            accepted = session.play(nickname, move_id, position)
+            if accepted and self.on_move is not None:
+                self.on_move(session, move_id)
+            if session.result is not None:
+                self.end(session)
+            else:
+                self.positions[game_id] = position
+                if len(self.positions) > LIVE_POSITIONS:
+                    self.positions.popitem(last=False)
+            return session, accepted
+
+    def watch(self, nickname: str, game_id: int, send: Callable[[GameSession], None]) -> bool:
+        """
+        Adds the player to the spectators of the game and calls send with the session under the lock, so that no move
+        is passed on while the position is being sent.
+
+        :return: False if there is no such game
+        """
+        with self.lock:
+            session = self.sessions.get(game_id)
+            if session is None:
+                return False
+            session.spectators[nickname] = None
+            self.watched_games.setdefault(nickname, set()).add(game_id)
+            send(session)
+            return True
+
+    def unwatch(self, nickname: str, game_id: int) -> None:
+        with self.lock:
+            session = self.sessions.get(game_id)
+            if session is not None:
+                session.spectators.pop(nickname, None)
+            self._forget(self.watched_games, nickname, game_id)
+
+    def end(self, session: GameSession) -> None:
+        del self.sessions[session.game_id]
+        self.positions.pop(session.game_id, None)
+        for nickname in (session.white, session.black):
+            self._forget(self.player_games, nickname, session.game_id)
+        for nickname in session.spectators:
+            self._forget(self.watched_games, nickname, session.game_id)
+
+    @staticmethod
+    def _forget(games: Dict[str, Set[int]], nickname: str, game_id: int) -> None:
+        player_games = games.get(nickname)
+        if player_games is not None:
+            player_games.discard(game_id)
+            if not player_games:
+                del games[nickname]
+
+    def leave(self, nickname: str) -> List[GameSession]:
+        """
+        Forgets the player's invitations and the games it watches, and resigns its games.
+
+        :return: sessions ended by the player leaving
+        """
+        with self.lock:
+            self.invitations = {invitation for invitation in self.invitations if nickname not in invitation}
+            for game_id in self.watched_games.pop(nickname, ()):
+                self.sessions[game_id].spectators.pop(nickname, None)
+            ended = [self.sessions[game_id] for game_id in self.player_games.get(nickname, ())]
+            for session in ended:
+                session.resign(nickname)
+                self.end(session)
+            return ended
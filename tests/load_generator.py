@@ -0,0 +1,315 @@
+"""
+Load generator for the lobby server. Simulated clients speaking the protocol of player.Player are run as asyncio tasks
+of one process, so thousands of them fit on one machine. They join at a given rate, chat, play games against each
+other (random legal moves), leave and are replaced, and the generator reports:
+
+    - connection rate and failed connections
+    - messages sent and frames received per second
+    - latency of chat broadcasts (from sending a message to every member of the lobby receiving it) and of moves (from
+      sending a move to receiving it back from the server) - p50, p99 and max
+
+Run from the root of the repository. The server is started in a process of its own, so that it does not share the
+interpreter with the clients:
+
+    python -m tests.load_generator --server threaded --clients 500 --duration 30
+    python -m tests.load_generator --server async --clients 5000 --rate 500 --chat-interval 10
+
+or pointed at a running server with --server none --host <host> --port <port>.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import subprocess
+import sys
+import time
+from typing import Dict, List, Set, Union
+import protocol
+from engine import GameState
+
+try:
+    import resource
+except ImportError:  # Windows - the default limit of open files is used
+    resource = None
+
+HOST = '127.0.0.1'
+PORT = 12345
+CONNECT_TIMEOUT = 10  # Seconds a client waits to be let in
+SERVER_START_TIME = 1.0  # Seconds given to a started server to listen
+
+# Servers started by --server, with the host, port and number of lobbies filled in
+SERVER_COMMANDS = {
+    'threaded': 'import server; server.HOST, server.PORT, server.MAX_LOBBIES = {host!r}, {port}, {lobbies}; '
+                'server.main()',
+    'async': 'import asyncio, async_server; '
+             'asyncio.run(async_server.AsyncServer({host!r}, {port}, max_lobbies={lobbies}).serve_forever())',
+}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.left = 0
+        self.sent = 0
+        self.received = 0
+        self.chat_latencies: List[float] = []  # Seconds, one per message received by one client
+        self.move_latencies: List[float] = []
+        self.games = 0
+        self.illegal_moves = 0
+
+    def latency_report(self, name: str, latencies: List[float]) -> str:
+        return f'{name} latency (ms): p50 {percentile(latencies, 0.5) * 1000:.1f}  ' \
+               f'p99 {percentile(latencies, 0.99) * 1000:.1f}  max {max(latencies, default=0) * 1000:.1f}  ' \
+               f'({len(latencies)} samples)'
+
+
+class SimulatedClient:
+    def __init__(self, nickname: str, stats: Stats, move_interval: float):
+        """
+        :param move_interval: seconds the client waits before its moves
+        """
+        self.nickname = nickname
+        self.stats = stats
+        self.move_interval = move_interval
+        self.reader: Union[asyncio.StreamReader, None] = None
+        self.writer: Union[asyncio.StreamWriter, None] = None
+        self.game_id: Union[int, None] = None
+        self.game_state: Union[GameState, None] = None
+        self.color = 'w'
+        self.move_sent_time = 0.0
+        self.tasks: Set[asyncio.Task] = set()  # Running tasks of the client
+
+    async def connect(self, host: str, port: int) -> bool:
+        """
+        Joins the server the way Player does.
+
+        :return: True if the client was let in
+        """
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+            message = await asyncio.wait_for(protocol.read_message(self.reader), CONNECT_TIMEOUT)
+            if message is None or 'NICK' not in message:
+                raise ConnectionError(f'Not asked for a nickname: {message}')
+            self.send({'NICK': self.nickname})
+            message = await asyncio.wait_for(protocol.read_message(self.reader), CONNECT_TIMEOUT)
+            if message is None or 'OK' not in message:
+                raise ConnectionError(f'Not let in: {message}')
+        except (OSError, asyncio.TimeoutError, ConnectionError, protocol.ProtocolError):
+            self.stats.failed += 1
+            if self.writer is not None:
+                self.writer.close()
+            return False
+        self.stats.connected += 1
+        self.start_task(self.receive())
+        return True
+
+    def start_task(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def send(self, message: Dict) -> None:
+        self.writer.write(protocol.encode(message))
+        self.stats.sent += 1
+
+    async def receive(self) -> None:
+        try:
+            while True:
+                message = await protocol.read_message(self.reader)
+                if message is None:
+                    return
+                self.stats.received += 1
+                message_header = list(message.keys())[0]
+                if message_header == 'MSG':
+                    self.stats.chat_latencies.append(time.perf_counter() - float(message['MSG']['text']))
+                elif message_header == 'INVITE':
+                    if self.game_id is None:
+                        self.send({'ACCEPT': message['INVITE']})
+                elif message_header == 'START':
+                    self.start_game(message['START'])
+                elif message_header == 'MOV' and message['MOV']['game'] == self.game_id:
+                    self.play(message['MOV']['move'])
+                elif message_header == 'ILLEGAL':
+                    self.stats.illegal_moves += 1
+                elif message_header == 'END' and message['END']['game'] == self.game_id:
+                    self.game_id = self.game_state = None
+        except (OSError, protocol.ProtocolError):
+            pass
+
+    def start_game(self, start: Dict) -> None:
+        self.game_id = start['game']
+        self.game_state = GameState(start['fen'])
+        self.color = 'w' if start['white'] == self.nickname else 'b'
+        if self.color == 'w':
+            self.stats.games += 1
+            self.start_task(self.make_move(0))
+
+    def play(self, move_id: int) -> None:
+        """
+        Applies a move of the game, and answers it if it is the client's turn.
+        """
+        move = next((move for move in self.game_state.get_valid_moves(expand_promotions=True)
+                     if move.move_id == move_id), None)
+        if move is None:
+            return
+        if (self.color == 'w') == self.game_state.white_to_move:  # Own move sent back
+            self.stats.move_latencies.append(time.perf_counter() - self.move_sent_time)
+        self.game_state.make_move(move)
+        if (self.color == 'w') == self.game_state.white_to_move:
+            self.start_task(self.make_move(self.move_interval))
+
+    async def make_move(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        if self.game_state is None or self.writer.is_closing():
+            return
+        moves = self.game_state.get_valid_moves(expand_promotions=True)
+        if moves:
+            self.move_sent_time = time.perf_counter()
+            self.send({'MOV': {'game': self.game_id, 'move': random.choice(moves).move_id}})
+
+    async def chat(self, interval: float) -> None:
+        """
+        Sends a message at random times, on average every interval seconds. The text is the time of sending.
+        """
+        while not self.writer.is_closing():
+            await asyncio.sleep(random.expovariate(1 / interval))
+            self.send({'MSG': {'author': self.nickname, 'text': f'{time.perf_counter():.6f}'}})
+
+    async def close(self) -> None:
+        for task in list(self.tasks):
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+
+class LoadGenerator:
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.stats = Stats()
+        self.clients: List[SimulatedClient] = []
+        self.client_numbers = itertools.count()
+
+    async def add_client(self) -> Union[SimulatedClient, None]:
+        client = SimulatedClient(f'load{next(self.client_numbers)}', self.stats, self.options.move_interval)
+        if not await client.connect(self.options.host, self.options.port):
+            return None
+        self.clients.append(client)
+        if self.options.chat_interval > 0:
+            client.start_task(client.chat(self.options.chat_interval))
+        return client
+
+    async def ramp_up(self) -> float:
+        """
+        Connects the clients at the given rate.
+
+        :return: seconds it took
+        """
+        start = time.perf_counter()
+        pending = []
+        for i in range(self.options.clients):
+            pending.append(asyncio.create_task(self.add_client()))
+            if self.options.rate > 0:
+                await asyncio.sleep(max(0.0, start + (i + 1) / self.options.rate - time.perf_counter()))
+        await asyncio.gather(*pending)
+        return time.perf_counter() - start
+
+    def start_games(self) -> None:
+        """
+        Pairs clients into games - the first of a pair invites the second.
+        """
+        players = random.sample(self.clients, int(len(self.clients) * self.options.games) // 2 * 2)
+        for inviting, invited in zip(players[::2], players[1::2]):
+            inviting.send({'INVITE': invited.nickname})
+
+    async def churn(self) -> None:
+        """
+        Replaces clients - a random client leaves and a new one joins - at the given rate.
+        """
+        while True:
+            await asyncio.sleep(random.expovariate(self.options.churn))
+            if self.clients:
+                client = self.clients.pop(random.randrange(len(self.clients)))
+                await client.close()
+                self.stats.left += 1
+            await self.add_client()
+
+    async def run(self) -> None:
+        ramp_up_time = await self.ramp_up()
+        print(f'Connected {self.stats.connected} clients in {ramp_up_time:.2f} s '
+              f'({self.stats.connected / ramp_up_time:.0f} connections/s), {self.stats.failed} failed')
+
+        self.start_games()
+        sent, received = self.stats.sent, self.stats.received
+        churn_task = asyncio.create_task(self.churn()) if self.options.churn > 0 else None
+        start = time.perf_counter()
+        await asyncio.sleep(self.options.duration)
+        elapsed = time.perf_counter() - start
+        sent, received = self.stats.sent - sent, self.stats.received - received
+        if churn_task is not None:
+            churn_task.cancel()
+
+        print(f'Steady state for {elapsed:.1f} s: {sent / elapsed:.0f} messages sent/s, '
+              f'{received / elapsed:.0f} frames received/s')
+        print(f'{self.stats.games} games, {len(self.stats.move_latencies)} moves, '
+              f'{self.stats.illegal_moves} rejected; {self.stats.left} clients replaced')
+        print(self.stats.latency_report('Chat broadcast', self.stats.chat_latencies))
+        print(self.stats.latency_report('Move', self.stats.move_latencies))
+        await asyncio.gather(*(client.close() for client in self.clients))
+
+
+def start_server(options: argparse.Namespace) -> subprocess.Popen:
+    command = SERVER_COMMANDS[options.server].format(host=options.host, port=options.port, lobbies=options.lobbies)
+    process = subprocess.Popen([sys.executable, '-c', command], stdout=subprocess.DEVNULL)
+    time.sleep(SERVER_START_TIME)
+    return process
+
+
+def raise_open_files_limit() -> None:
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Load test of the lobby server with simulated clients.')
+    parser.add_argument('--server', choices=['threaded', 'async', 'none'], default='threaded',
+                        help='server started for the test, none - test a running server')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--lobbies', type=int, default=2000, help='lobbies of a started server')
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=200, help='connections per second, 0 - all at once')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of chatting and playing after ramp up')
+    parser.add_argument('--chat-interval', type=float, default=5, help='mean seconds between messages of a client, '
+                                                                        '0 - no chat')
+    parser.add_argument('--games', type=float, default=0.2, help='fraction of the clients playing games')
+    parser.add_argument('--move-interval', type=float, default=1, help='seconds a player thinks')
+    parser.add_argument('--churn', type=float, default=0, help='clients replaced per second')
+    parser.add_argument('--seed', type=int, default=None)
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    raise_open_files_limit()
+    server_process = start_server(options) if options.server != 'none' else None
+    try:
+        asyncio.run(LoadGenerator(options).run())
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+
+if __name__ == '__main__':
+    main()
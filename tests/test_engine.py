@@ -0,0 +1,62 @@
+"""
+Checks of the incremental zobrist and pawn keys - after every make and undo they must equal the keys computed from
+scratch. Run from the root of the repository:
+
+    python -m pytest tests/test_engine.py
+"""
+import pytest
+from engine import GameState
+
+# Position and a move of the kind whose keys are updated separately
+POSITIONS = [
+    ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', 'e1g1'),  # Castling king side
+    ('r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1', 'e8c8'),  # Castling queen side
+    ('4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1', 'e5d6'),  # En passant
+    ('4k3/8/8/8/3Pp3/8/8/4K3 b - d3 0 1', 'e4d3'),
+    ('4k3/1P6/8/8/8/8/8/4K3 w - - 0 1', 'b7b8q'),  # Promotion
+    ('2r1k3/1P6/8/8/8/8/8/4K3 w - - 0 1', 'b7c8n'),  # Promotion with a capture
+    ('4k3/8/8/8/8/8/6p1/4K2R b K - 0 1', 'g2h1q'),  # Promotion capturing a rook which could castle
+]
+
+
+def assert_keys_consistent(game_state):
+    assert game_state.zobrist_key == game_state.compute_zobrist_key()
+    assert game_state.pawn_key == game_state.compute_pawn_key()
+
+
+@pytest.mark.parametrize('fen, notation', POSITIONS)
+def test_keys_after_make_and_undo(fen, notation):
+    game_state = GameState(fen)
+    keys = game_state.zobrist_key, game_state.pawn_key
+    move = game_state.get_move_from_notation(notation)
+    assert move is not None
+    game_state.make_move(move)
+    assert_keys_consistent(game_state)
+    for reply in game_state.get_valid_moves(expand_promotions=True):
+        game_state.make_move(reply)
+        assert_keys_consistent(game_state)
+        game_state.undo_move()
+    game_state.undo_move()
+    assert_keys_consistent(game_state)
+    assert (game_state.zobrist_key, game_state.pawn_key) == keys
+
+
+def test_keys_along_a_game():
+    game_state = GameState()
+    for notation in ['e2e4', 'd7d5', 'e4e5', 'f7f5', 'e5f6', 'g8h6', 'f6g7', 'e8f7', 'g7h8q', 'b8c6', 'g1f3', 'c8f5',
+                     'f1c4', 'd8d7', 'e1g1']:
+        move = game_state.get_move_from_notation(notation)
+        assert move is not None, notation
+        game_state.make_move(move)
+        assert_keys_consistent(game_state)
+    while game_state.move_log:
+        game_state.undo_move()
+        assert_keys_consistent(game_state)
+    assert game_state.zobrist_key == GameState().zobrist_key
+
+
+@pytest.mark.parametrize('fen', ['8/8/8/8/8/8/8/8 w - - 0 1', '4k3/8/8/8/8/8/8/8 w - - 0 1',
+                                 '4k3/8/8/8/8/8/8/3KK3 w - - 0 1'])
+def test_fen_without_one_king_per_side_is_rejected(fen):
+    with pytest.raises(ValueError):
+        GameState(fen)
@@ -0,0 +1,33 @@
+"""
+Checks of the limits of the parallel root search. Run from the root of the repository:
+
+    python -m pytest tests/test_parallel_search.py
+"""
+import time
+import pytest
+from engine import GameState
+from chess_ai import SearchLimits
+from parallel_search import ParallelSearch
+
+TIME_MARGIN = 0.15  # Seconds the search may take beyond its time limit - stopping the workers and collecting results
+
+
+@pytest.fixture(scope='module')
+def parallel_search():
+    with ParallelSearch(workers=2) as search:
+        search.search(GameState(), limits=SearchLimits(depth=1))  # Starts the worker processes
+        yield search
+
+
+def test_move_time_limits_the_whole_search(parallel_search):
+    start = time.perf_counter()
+    move = parallel_search.search(GameState(), limits=SearchLimits(depth=20, move_time=0.2))
+    elapsed = time.perf_counter() - start
+    assert move is not None
+    assert elapsed < 0.2 + TIME_MARGIN
+
+
+def test_nodes_limit_the_whole_search(parallel_search):
+    parallel_search.search(GameState(), limits=SearchLimits(depth=20, nodes=5000))
+    # Limits are checked every SearchEngine.CHECK_INTERVAL nodes by every root move search
+    assert parallel_search.nodes < 5000 + 64 * 20
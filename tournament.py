@@ -0,0 +1,329 @@
+"""
+Engine-vs-engine matches between two configurations of the AI. Games are played in parallel in a process pool, every
+opening of the suite twice with swapped colors, and judged by GameState. The match stops early when the sequential
+probability ratio test (SPRT) accepts one of its hypotheses.
+
+    python tournament.py --engine1 depth=3 --engine2 depth=3,bitbases=resources/bitbases.bin --games 2000 --pgn match.pgn
+
+An engine configuration is a comma separated list of options: depth, nodes, movetime (seconds), book, bitbases (paths
+to the files) and tt (transposition table size).
+"""
+import argparse
+import math
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple, Union
+from engine import GameState, START_FEN
+from chess_ai import ChessAi, SearchEngine, SearchLimits
+from book import OpeningBook
+from bitbases import Bitbases
+from pgn import move_to_san, read_games, san_to_move, write_game
+
+MAX_PLIES = 300  # Longer games are adjudicated as draws
+FIFTY_MOVE_PLIES = 100
+
+# Balanced openings - both colors are played from each of them
+OPENINGS = [
+    (START_FEN, 'e4 e5 Nf3 Nc6 Bb5 a6'.split()),  # Ruy Lopez
+    (START_FEN, 'e4 e5 Nf3 Nc6 Bc4 Bc5'.split()),  # Italian Game
+    (START_FEN, 'e4 e5 Nf3 Nc6 d4 exd4 Nxd4 Nf6'.split()),  # Scotch Game
+    (START_FEN, 'e4 e5 Nf3 Nf6 Nxe5 d6 Nf3 Nxe4'.split()),  # Petrov Defence
+    (START_FEN, 'e4 e5 Nc3 Nf6 f4 d5'.split()),  # Vienna Game
+    (START_FEN, 'e4 c5 Nf3 d6 d4 cxd4 Nxd4 Nf6 Nc3 a6'.split()),  # Sicilian Najdorf
+    (START_FEN, 'e4 c5 Nc3 Nc6 g3 g6'.split()),  # Closed Sicilian
+    (START_FEN, 'e4 e6 d4 d5 Nc3 Nf6'.split()),  # French Defence
+    (START_FEN, 'e4 c6 d4 d5 e5 Bf5'.split()),  # Caro-Kann Advance
+    (START_FEN, 'e4 d5 exd5 Qxd5 Nc3 Qa5'.split()),  # Scandinavian Defence
+    (START_FEN, 'e4 d6 d4 Nf6 Nc3 g6'.split()),  # Pirc Defence
+    (START_FEN, 'e4 g6 d4 Bg7 Nc3 d6'.split()),  # Modern Defence
+    (START_FEN, 'd4 d5 c4 e6 Nc3 Nf6'.split()),  # Queen's Gambit Declined
+    (START_FEN, 'd4 d5 c4 c6 Nf3 Nf6'.split()),  # Slav Defence
+    (START_FEN, 'd4 d5 c4 dxc4 e3 Nf6'.split()),  # Queen's Gambit Accepted
+    (START_FEN, 'd4 Nf6 c4 g6 Nc3 Bg7 e4 d6'.split()),  # King's Indian Defence
+    (START_FEN, 'd4 Nf6 c4 e6 Nc3 Bb4'.split()),  # Nimzo-Indian Defence
+    (START_FEN, 'd4 Nf6 c4 e6 Nf3 b6'.split()),  # Queen's Indian Defence
+    (START_FEN, 'd4 f5 g3 Nf6 Bg2 e6'.split()),  # Dutch Defence
+    (START_FEN, 'd4 d5 Bf4 Nf6 e3 c5'.split()),  # London System
+    (START_FEN, 'c4 e5 Nc3 Nf6 g3 d5'.split()),  # English Opening
+    (START_FEN, 'c4 c5 Nc3 Nc6 g3 g6'.split()),  # Symmetrical English
+    (START_FEN, 'Nf3 d5 g3 Nf6 Bg2 e6'.split()),  # Reti Opening
+    (START_FEN, 'd4 Nf6 Nf3 d5 e3 e6'.split()),  # Colle System
+]
+
+
+class EngineConfig:
+    def __init__(self, name: str, depth: int = ChessAi.DEPTH, nodes: Union[int, None] = None,
+                 move_time: Union[float, None] = None, book: Union[str, None] = None,
+                 bitbases: Union[str, None] = None, tt_size: int = 1_000_000):
+        self.name = name
+        self.depth = depth
+        self.nodes = nodes
+        self.move_time = move_time
+        self.book = book  # Path of an opening book
+        self.bitbases = bitbases  # Path of endgame bitbases
+        self.tt_size = tt_size
+
+    @staticmethod
+    def parse(name: str, text: str) -> 'EngineConfig':
+        """
+        Creates the configuration from text like 'depth=4,movetime=0.5,bitbases=resources/bitbases.bin'.
+        """
+        config = EngineConfig(name)
+        for option in filter(None, text.split(',')):
+            key, _, value = option.partition('=')
+            if key == 'depth':
+                config.depth = int(value)
+            elif key == 'nodes':
+                config.nodes = int(value)
+            elif key == 'movetime':
+                config.move_time = float(value)
+            elif key == 'book':
+                config.book = value
+            elif key == 'bitbases':
+                config.bitbases = value
+            elif key == 'tt':
+                config.tt_size = int(value)
+            else:
+                raise ValueError(f'Unknown engine option: {key}')
+        return config
+
+    def create_engine(self, seed: int) -> SearchEngine:
+        return SearchEngine(SearchLimits(self.depth, self.nodes, self.move_time), tt_size=self.tt_size, seed=seed,
+                            book=OpeningBook(self.book) if self.book else None,
+                            bitbases=Bitbases(self.bitbases) if self.bitbases else None)
+
+
+class Sprt:
+    """
+    Sequential probability ratio test of the Elo difference - H0: elo = elo0 against H1: elo = elo1. Uses the normal
+    approximation of the log-likelihood ratio with the variance of the game results measured so far.
+    """
+    MIN_VARIANCE = 0.05  # One-sided results (only wins or only losses) would have no variance and stop the test at once
+
+    def __init__(self, elo0: float = 0.0, elo1: float = 5.0, alpha: float = 0.05, beta: float = 0.05):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower_bound = math.log(beta / (1 - alpha))
+        self.upper_bound = math.log((1 - beta) / alpha)
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+
+    @property
+    def games(self) -> int:
+        return self.wins + self.draws + self.losses
+
+    def add(self, points: float) -> None:
+        """
+        :param points: 1 - win, 0.5 - draw, 0 - loss of the first engine
+        """
+        if points == 1:
+            self.wins += 1
+        elif points == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    def score_and_variance(self) -> Tuple[float, float]:
+        games = self.games
+        score = (self.wins + self.draws / 2) / games
+        variance = (self.wins * (1 - score) ** 2 + self.draws * (0.5 - score) ** 2 + self.losses * score ** 2) / games
+        return score, variance
+
+    def llr(self) -> float:
+        if not self.wins + self.losses:  # Only draws (or nothing) - no information about the difference yet
+            return 0.0
+        score, variance = self.score_and_variance()
+        variance = max(variance, Sprt.MIN_VARIANCE)
+        score0, score1 = Sprt.expected_score(self.elo0), Sprt.expected_score(self.elo1)
+        return self.games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance)
+
+    def status(self) -> Union[str, None]:
+        """
+        :return: 'H0' or 'H1' when the hypothesis is accepted, None while the test continues
+        """
+        llr = self.llr()
+        if llr <= self.lower_bound:
+            return 'H0'
+        if llr >= self.upper_bound:
+            return 'H1'
+        return None
+
+    def elo(self) -> Tuple[float, float]:
+        """
+        :return: Elo difference and the half width of its 95 % confidence interval
+        """
+        if not self.games:
+            return 0.0, 0.0
+        score, variance = self.score_and_variance()
+        margin = 1.96 * math.sqrt(variance / self.games)
+        elo = Sprt.score_to_elo(score)
+        return elo, (Sprt.score_to_elo(score + margin) - Sprt.score_to_elo(score - margin)) / 2
+
+    @staticmethod
+    def expected_score(elo: float) -> float:
+        return 1 / (1 + 10 ** (-elo / 400))
+
+    @staticmethod
+    def score_to_elo(score: float) -> float:
+        score = min(max(score, 1e-6), 1 - 1e-6)
+        return -400 * math.log10(1 / score - 1)
+
+
+def load_openings(path: str) -> List[Tuple[str, List[str]]]:
+    """
+    Reads an opening suite - a PGN file (moves of every game, from its 'FEN' header if it has one) or a file with one
+    FEN per line.
+
+    :return: list of (FEN, list of SAN moves)
+    """
+    with open(path, encoding='utf-8') as openings_file:
+        if path.lower().endswith('.pgn'):
+            return [(headers.get('FEN', START_FEN), sans) for headers, sans in read_games(openings_file)]
+        return [(line.strip(), []) for line in openings_file if line.strip() and not line.startswith('#')]
+
+
+def insufficient_material(game_state: GameState) -> bool:
+    """
+    Neither side can mate - bare kings or a single minor piece left.
+    """
+    pieces = [piece for piece in game_state.board.flatten().tolist() if piece != '--' and piece[1] != 'K']
+    return not pieces or (len(pieces) == 1 and pieces[0][1] in 'BN')
+
+
+def play_game(game_number: int, opening: Tuple[str, List[str]], white: EngineConfig, black: EngineConfig,
+              max_plies: int = MAX_PLIES) -> Dict:
+    """
+    Plays one game in a worker process.
+
+    :return: dictionary with 'result', 'termination', 'headers' and 'sans' of the game
+    """
+    fen, opening_sans = opening
+    game_state = GameState(fen)
+    sans = []
+    for san in opening_sans:
+        move = san_to_move(game_state, san)
+        if move is None:
+            raise ValueError(f'Illegal opening move {san} in {fen}')
+        sans.append(move_to_san(game_state, move))
+        game_state.make_move(move)
+
+    engines = {True: white.create_engine(seed=2 * game_number), False: black.create_engine(seed=2 * game_number + 1)}
+    positions = Counter([game_state.zobrist_key])
+    halfmove_clock = 0
+    while True:
+        valid_moves = game_state.get_valid_moves(expand_promotions=True)
+        if game_state.check_mate:
+            result, termination = ('0-1' if game_state.white_to_move else '1-0'), 'checkmate'
+            break
+        if game_state.stale_mate:
+            result, termination = '1/2-1/2', 'stalemate'
+            break
+        if positions[game_state.zobrist_key] >= 3:
+            result, termination = '1/2-1/2', 'threefold repetition'
+            break
+        if halfmove_clock >= FIFTY_MOVE_PLIES:
+            result, termination = '1/2-1/2', 'fifty-move rule'
+            break
+        if insufficient_material(game_state):
+            result, termination = '1/2-1/2', 'insufficient material'
+            break
+        if len(sans) >= max_plies:
+            result, termination = '1/2-1/2', 'adjudicated after the ply limit'
+            break
+
+        best_move = engines[game_state.white_to_move].search(game_state)
+        move = next(move for move in valid_moves if move.move_id == best_move.move_id)
+        sans.append(move_to_san(game_state, move))
+        game_state.make_move(move)
+        halfmove_clock = 0 if move.piece_moved[1] == 'P' or move.is_capture_move else halfmove_clock + 1
+        positions[game_state.zobrist_key] += 1
+
+    headers = {'Event': 'Engine match', 'Site': '?', 'Date': time.strftime('%Y.%m.%d'), 'Round': str(game_number + 1),
+               'White': white.name, 'Black': black.name, 'Result': result, 'Termination': termination}
+    if fen != START_FEN:
+        headers['SetUp'] = '1'
+        headers['FEN'] = fen
+    return {'result': result, 'termination': termination, 'headers': headers, 'sans': sans}
+
+
+def run_match(engine1: EngineConfig, engine2: EngineConfig, games: int,
+              openings: Union[List[Tuple[str, List[str]]], None] = None, workers: Union[int, None] = None,
+              pgn_path: Union[str, None] = None, sprt: Union[Sprt, None] = None, max_plies: int = MAX_PLIES) -> Sprt:
+    """
+    Plays the match and prints the standing after every game.
+
+    :param games: maximum number of games - fewer are played if the SPRT finishes earlier
+    :param openings: opening suite, OPENINGS if None
+    :param workers: number of processes, all cores if None
+    :param pgn_path: file the games are written to
+    :param sprt: test of the results of the first engine, if None all games are played
+    :return: the SPRT with the results
+    """
+    openings = openings if openings is not None else OPENINGS
+    stop_early = sprt is not None
+    sprt = sprt if sprt is not None else Sprt()
+    workers = workers if workers is not None else os.cpu_count()
+    pgn_file = open(pgn_path, 'w', encoding='utf-8') if pgn_path is not None else None
+    executor = ProcessPoolExecutor(max_workers=workers)
+    start = time.perf_counter()
+    try:
+        futures = {}
+        for game_number in range(games):
+            opening = openings[game_number // 2 % len(openings)]
+            engine1_white = game_number % 2 == 0  # Every opening is played with both colors
+            white, black = (engine1, engine2) if engine1_white else (engine2, engine1)
+            future = executor.submit(play_game, game_number, opening, white, black, max_plies)
+            futures[future] = engine1_white
+
+        for future in as_completed(futures):
+            game = future.result()
+            points = {'1-0': 1.0, '0-1': 0.0}.get(game['result'], 0.5)
+            sprt.add(points if futures[future] else 1 - points)
+            if pgn_file is not None:
+                write_game(pgn_file, game['headers'], game['sans'])
+                pgn_file.flush()
+            elo, margin = sprt.elo()
+            print(f'Games {sprt.games}: +{sprt.wins} ={sprt.draws} -{sprt.losses}, Elo {elo:+.1f} +/- {margin:.1f}, '
+                  f'LLR {sprt.llr():.2f} [{sprt.lower_bound:.2f}, {sprt.upper_bound:.2f}], '
+                  f'{time.perf_counter() - start:.0f} s')
+            status = sprt.status() if stop_early else None
+            if status is not None:
+                print(f'SPRT finished - {status} accepted')
+                break
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if pgn_file is not None:
+            pgn_file.close()
+    return sprt
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Play a match between two engine configurations.')
+    parser.add_argument('--engine1', default='', help='configuration of the tested engine, e.g. depth=4,movetime=0.5')
+    parser.add_argument('--engine2', default='', help='configuration of the reference engine')
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all cores by default')
+    parser.add_argument('--openings', default=None, help='PGN or FEN file with openings, the built-in suite by default')
+    parser.add_argument('--pgn', default=None, help='file to write the games to')
+    parser.add_argument('--max-plies', type=int, default=MAX_PLIES)
+    parser.add_argument('--elo0', type=float, default=0.0)
+    parser.add_argument('--elo1', type=float, default=5.0)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--beta', type=float, default=0.05)
+    parser.add_argument('--no-sprt', action='store_true', help='play all games')
+    args = parser.parse_args()
+
+    engine1 = EngineConfig.parse('engine1', args.engine1)
+    engine2 = EngineConfig.parse('engine2', args.engine2)
+    openings = load_openings(args.openings) if args.openings is not None else None
+    sprt = None if args.no_sprt else Sprt(args.elo0, args.elo1, args.alpha, args.beta)
+    sprt = run_match(engine1, engine2, args.games, openings, args.workers, args.pgn, sprt, args.max_plies)
+    elo, margin = sprt.elo()
+    print(f'Result: +{sprt.wins} ={sprt.draws} -{sprt.losses}, Elo {elo:+.1f} +/- {margin:.1f}')
+
+
+if __name__ == '__main__':
+    main()
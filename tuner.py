@@ -0,0 +1,299 @@
+"""
+Texel tuning of the evaluation - fits PIECE_SCORES, the position tables and the pawn structure scores of ChessAi to game
+results. The evaluation is linear in the counts of pieces, of pieces on squares and of doubled, isolated and passed
+pawns, so a position is reduced to a vector of such counts (features) and its score is the dot product with the
+weights. The weights minimize the mean squared error between the
+results and the scores mapped to expected results by a sigmoid.
+
+Extracting features streams through the input and appends them to a memory-mapped file, so neither the positions nor
+the features have to fit in memory:
+
+    python tuner.py extract positions.epd games.pgn --output data/texel
+    python tuner.py train data/texel --epochs 20 --output resources/weights.json
+
+Positions files have a FEN (at least the piece placement) and a result on every line - '1-0', '0-1', '1/2-1/2' or
+[1.0], [0.5], [0.0], as written by the common Texel data sets. In PGN files every position after the first plies of a
+game is labeled with the result of the game.
+"""
+import argparse
+import json
+import math
+import re
+import time
+from typing import Iterator, List, Tuple
+import numpy as np
+from engine import GameState
+from chess_ai import ChessAi
+from pgn import read_games, san_to_move
+
+MATERIAL_PIECES = ('Q', 'R', 'B', 'N', 'P')  # The king has no material value
+TABLES = ('N', 'B', 'Q', 'R', 'wP', 'bP')  # Keys of ChessAi.PIECE_POSITION_SCORES
+# Columns of doubled, isolated and passed pawns follow the tables
+PAWN_STRUCTURE_OFFSET = len(MATERIAL_PIECES) + 64 * len(TABLES)
+PASSED_RANKS = slice(1, 7)  # Entries of ChessAi.PASSED_PAWN_SCORES a pawn can reach - the others are not tuned
+FEATURES = PAWN_STRUCTURE_OFFSET + 2 + PASSED_RANKS.stop - PASSED_RANKS.start
+BATCH_SIZE = 65536  # Positions turned into features at once
+SKIPPED_PLIES = 8  # Opening positions of PGN games say little about the result
+RESULT_POINTS = {'1-0': 1.0, '0-1': 0.0, '1/2-1/2': 0.5, '1.0': 1.0, '0.0': 0.0, '0.5': 0.5}
+_RESULT = re.compile(r'(1-0|0-1|1/2-1/2|\b1\.0\b|\b0\.0\b|\b0\.5\b)')
+_FEN_CODES = {char: ChessAi.PIECE_CODES[('w' if char.isupper() else 'b') + char.upper()] for char in 'PNBRQKpnbrqk'}
+
+
+def _build_feature_map() -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: (material column, table column offset) of every piece code, -1 where the piece has none
+    """
+    material_columns = np.full(len(ChessAi.PIECE_NAMES), -1)
+    table_offsets = np.full(len(ChessAi.PIECE_NAMES), -1)
+    for code, name in enumerate(ChessAi.PIECE_NAMES.tolist()):
+        if name == '--':
+            continue
+        if name[1] in MATERIAL_PIECES:
+            material_columns[code] = MATERIAL_PIECES.index(name[1])
+        table = name if name[1] == 'P' else name[1]
+        if table in TABLES:
+            table_offsets[code] = len(MATERIAL_PIECES) + 64 * TABLES.index(table)
+    return material_columns, table_offsets
+
+
+MATERIAL_COLUMNS, TABLE_OFFSETS = _build_feature_map()
+
+
+def codes_from_fen(fen: str) -> np.ndarray:
+    """
+    Piece codes of the 64 squares of the FEN's piece placement - much faster than setting up a GameState.
+    """
+    codes = []
+    for char in fen.split()[0]:
+        if char.isdigit():
+            codes += [0] * int(char)
+        elif char != '/':
+            codes.append(_FEN_CODES[char])
+    if len(codes) != 64:
+        raise ValueError(f'Invalid FEN: {fen}')
+    return np.array(codes, dtype=np.int8)
+
+
+def extract_features(codes: np.ndarray) -> np.ndarray:
+    """
+    :param codes: (n, 64) piece codes of n positions
+    :return: (n, FEATURES) feature counts - material and pawn structure columns hold white minus black pieces, table
+             columns +1 for a white and -1 for a black piece on the square
+    """
+    codes = codes.astype(np.intp)
+    features = np.zeros((len(codes), FEATURES), dtype=np.int8)
+    rows = np.arange(len(codes))[:, None]
+    signs = np.where(ChessAi.PIECE_NAMES.astype('<U1') == 'w', 1, -1)[codes]
+    material = MATERIAL_COLUMNS[codes]
+    for piece in range(len(MATERIAL_PIECES)):
+        features[:, piece] = (signs * (material == piece)).sum(axis=1)
+    table = TABLE_OFFSETS[codes] + ChessAi.SQUARES
+    mask = TABLE_OFFSETS[codes] >= 0
+    np.add.at(features, (np.broadcast_to(rows, codes.shape)[mask], table[mask]), signs[mask].astype(np.int8))
+    doubled, isolated, passed = ChessAi.count_pawn_structure(codes)
+    features[:, PAWN_STRUCTURE_OFFSET] = doubled
+    features[:, PAWN_STRUCTURE_OFFSET + 1] = isolated
+    features[:, PAWN_STRUCTURE_OFFSET + 2:] = passed[:, PASSED_RANKS]
+    return features
+
+
+def initial_weights() -> np.ndarray:
+    """
+    Weights of the current evaluation - the dot product with the features equals ChessAi.score_codes plus
+    ChessAi.score_pawn_structure.
+    """
+    weights = np.zeros(FEATURES)
+    for i, piece in enumerate(MATERIAL_PIECES):
+        weights[i] = ChessAi.PIECE_SCORES[piece]
+    for i, table in enumerate(TABLES):
+        offset = len(MATERIAL_PIECES) + 64 * i
+        weights[offset:offset + 64] = ChessAi.PIECE_POSITION_SCORES[table].ravel() * ChessAi.POSITION_SCORE_WEIGHT
+    weights[PAWN_STRUCTURE_OFFSET] = ChessAi.DOUBLED_PAWN_SCORE
+    weights[PAWN_STRUCTURE_OFFSET + 1] = ChessAi.ISOLATED_PAWN_SCORE
+    weights[PAWN_STRUCTURE_OFFSET + 2:] = ChessAi.PASSED_PAWN_SCORES[PASSED_RANKS]
+    return weights
+
+
+def read_positions(paths: List[str]) -> Iterator[Tuple[np.ndarray, float]]:
+    """
+    Streams labeled positions from positions files and PGN files.
+
+    :return: iterator of (piece codes, result for white)
+    """
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as input_file:
+            if path.lower().endswith('.pgn'):
+                for headers, sans in read_games(input_file):
+                    result = RESULT_POINTS.get(headers.get('Result'))
+                    if result is None:
+                        continue
+                    game_state = GameState(headers['FEN']) if 'FEN' in headers else GameState()
+                    for ply, san in enumerate(sans):
+                        move = san_to_move(game_state, san)
+                        if move is None:
+                            break
+                        game_state.make_move(move)
+                        if ply + 1 >= SKIPPED_PLIES:
+                            yield ChessAi.encode_board(game_state.board).ravel(), result
+            else:
+                for line in input_file:
+                    result = _RESULT.search(line[line.find(' '):])  # Not in the piece placement
+                    if not line.strip() or result is None:
+                        continue
+                    yield codes_from_fen(line), RESULT_POINTS[result.group(1)]
+
+
+def extract(paths: List[str], output: str) -> int:
+    """
+    Writes features of all positions to '<output>.features' and results to '<output>.results'.
+
+    :return: number of positions
+    """
+    count = 0
+    with open(output + '.features', 'wb') as features_file, open(output + '.results', 'wb') as results_file:
+        batch_codes, batch_results = [], []
+        for codes, result in read_positions(paths):
+            batch_codes.append(codes)
+            batch_results.append(result)
+            if len(batch_codes) == BATCH_SIZE:
+                extract_features(np.stack(batch_codes)).tofile(features_file)
+                np.array(batch_results, dtype=np.float32).tofile(results_file)
+                count += len(batch_codes)
+                batch_codes, batch_results = [], []
+        if batch_codes:
+            extract_features(np.stack(batch_codes)).tofile(features_file)
+            np.array(batch_results, dtype=np.float32).tofile(results_file)
+            count += len(batch_codes)
+    return count
+
+
+def load_dataset(prefix: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Memory-maps features and results written by extract().
+    """
+    features = np.memmap(prefix + '.features', dtype=np.int8, mode='r').reshape(-1, FEATURES)
+    results = np.memmap(prefix + '.results', dtype=np.float32, mode='r')
+    return features, results
+
+
+def sigmoid(scores: np.ndarray, k: float) -> np.ndarray:
+    """
+    Expected result for white of positions with the scores (in pawns).
+    """
+    return 1 / (1 + 10 ** (-k * scores / 4))
+
+
+def mean_error(features: np.ndarray, results: np.ndarray, weights: np.ndarray, k: float,
+               batch_size: int = BATCH_SIZE) -> float:
+    error = 0.0
+    for start in range(0, len(results), batch_size):
+        scores = features[start:start + batch_size].astype(np.float32) @ weights.astype(np.float32)
+        error += float(((results[start:start + batch_size] - sigmoid(scores, k)) ** 2).sum())
+    return error / len(results)
+
+
+def fit_k(features: np.ndarray, results: np.ndarray, weights: np.ndarray, samples: int = 1_000_000) -> float:
+    """
+    Scaling of the sigmoid which fits the current weights best (golden section search).
+    """
+    features, results = features[:samples], results[:samples]
+    low, high = 0.05, 5.0
+    ratio = (math.sqrt(5) - 1) / 2
+    for _ in range(30):
+        left, right = high - ratio * (high - low), low + ratio * (high - low)
+        if mean_error(features, results, weights, left) < mean_error(features, results, weights, right):
+            high = right
+        else:
+            low = left
+    return (low + high) / 2
+
+
+def train(features: np.ndarray, results: np.ndarray, weights: np.ndarray, k: float, epochs: int = 20,
+          batch_size: int = 16384, learning_rate: float = 0.01, regularization: float = 1e-6,
+          seed: int = 0) -> np.ndarray:
+    """
+    Minimizes the mean squared error with mini-batch gradient descent (Adam). Batches are read from the memory-mapped
+    features in random order. A small L2 term keeps the weights near the starting ones - material and position scores
+    are not independent (adding a constant to a whole table equals changing the material value).
+
+    :return: fitted weights
+    """
+    random_generator = np.random.default_rng(seed)
+    start_weights = weights.copy()
+    weights = weights.copy()
+    first_moment = np.zeros_like(weights)
+    second_moment = np.zeros_like(weights)
+    step = 0
+    starts = np.arange(0, len(results), batch_size)
+    for epoch in range(epochs):
+        epoch_start = time.perf_counter()
+        for start in random_generator.permutation(starts):
+            batch = features[start:start + batch_size].astype(np.float64)
+            expected = sigmoid(batch @ weights, k)
+            # d/dw (result - sigmoid(k * score / 4)) ** 2, sigmoid in base 10
+            slope = -2 * (results[start:start + batch_size] - expected) * expected * (1 - expected) * k * math.log(10) / 4
+            gradient = batch.T @ slope / len(batch) + 2 * regularization * (weights - start_weights)
+
+            step += 1
+            first_moment = 0.9 * first_moment + 0.1 * gradient
+            second_moment = 0.999 * second_moment + 0.001 * gradient ** 2
+            corrected_first = first_moment / (1 - 0.9 ** step)
+            corrected_second = second_moment / (1 - 0.999 ** step)
+            weights -= learning_rate * corrected_first / (np.sqrt(corrected_second) + 1e-8)
+        print(f'Epoch {epoch + 1}: error {mean_error(features, results, weights, k):.6f} '
+              f'({time.perf_counter() - epoch_start:.1f} s)')
+    return weights
+
+
+def export_weights(weights: np.ndarray, path: str) -> None:
+    """
+    Writes the weights in the format of ChessAi.load_weights.
+    """
+    exported = {'PIECE_SCORES': {piece: round(float(weights[i]), 3) for i, piece in enumerate(MATERIAL_PIECES)}}
+    for i, table in enumerate(TABLES):
+        offset = len(MATERIAL_PIECES) + 64 * i
+        scores = weights[offset:offset + 64].reshape(8, 8) / ChessAi.POSITION_SCORE_WEIGHT
+        exported[ChessAi.POSITION_TABLE_NAMES[table]] = np.round(scores, 3).tolist()
+    exported['DOUBLED_PAWN_SCORE'] = round(float(weights[PAWN_STRUCTURE_OFFSET]), 3)
+    exported['ISOLATED_PAWN_SCORE'] = round(float(weights[PAWN_STRUCTURE_OFFSET + 1]), 3)
+    passed_pawn_scores = np.zeros(len(ChessAi.PASSED_PAWN_SCORES))
+    passed_pawn_scores[PASSED_RANKS] = weights[PAWN_STRUCTURE_OFFSET + 2:]
+    exported['PASSED_PAWN_SCORES'] = np.round(passed_pawn_scores, 3).tolist()
+    with open(path, 'w', encoding='utf-8') as weights_file:
+        json.dump(exported, weights_file, indent=1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Tune the evaluation on labeled positions.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    extract_parser = commands.add_parser('extract', help='extract features from positions and PGN files')
+    extract_parser.add_argument('inputs', nargs='+')
+    extract_parser.add_argument('--output', required=True, help='prefix of the feature files')
+    train_parser = commands.add_parser('train', help='fit the weights to extracted features')
+    train_parser.add_argument('dataset', help='prefix of the feature files')
+    train_parser.add_argument('--output', required=True, help='weights file to write')
+    train_parser.add_argument('--weights', default=None, help='weights file to start from, the current scores if not set')
+    train_parser.add_argument('--epochs', type=int, default=20)
+    train_parser.add_argument('--batch-size', type=int, default=16384)
+    train_parser.add_argument('--learning-rate', type=float, default=0.01)
+    train_parser.add_argument('--k', type=float, default=None, help='sigmoid scaling, fitted if not set')
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        count = extract(args.inputs, args.output)
+        print(f'{count} positions written to {args.output}.features')
+        return
+
+    if args.weights is not None:
+        ChessAi.load_weights(args.weights)
+    features, results = load_dataset(args.dataset)
+    weights = initial_weights()
+    k = args.k if args.k is not None else fit_k(features, results, weights)
+    print(f'{len(results)} positions, k = {k:.3f}, error {mean_error(features, results, weights, k):.6f}')
+    weights = train(features, results, weights, k, args.epochs, args.batch_size, args.learning_rate)
+    export_weights(weights, args.output)
+    print(f'Weights written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+UCI (Universal Chess Interface) front-end of the engine. Reads commands from stdin and writes replies to stdout, so the
+engine can be used by chess GUIs and tournament tools:
+
+    python uci.py
+"""
+import json
+import os
+import sys
+import threading
+from typing import List, TextIO, Union
+from engine import GameState, START_FEN
+from chess_ai import ChessAi, SearchEngine, SearchLimits, SearchStats, MAX_DEPTH
+from book import OpeningBook
+from bitbases import Bitbases
+from nnue import Network
+
+ENGINE_NAME = 'ChessGame'
+ENGINE_AUTHOR = 'Patryk Bandyra'
+DEFAULT_MOVES_TO_GO = 30  # Expected number of moves left in the game when the GUI does not say
+MAX_MULTI_PV = 64  # Largest number of lines the GUI may ask for
+MOVE_OVERHEAD = 0.05  # Seconds kept in reserve for communication with the GUI
+DEFAULT_BOOK_PATH = 'resources/book.bin'  # Polyglot book used if present, changed with 'setoption name BookFile'
+BITBASES_PATH = 'resources/bitbases.bin'  # Endgame bitbases used if present
+WEIGHTS_PATH = 'resources/weights.json'  # Tuned evaluation used if present
+NETWORK_PATH = 'resources/nnue.npz'  # Neural evaluation used instead of the handcrafted one if present
+
+
+class UciEngine:
+    def __init__(self, input_stream: TextIO = sys.stdin, output_stream: TextIO = sys.stdout):
+        self.input_stream = input_stream
+        self.output_stream = output_stream
+        self.output_lock = threading.Lock()
+        # Stop event cleared by go() before the search thread starts, so that a 'stop' right after 'go' is not lost
+        self.engine = SearchEngine(info_callback=self.send_info, stop_event=threading.Event())
+        self.book_path = DEFAULT_BOOK_PATH
+        if os.path.exists(DEFAULT_BOOK_PATH):
+            self.engine.book = OpeningBook(DEFAULT_BOOK_PATH)
+        if os.path.exists(BITBASES_PATH):
+            self.engine.bitbases = Bitbases(BITBASES_PATH)
+        if os.path.exists(WEIGHTS_PATH):
+            ChessAi.load_weights(WEIGHTS_PATH)
+        if os.path.exists(NETWORK_PATH):
+            self.engine.network = Network.load(NETWORK_PATH)
+        self.game_state = GameState()
+        self.search_thread: Union[threading.Thread, None] = None
+
+    def send(self, line: str) -> None:
+        with self.output_lock:
+            self.output_stream.write(line + '\n')
+            self.output_stream.flush()
+
+    def run(self) -> None:
+        """
+        Processes commands until 'quit' or end of input.
+        """
+        for line in self.input_stream:
+            tokens = line.split()
+            if not tokens:
+                continue
+            command, args = tokens[0], tokens[1:]
+            try:
+                self.run_command(command, args)
+            except (ValueError, IndexError, KeyError) as e:  # Malformed command - the engine keeps running
+                self.send(f'info string {e}')
+            if command == 'quit':
+                return
+
+        self.finish_search(stop=False)  # End of input - let the last search report its move
+
+    def run_command(self, command: str, args: List[str]) -> None:
+        """
+        Raises ValueError, IndexError or KeyError if the arguments are malformed.
+        """
+        if command == 'uci':
+            self.send(f'id name {ENGINE_NAME}')
+            self.send(f'id author {ENGINE_AUTHOR}')
+            self.send(f'option name OwnBook type check default {"true" if self.engine.book else "false"}')
+            self.send(f'option name BookFile type string default {DEFAULT_BOOK_PATH}')
+            self.send('option name SearchStats type check default false')
+            self.send(f'option name MultiPV type spin default 1 min 1 max {MAX_MULTI_PV}')
+            self.send('uciok')
+        elif command == 'isready':
+            self.send('readyok')
+        elif command == 'setoption':
+            self.finish_search()
+            self.set_option(args)
+        elif command == 'ucinewgame':
+            self.finish_search()
+            self.engine.new_game()
+            self.game_state = GameState()
+        elif command == 'position':
+            self.finish_search()  # GUIs send 'stop' first - a search still running may never end on its own
+            self.set_position(args)
+        elif command == 'go':
+            self.finish_search()
+            self.go(args)
+        elif command == 'ponderhit':
+            self.engine.ponderhit()
+        elif command == 'stop':
+            self.finish_search()
+        elif command == 'quit':
+            self.finish_search()
+
+    def set_option(self, args: List[str]) -> None:
+        """
+        setoption name <name> [value <value>]
+        """
+        value_index = args.index('value') if 'value' in args else len(args)
+        name = ' '.join(args[1:value_index]).lower()
+        value = ' '.join(args[value_index + 1:])
+        if name == 'bookfile':
+            self.book_path = value
+            self.engine.book = OpeningBook(value) if os.path.exists(value) else None
+        elif name == 'ownbook':
+            self.engine.book = OpeningBook(self.book_path) if value == 'true' and os.path.exists(self.book_path) \
+                else None
+        elif name == 'searchstats':
+            self.engine.stats = SearchStats() if value == 'true' else None
+        elif name == 'multipv':
+            self.engine.multi_pv = min(max(int(value), 1), MAX_MULTI_PV)
+        else:
+            self.send(f'info string unknown option {name}')
+
+    def set_position(self, args: List[str]) -> None:
+        """
+        position [startpos | fen <fen>] [moves <move1> ... <moveN>]
+        """
+        moves_index = args.index('moves') if 'moves' in args else len(args)
+        if args and args[0] == 'fen':
+            fen = ' '.join(args[1:moves_index])
+        else:
+            fen = START_FEN
+        game_state = GameState(fen)
+        for notation in args[moves_index + 1:]:
+            move = game_state.get_move_from_notation(notation)
+            if move is None:
+                self.send(f'info string illegal move {notation}')
+                return
+            game_state.make_move(move)
+        self.game_state = game_state
+
+    def go(self, args: List[str]) -> None:
+        """
+        go [ponder] [depth <plies>] [nodes <n>] [movetime <ms>] [wtime <ms>] [btime <ms>] [winc <ms>] [binc <ms>]
+           [movestogo <n>] [infinite]
+
+        With 'ponder' the position after the expected move is searched on the opponent's time. The limits apply from
+        'ponderhit' on and the best move is not sent before 'ponderhit' or 'stop'.
+        """
+        values = {}
+        for i, arg in enumerate(args):
+            if arg in ('depth', 'nodes', 'movetime', 'wtime', 'btime', 'winc', 'binc', 'movestogo') and i + 1 < len(args):
+                values[arg] = int(args[i + 1])
+
+        limits = SearchLimits(depth=values.get('depth', MAX_DEPTH), nodes=values.get('nodes'))
+        if 'movetime' in values:
+            limits.move_time = values['movetime'] / 1000
+        else:
+            time_left = values.get('wtime' if self.game_state.white_to_move else 'btime')
+            if time_left is not None:
+                increment = values.get('winc' if self.game_state.white_to_move else 'binc', 0)
+                moves_to_go = values.get('movestogo', DEFAULT_MOVES_TO_GO)
+                move_time = time_left / moves_to_go + increment * 0.8
+                limits.move_time = max(0.01, min(move_time, time_left / 2) / 1000 - MOVE_OVERHEAD)
+        if 'infinite' not in args and 'depth' not in values and 'nodes' not in values and limits.move_time is None:
+            limits.depth = ChessAi.DEPTH  # Plain 'go' - search to the default depth
+
+        self.engine.stop_event.clear()
+        if 'ponder' in args:  # Before the thread starts, so that a following 'ponderhit' is not lost
+            self.engine.begin_ponder()
+        self.search_thread = threading.Thread(target=self.search, args=(self.game_state, limits, 'ponder' in args))
+        self.search_thread.start()
+
+    def search(self, game_state: GameState, limits: SearchLimits, ponder: bool) -> None:
+        """
+        Sends the best move - 'bestmove 0000' if there is none or the search failed, so the GUI never waits forever.
+        """
+        move = None
+        try:
+            move = self.engine.search(game_state, limits=limits, ponder=ponder)
+        finally:
+            if move is None:
+                self.send('bestmove 0000')
+            elif len(self.engine.principal_variation) > 1:  # Expected reply - the GUI may let the engine ponder on it
+                self.send(f'bestmove {move.get_chess_notation()} '
+                          f'ponder {self.engine.principal_variation[1].get_chess_notation()}')
+            else:
+                self.send(f'bestmove {move.get_chess_notation()}')
+
+    def finish_search(self, stop: bool = True) -> None:
+        """
+        Waits for the running search to send its best move.
+
+        :param stop: if True, the search is stopped first
+        """
+        if self.search_thread is not None and self.search_thread.is_alive():
+            if stop or self.engine.pondering:  # A ponder search would never finish on its own
+                self.engine.stop()
+            self.search_thread.join()
+        self.search_thread = None
+
+    def send_info(self, info: dict) -> None:
+        progress = f'nodes {info["nodes"]} nps {info["nps"]} time {int(info["time"] * 1000)}'
+        if 'lines' in info:
+            for number, line in enumerate(info['lines'], 1):
+                self.send(f'info depth {info["depth"]} multipv {number} score {UciEngine.format_score(line["score"])} '
+                          f'{progress} pv {" ".join(line["pv"])}')
+        else:
+            self.send(f'info depth {info["depth"]} score {UciEngine.format_score(info["score"])} {progress} '
+                      f'pv {" ".join(info["pv"])}')
+        if 'stats' in info:
+            self.send(f'info string stats {json.dumps(info["stats"])}')
+
+    @staticmethod
+    def format_score(score: float) -> str:
+        """
+        Engine scores are in pawns from the side to move's point of view. Mates are reported in moves.
+        """
+        if abs(score) > SearchEngine.MATE_THRESHOLD:
+            plies = ChessAi.CHECKMATE - abs(score)
+            moves = (plies + 1) // 2
+            return f'mate {int(moves) if score > 0 else -int(moves)}'
+        return f'cp {round(score * 100)}'
+
+
+def main() -> None:
+    UciEngine().run()
+
+
+if __name__ == '__main__':
+    main()